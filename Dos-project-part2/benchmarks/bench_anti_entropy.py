@@ -0,0 +1,88 @@
+# What an anti-entropy pass (common/anti_entropy.py) costs as the two
+# catalog replicas drift apart, in throwaway files: nodes compared and time
+# to find and repair N differing books, next to reading and comparing both
+# tables whole.
+#
+#   python benchmarks/bench_anti_entropy.py --books 200000 --drift 0,1,10,100,1000,10000
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import closing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common.anti_entropy import LAYOUTS, AntiEntropy, refresh
+from common.db_pool import open_connection
+from common.rebalance import create_like
+
+CATALOG_DB = os.path.join(os.path.dirname(__file__), '../catalog/catalog-1/catalog1.db')
+
+
+def load(path, books):
+    with closing(open_connection(path)) as connection, connection:
+        connection.execute(
+            "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+            "INSERT INTO books (id, title, quantity, price, topic) "
+            "SELECT i, 'Book ' || i, 1000, 10.0, 'Topic ' || (i % 50) FROM n", (books,))
+
+
+def drift(path, books, count):
+    # `count` random books changed, half of them in quantity, a few deleted
+    ids = random.sample(range(1, books + 1), count)
+    with closing(open_connection(path)) as connection, connection:
+        for index, book_id in enumerate(ids):
+            if index % 10 == 9:
+                connection.execute("DELETE FROM books WHERE id = ?", (book_id,))
+            elif index % 2:
+                connection.execute("UPDATE books SET quantity = quantity - 1 WHERE id = ?", (book_id,))
+            else:
+                connection.execute("UPDATE books SET price = price + 1 WHERE id = ?", (book_id,))
+
+
+def full_compare(source_path, target_path):
+    # the naive way: read both tables and compare them row by row
+    query = "SELECT id, title, quantity, price, topic FROM books ORDER BY id"
+    with closing(open_connection(source_path)) as source, closing(open_connection(target_path)) as target:
+        return len(set(source.execute(query).fetchall()) ^ set(target.execute(query).fetchall()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=200000)
+    parser.add_argument('--drift', default='0,1,10,100,1000,10000')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        source, target = (os.path.join(workdir, f'catalog{n}.db') for n in (1, 2))
+        for path in (source, target):
+            create_like(path, CATALOG_DB, 'books')
+            load(path, args.books)
+        job = AntiEntropy([('catalog', 'catalog', source, [target])], max_blocks=10 ** 9)
+        start = time.perf_counter()
+        job.run_once(repair=False)
+        print(f"built the checksum trees of {args.books} books twice in {time.perf_counter() - start:.1f}s")
+
+        print(f"{'drift':>6} {'nodes':>7} {'blocks':>7} {'rows':>6} {'refresh ms':>11} {'pass ms':>9} {'full scan ms':>13}")
+        for count in (int(value) for value in args.drift.split(',')):
+            drift(target, args.books, count)
+            start = time.perf_counter()
+            with closing(open_connection(target)) as connection:
+                refresh(connection, LAYOUTS['catalog'])
+            refreshed = (time.perf_counter() - start) * 1000
+            report = job.run_once(confirm=False)['replicas']['catalog:catalog2.db']
+            start = time.perf_counter()
+            left = full_compare(source, target)
+            scan = (time.perf_counter() - start) * 1000
+            assert left == 0, f"{left} rows still differ"
+            print(f"{count:>6} {report['nodes_compared']:>7} {report['blocks_differing']:>7} {report['rows_repaired']:>6} "
+                  f"{refreshed:11.1f} {report['duration_ms']:9.1f} {scan:13.1f}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
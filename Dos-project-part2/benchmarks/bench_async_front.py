@@ -0,0 +1,160 @@
+# The Flask front (threaded dev server) against the asyncio front (asgi_app.py
+# under uvicorn) on a throwaway copy of the tree, with --connections keep-alive
+# clients each sending requests back to back. Both fronts read and write the
+# replica files directly (FRONT_BACKEND=sqlite), so no other service is started.
+#
+#   python benchmarks/bench_async_front.py --connections 1000 --seconds 10 --purchase-ratio 0.1
+import argparse
+import asyncio
+import os
+import random
+import resource
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BOOK_IDS = (1, 2)
+
+FLASK_SERVER = """
+import sys
+from werkzeug.serving import WSGIRequestHandler
+import app
+WSGIRequestHandler.protocol_version = "HTTP/1.1"
+WSGIRequestHandler.disable_nagle_algorithm = True
+app.app.run(port=int(sys.argv[1]), threaded=True)
+"""
+
+
+def restock(tree, stock):
+    for path in ('catalog/catalog-1/catalog1.db', 'catalog/catalog-2/catalog2.db'):
+        connection = sqlite3.connect(os.path.join(tree, path))
+        connection.execute("UPDATE books SET quantity=?", (stock,))
+        connection.commit()
+        connection.close()
+
+
+def stock_left(tree):
+    left = []
+    for path in ('catalog/catalog-1/catalog1.db', 'catalog/catalog-2/catalog2.db'):
+        connection = sqlite3.connect(os.path.join(tree, path))
+        left.append(connection.execute("SELECT SUM(quantity) FROM books WHERE id IN (1, 2)").fetchone()[0])
+        connection.close()
+    return left
+
+
+def wait_for_port(port, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+async def request(reader, writer, method, path):
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: 0\r\n\r\n".encode())
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = {name.lower(): value.strip() for name, _, value in (line.partition(':') for line in lines[1:] if line)}
+    await reader.readexactly(int(headers.get('content-length', 0)))
+    closes = headers.get('connection', '').lower() == 'close' or lines[0].startswith('HTTP/1.0')
+    return status, closes
+
+
+async def client(port, deadline, purchase_ratio, stats):
+    connection = None
+    while time.time() < deadline:
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection('127.0.0.1', port)
+            if random.random() < purchase_ratio:
+                kind, method, path = 'purchase', 'PUT', f'/purchase/{random.choice(BOOK_IDS)}/'
+            else:
+                kind, method, path = 'read', 'GET', f'/product/{random.choice(BOOK_IDS)}'
+            start = time.perf_counter()
+            status, closes = await request(*connection, method, path)
+            stats[kind].append(time.perf_counter() - start)
+            if status >= 500:
+                stats['errors'] += 1
+            elif kind == 'purchase' and status == 200:
+                stats['sold'] += 1
+            if closes:
+                connection[1].close()
+                connection = None
+        except (OSError, asyncio.IncompleteReadError):
+            stats['errors'] += 1
+            if connection:
+                connection[1].close()
+            connection = None
+            await asyncio.sleep(0.05)
+    if connection:
+        connection[1].close()
+
+
+async def load(port, connections, seconds, purchase_ratio):
+    stats = {'read': [], 'purchase': [], 'errors': 0, 'sold': 0}
+    deadline = time.time() + seconds
+    await asyncio.gather(*(client(port, deadline, purchase_ratio, stats) for _ in range(connections)))
+    return stats
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000
+
+
+def run(label, command, tree, port, args):
+    restock(tree, args.stock)
+    log = open(os.path.join(tree, f'{label}.log'), 'w')
+    server = subprocess.Popen(command, cwd=os.path.join(tree, 'front-and-server'), stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_for_port(port)
+        stats = asyncio.run(load(port, args.connections, args.seconds, args.purchase_ratio))
+    finally:
+        server.terminate()
+        server.wait()
+        log.close()
+
+    total = len(stats['read']) + len(stats['purchase'])
+    left = stock_left(tree)
+    print(f"{label:<8} {total / args.seconds:8.0f} req/s  "
+          f"read p50 {percentile(stats['read'], 0.5):7.1f} ms  p99 {percentile(stats['read'], 0.99):7.1f} ms  "
+          f"purchase p50 {percentile(stats['purchase'], 0.5):7.1f} ms  p99 {percentile(stats['purchase'], 0.99):7.1f} ms  "
+          f"errors {stats['errors']}  sold {stats['sold']}  replicas agree {left[0] == left[1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--purchase-ratio', type=float, default=0.1)
+    parser.add_argument('--stock', type=int, default=1000000)
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    # every connection is a socket on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.connections * 2 + 256)), hard))
+
+    workdir = tempfile.mkdtemp()
+    try:
+        tree = os.path.join(workdir, 'tree')
+        shutil.copytree(ROOT, tree, ignore=shutil.ignore_patterns('__pycache__', '*.db-wal', '*.db-shm'))
+        run("flask", [sys.executable, '-c', FLASK_SERVER, str(args.port)], tree, args.port, args)
+        run("asyncio", [sys.executable, 'asgi_app.py', '--port', str(args.port)], tree, args.port, args)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# Compares one-connection-per-request calls against the pooled BackendClient
+# using two local stand-in catalog replicas, then stops one replica to check failover.
+#
+#   python benchmarks/bench_backend_client.py --requests 5000 --threads 16
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common.http_client import BackendClient
+
+BOOK = json.dumps({"id": 1, "title": "How to get a good grade in DOS in 40 minutes a day",
+                   "quantity": 10, "price": 20.0, "topic": "distributed systems"}).encode()
+
+
+class StandInReplica(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(BOOK)))
+        self.end_headers()
+        self.wfile.write(BOOK)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_replica():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInReplica)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(label, call, total, threads):
+    latencies = []
+
+    def one(_):
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{label:<22} {total / elapsed:9.0f} req/s   p50 {latencies[len(latencies) // 2] * 1000:6.2f} ms   p99 {p99 * 1000:6.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+
+    replicas = [start_replica(), start_replica()]
+    urls = [f"http://127.0.0.1:{server.server_address[1]}" for server in replicas]
+    counter = iter(range(10 ** 9))
+
+    def new_connection():
+        url = urls[next(counter) % 2]
+        with urllib.request.urlopen(f"{url}/retrieve/item/1") as response:
+            response.read()
+
+    client = BackendClient(urls, max_connections=args.threads)
+    run("new connection", new_connection, args.requests, args.threads)
+    run("pooled keep-alive", lambda: client.get('/retrieve/item/1'), args.requests, args.threads)
+    print("connections opened by pool:", sum(pool.created for pool in client.pools))
+
+    replicas[0].shutdown()
+    replicas[0].server_close()
+    client.close()
+    run("pooled, one replica down", lambda: client.get('/retrieve/item/1'), args.requests, args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# Catalog reads on a throwaway copy of catalog1.db padded to --books rows:
+# query + dict(row) + json per request against CatalogSnapshot lookups, with
+# a purchase-style write every --write-every reads so the deltas are exercised.
+#
+#   python benchmarks/bench_catalog_snapshot.py --books 5000 --reads 50000
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common.catalog_snapshot import CatalogSnapshot
+from common.db_pool import open_connection
+from common.migrations import migrate
+from common.topic_search import search_books
+
+CATALOG_DB = os.path.join(os.path.dirname(__file__), '../catalog/catalog-1/catalog1.db')
+TOPICS = ['Fiction', 'Programming', 'Art', 'History', 'Science', 'Poetry', 'Travel', 'Cooking']
+
+
+def pad(path, books):
+    connection = open_connection(path)
+    start = connection.execute("SELECT MAX(id) FROM books").fetchone()[0] + 1
+    connection.executemany("INSERT INTO books (id, title, quantity, price, topic) VALUES (?, ?, ?, ?, ?)",
+                           [(book_id, f"Book {book_id}", 1000000, 10.0, random.choice(TOPICS))
+                            for book_id in range(start, books + 1)])
+    connection.commit()
+    connection.close()
+
+
+def requests(books, reads):
+    for _ in range(reads):
+        if random.random() < 0.8:
+            yield 'item', random.randint(1, books)
+        else:
+            yield 'topic', random.choice(TOPICS)[:4].lower()
+
+
+def sqlite_reads(connection, writer, work, write_every):
+    for count, (kind, key) in enumerate(work):
+        if count % write_every == 0:
+            writer.execute("UPDATE books SET quantity = quantity - 1 WHERE id = ?", (key if kind == 'item' else 1,))
+            writer.commit()
+        if kind == 'item':
+            row = connection.execute("SELECT * FROM books WHERE id=?", (key,)).fetchone()
+            json.dumps(dict(row))
+        else:
+            json.dumps([dict(row) for row in search_books(connection, key)])
+
+
+def snapshot_reads(snapshot, writer, work, write_every):
+    for count, (kind, key) in enumerate(work):
+        if count % write_every == 0:
+            writer.execute("UPDATE books SET quantity = quantity - 1 WHERE id = ?", (key if kind == 'item' else 1,))
+            writer.commit()
+        if kind == 'item':
+            snapshot.refresh().item(key)
+        else:
+            snapshot.refresh().topic(key)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=5000)
+    parser.add_argument('--reads', type=int, default=50000)
+    parser.add_argument('--write-every', type=int, default=100)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'catalog.db')
+        shutil.copy(CATALOG_DB, path)
+        migrate(path, 'catalog')
+        pad(path, args.books)
+        work = list(requests(args.books, args.reads))
+        writer = open_connection(path)
+
+        connection = open_connection(path)
+        start = time.perf_counter()
+        sqlite_reads(connection, writer, work, args.write_every)
+        elapsed = time.perf_counter() - start
+        print(f"{'sqlite + json':<16} {args.reads / elapsed:9.0f} reads/s")
+
+        snapshot = CatalogSnapshot(path)
+        start = time.perf_counter()
+        snapshot_reads(snapshot, writer, work, args.write_every)
+        elapsed = time.perf_counter() - start
+        print(f"{'snapshot':<16} {args.reads / elapsed:9.0f} reads/s  {snapshot.stats()}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Mixed read/write load on throwaway copies of catalog1.db and order1.db,
+# first as shipped (rollback journal, SQLite defaults) and then after
+# migrate() and with each connection PRAGMA profile.
+#
+#   python benchmarks/bench_db_profiles.py --readers 8 --writers 4 --seconds 3
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common.db_pool import PROFILES, open_connection
+from common.migrations import migrate
+from common.stock import decrement_stock, insert_order
+from common.topic_search import search_books
+
+HERE = os.path.dirname(__file__)
+CATALOG_DB = os.path.join(HERE, '../catalog/catalog-1/catalog1.db')
+ORDER_DB = os.path.join(HERE, '../order/order-1/order1.db')
+TOPICS = ["Fiction", "Programming", "Art", "History", "Science", "Travel"]
+
+
+def prepare(workdir, books):
+    catalog = os.path.join(workdir, 'catalog.db')
+    orders = os.path.join(workdir, 'order.db')
+    shutil.copy(CATALOG_DB, catalog)
+    shutil.copy(ORDER_DB, orders)
+    connection = sqlite3.connect(catalog)
+    rng = random.Random(3)
+    connection.executemany("INSERT INTO books (title, quantity, price, topic) VALUES (?, ?, ?, ?)",
+                           ((f"Book {i}", 10 ** 6, rng.randint(5, 200), rng.choice(TOPICS)) for i in range(books)))
+    connection.commit()
+    connection.close()
+    return catalog, orders
+
+
+def run(label, catalog, orders, pragmas, args):
+    stop = time.monotonic() + args.seconds
+    read_latencies, writes, errors = [], [0], [0]
+    max_id = sqlite3.connect(catalog).execute("SELECT MAX(id) FROM books").fetchone()[0]
+
+    def reader(seed):
+        rng = random.Random(seed)
+        connection = open_connection(catalog, pragmas=pragmas)
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            try:
+                if rng.random() < 0.9:
+                    connection.execute("SELECT * FROM books WHERE id=?", (rng.randint(1, max_id),)).fetchone()
+                else:
+                    search_books(connection, rng.choice(TOPICS), 'exact')
+            except sqlite3.OperationalError:
+                errors[0] += 1
+                continue
+            read_latencies.append(time.perf_counter() - start)
+
+    def writer(seed):
+        rng = random.Random(seed)
+        catalog_connection = open_connection(catalog, pragmas=pragmas)
+        order_connection = open_connection(orders, pragmas=pragmas)
+        while time.monotonic() < stop:
+            book_id = rng.randint(1, max_id)
+            try:
+                decrement_stock(catalog_connection, book_id)
+                insert_order(order_connection, book_id)
+                writes[0] += 1
+            except sqlite3.OperationalError:
+                errors[0] += 1
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+    threads += [threading.Thread(target=writer, args=(100 + i,)) for i in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    read_latencies.sort()
+    p99 = read_latencies[int(len(read_latencies) * 0.99)] * 1000 if read_latencies else 0
+    print(f"{label:<26} reads {len(read_latencies) / args.seconds:8.0f}/s  p99 {p99:7.2f} ms   "
+          f"purchases {writes[0] / args.seconds:7.0f}/s   busy errors {errors[0]}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--books', type=int, default=20000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        catalog, orders = prepare(workdir, args.books)
+        run("rollback journal, defaults", catalog, orders, (), args)
+        migrate(catalog, 'catalog')
+        migrate(orders, 'order')
+        for profile, pragmas in PROFILES.items():
+            run(f"WAL, {profile}", catalog, orders, pragmas, args)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
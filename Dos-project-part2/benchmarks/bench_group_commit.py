@@ -0,0 +1,72 @@
+# Orders/sec for concurrent purchases on a throwaway copy of order1.db: one
+# commit per order (insert_order) against the GroupCommitWriter.
+#
+#   python benchmarks/bench_group_commit.py --threads 32 --orders 200
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common.group_commit import GroupCommitWriter
+from common.stock import insert_order
+
+ORDER_DB = os.path.join(os.path.dirname(__file__), '../order/order-1/order1.db')
+
+
+def run(label, make_buyer, threads, orders):
+    buyers = [threading.Thread(target=make_buyer(), args=(orders,)) for _ in range(threads)]
+    start = time.perf_counter()
+    for buyer in buyers:
+        buyer.start()
+    for buyer in buyers:
+        buyer.join()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<26} {threads * orders / elapsed:8.0f} orders/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--orders', type=int, default=100, help="orders per thread")
+    parser.add_argument('--max-rows', type=int, default=128)
+    parser.add_argument('--delay-ms', type=float, default=2)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'order.db')
+        shutil.copy(ORDER_DB, path)
+
+        def direct_buyer():
+            def buy(orders):
+                connection = sqlite3.connect(path, timeout=60)
+                for _ in range(orders):
+                    insert_order(connection, 1)
+                connection.close()
+            return buy
+
+        run("commit per order", direct_buyer, args.threads, args.orders)
+
+        writer = GroupCommitWriter(path, args.max_rows, args.delay_ms / 1000)
+
+        def grouped_buyer():
+            def buy(orders):
+                for _ in range(orders):
+                    writer.write(1)
+            return buy
+
+        run("group commit", grouped_buyer, args.threads, args.orders)
+        stats = writer.stats()
+        print(f"{stats['commits']} commits, {stats['rows_per_commit']} rows per commit, "
+              f"largest batch {stats['largest_batch']}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
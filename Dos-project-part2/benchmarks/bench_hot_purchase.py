@@ -0,0 +1,105 @@
+# Concurrent buyers hammering one book on a throwaway copy of catalog1.db:
+# the old SELECT / quantity - 1 / UPDATE sequence against decrement_stock(),
+# and against the in-memory counters of HOT_BOOKS mode (common/hot_stock.py)
+# flushed to the file every --flush-ms.
+#
+#   python benchmarks/bench_hot_purchase.py --buyers 16 --stock 2000
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common.hot_stock import reservation_id, HotStock
+from common.stock import decrement_stock, PURCHASED
+
+CATALOG_DB = os.path.join(os.path.dirname(__file__), '../catalog/catalog-1/catalog1.db')
+ORDER_DB = os.path.join(os.path.dirname(__file__), '../order/order-1/order1.db')
+BOOK_ID = 1
+
+
+def read_modify_write(connection, book_id):
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM books WHERE id=?", (book_id,))
+    book = cursor.fetchone()
+    if book is None or book['quantity'] <= 0:
+        return False
+    cursor.execute("UPDATE books SET quantity=? WHERE id=?", (book['quantity'] - 1, book_id))
+    connection.commit()
+    return True
+
+
+def atomic(connection, book_id):
+    status, _ = decrement_stock(connection, book_id)
+    return status == PURCHASED
+
+
+def run(label, buy, path, buyers, stock, attempts, hot_stock=None):
+    setup = sqlite3.connect(path)
+    setup.execute("UPDATE books SET quantity=? WHERE id=?", (stock, BOOK_ID))
+    setup.commit()
+    if hot_stock is not None:
+        hot_stock = hot_stock()
+        # each reservation is written down before it is confirmed, as /reserve does
+        buy = lambda connection, book_id: hot_stock.reserve([(book_id, 1)], reservation_id())[0] == PURCHASED
+
+    sold = [0] * buyers
+    errors = [0] * buyers
+
+    def buyer(index):
+        connection = sqlite3.connect(path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        for _ in range(attempts):
+            try:
+                if buy(connection, BOOK_ID):
+                    sold[index] += 1
+            except sqlite3.OperationalError:
+                connection.rollback()
+                errors[index] += 1
+        connection.close()
+
+    threads = [threading.Thread(target=buyer, args=(i,)) for i in range(buyers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if hot_stock is not None:
+        hot_stock.flush()
+
+    remaining = setup.execute("SELECT quantity FROM books WHERE id=?", (BOOK_ID,)).fetchone()[0]
+    setup.close()
+    total_sold = sum(sold)
+    print(f"{label:<20} {buyers * attempts / elapsed:8.0f} attempts/s  sold {total_sold:6d}  "
+          f"left {remaining:6d}  oversold {total_sold - (stock - remaining):6d}  busy errors {sum(errors)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--buyers', type=int, default=16)
+    parser.add_argument('--stock', type=int, default=2000)
+    parser.add_argument('--attempts', type=int, default=200)
+    parser.add_argument('--flush-ms', type=float, default=50)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'catalog.db')
+        order_path = os.path.join(workdir, 'order.db')
+        shutil.copy(CATALOG_DB, path)
+        shutil.copy(ORDER_DB, order_path)
+        run("read-modify-write", read_modify_write, path, args.buyers, args.stock, args.attempts)
+        run("atomic decrement", atomic, path, args.buyers, args.stock, args.attempts)
+        run("hot stock counter", None, path, args.buyers, args.stock, args.attempts,
+            lambda: HotStock([path], order_path, [BOOK_ID], args.flush_ms / 1000).start())
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Sales analytics on millions of orders in a throwaway file: the rollup
+# tables (common/order_rollups.py) against the same answers computed from
+# orders, how long a rebuild takes, and what the triggers add to a purchase.
+#
+#   python benchmarks/bench_order_rollups.py --rows 2000000 --books 10000 --days 365
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import closing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common.db_pool import open_connection
+from common.order_rollups import TRIGGERS, book_sales, rebuild_rollups, sales_by_bucket, top_sellers
+from common.rebalance import create_like
+from common.stock import insert_orders
+
+ORDER_DB = os.path.join(os.path.dirname(__file__), '../order/order-1/order1.db')
+
+SCANS = {
+    'top sellers': ("SELECT book_id, COUNT(*), SUM(quantity) FROM orders GROUP BY book_id "
+                    "ORDER BY SUM(quantity) DESC, book_id LIMIT 20", ()),
+    'sales of one book': ("SELECT substr(order_date, 1, 10), COUNT(*), SUM(quantity) FROM orders "
+                          "WHERE book_id = ? GROUP BY 1 ORDER BY 1", (42,)),
+    'sales per day': ("SELECT substr(order_date, 1, 10), COUNT(*), SUM(quantity) FROM orders GROUP BY 1 ORDER BY 1", ()),
+    'sales per hour, one day': ("SELECT substr(order_date, 1, 13), COUNT(*), SUM(quantity) FROM orders "
+                                "WHERE order_date >= ? AND order_date < ? GROUP BY 1 ORDER BY 1",
+                                ('2024-06-01', '2024-06-02')),
+}
+
+ROLLUPS = {
+    'top sellers': lambda connection: top_sellers(connection, 20),
+    'sales of one book': lambda connection: book_sales(connection, 42),
+    'sales per day': lambda connection: sales_by_bucket(connection, 'day'),
+    'sales per hour, one day': lambda connection: sales_by_bucket(connection, 'hour', '2024-06-01', '2024-06-01 23'),
+}
+
+
+def drop_triggers(connection):
+    with connection:
+        for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'order_sales_%'").fetchall():
+            connection.execute(f"DROP TRIGGER {name}")
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def load(connection, rows, books, days):
+    # rows spread over `days` days from 2024-01-01, one order every few seconds
+    step = days * 86400 // rows or 1
+    connection.execute("DELETE FROM orders")
+    connection.execute(
+        "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+        "INSERT INTO orders (id, book_id, order_date, quantity) "
+        "SELECT i, abs(random()) % ? + 1, datetime(strftime('%s', '2024-01-01') + i * ?, 'unixepoch'), abs(random()) % 3 + 1 FROM n",
+        (rows, books, step))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--purchases', type=int, default=4000)
+    parser.add_argument('--cart', type=int, default=64)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'order.db')
+        create_like(path, ORDER_DB, 'orders')
+        with closing(open_connection(path)) as connection:
+            # bulk load without the triggers, then one rebuild
+            drop_triggers(connection)
+            start = time.perf_counter()
+            with connection:
+                load(connection, args.rows, args.books, args.days)
+            print(f"loaded {args.rows} orders in {time.perf_counter() - start:.1f}s")
+            start = time.perf_counter()
+            with connection:
+                rebuild_rollups(connection)
+                for statement in TRIGGERS:
+                    connection.execute(statement)
+            print(f"rebuilt the rollups in {time.perf_counter() - start:.1f}s")
+
+            print(f"{'query':<26} {'scan ms':>10} {'rollup ms':>10}")
+            for name, (sql, params) in SCANS.items():
+                scan = timed(lambda: connection.execute(sql, params).fetchall(), args.repeat)
+                rollup = timed(lambda: ROLLUPS[name](connection), args.repeat * 10)
+                print(f"{name:<26} {scan:10.1f} {rollup:10.2f}")
+
+            # one purchase per commit, and carts of --cart orders per commit as
+            # the group commit writer does, with and without the triggers
+            for label in ('with triggers', 'without triggers'):
+                for cart in (1, args.cart):
+                    start = time.perf_counter()
+                    for index in range(0, args.purchases, cart):
+                        insert_orders(connection, [((index + offset) % args.books + 1, 1) for offset in range(cart)])
+                    print(f"{cart:>3} per commit {label:<17} {args.purchases / (time.perf_counter() - start):8.0f} orders/s")
+                drop_triggers(connection)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# What a cached topic list costs to send (common/serialization.py), in
+# process: json.dumps on every hit as jsonify did, the encoded bytes kept in
+# the cache, a 304 for a client that already has them, and the size and time
+# of the gzipped body, for lists of --sizes books.
+#
+#   python benchmarks/bench_serialization.py --sizes 10,100,1000,10000 --repeat 200
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common import serialization
+from common.serialization import Encoded, dumps, encoded_response
+
+TOPICS = ['Fiction', 'Programming', 'Art', 'History', 'Science', 'Poetry', 'Travel', 'Cooking']
+
+
+def books(count):
+    return [{"id": book_id, "title": f"Book {book_id}", "quantity": random.randint(0, 1000),
+             "price": round(random.uniform(5, 100), 2), "topic": random.choice(TOPICS)}
+            for book_id in range(1, count + 1)]
+
+
+def per_call_us(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10,100,1000,10000')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"encoder: {'orjson' if serialization.orjson else 'json'}")
+    print(f"{'books':>6} {'json us':>9} {'dumps us':>9} {'hit us':>8} {'304 us':>8} {'gzip first us':>14} "
+          f"{'gzip hit us':>12} {'bytes':>8} {'gzipped':>8}")
+    for size in (int(value) for value in args.sizes.split(',')):
+        value = books(size)
+        encoded = Encoded(dumps(value))
+        fresh = {}
+        conditional = {'If-None-Match': encoded.etag}
+        accepts_gzip = {'Accept-Encoding': 'gzip'}
+        json_us = per_call_us(lambda: json.dumps(value).encode(), args.repeat)
+        dumps_us = per_call_us(lambda: dumps(value), args.repeat)
+        hit_us = per_call_us(lambda: encoded_response(encoded, fresh), args.repeat)
+        not_modified_us = per_call_us(lambda: encoded_response(encoded, conditional), args.repeat)
+        start = time.perf_counter()
+        _, _, compressed = encoded_response(encoded, accepts_gzip, 1)
+        first_us = (time.perf_counter() - start) * 1e6
+        gzip_hit_us = per_call_us(lambda: encoded_response(encoded, accepts_gzip, 1), args.repeat)
+        print(f"{size:>6} {json_us:9.1f} {dumps_us:9.1f} {hit_us:8.1f} {not_modified_us:8.1f} {first_us:14.1f} "
+              f"{gzip_hit_us:12.1f} {len(encoded.body):>8} {len(compressed):>8}")
+
+
+if __name__ == '__main__':
+    main()
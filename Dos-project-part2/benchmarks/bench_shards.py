@@ -0,0 +1,97 @@
+# Purchase throughput against 1, 2, 4... shards of two catalog and two order
+# replicas each, in throwaway files: every buyer thread runs the front
+# server's sqlite write path (decrement on each catalog replica, order row on
+# each order replica) for a random book on the shard that owns it.
+#
+#   python benchmarks/bench_shards.py --shards 1,2,4 --buyers 16 --seconds 5
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common.db_pool import get_pool
+from common.rebalance import create_like, write
+from common.sharding import Shard, ShardMap
+from common.stock import decrement_stock, insert_order, PURCHASED
+
+CATALOG_DB = os.path.join(os.path.dirname(__file__), '../catalog/catalog-1/catalog1.db')
+ORDER_DB = os.path.join(os.path.dirname(__file__), '../order/order-1/order1.db')
+TOPICS = ['Fiction', 'Programming', 'Art', 'History', 'Science']
+
+
+def build(workdir, count, books):
+    shards = []
+    for index in range(count):
+        folder = os.path.join(workdir, f'{count}-{index}')
+        shard = Shard(f'shard-{index}', [os.path.join(folder, f'catalog{n}.db') for n in (1, 2)],
+                      [os.path.join(folder, f'order{n}.db') for n in (1, 2)])
+        for path in shard.catalog:
+            create_like(path, CATALOG_DB, 'books')
+        for path in shard.order:
+            create_like(path, ORDER_DB, 'orders')
+        shards.append(shard)
+    shard_map = ShardMap(shards)
+
+    owned = {}
+    for book_id in range(1, books + 1):
+        owned.setdefault(shard_map.shard_for(book_id).name, []).append(
+            (book_id, f"Book {book_id}", 10 ** 9, 10.0, random.choice(TOPICS)))
+    for shard in shards:
+        for path in shard.catalog:
+            write(path, [("INSERT INTO books (id, title, quantity, price, topic) VALUES (?, ?, ?, ?, ?)",
+                          owned.get(shard.name, []))])
+    return shard_map
+
+
+def run(shard_map, books, buyers, seconds):
+    sold = [0] * buyers
+    deadline = time.perf_counter() + seconds
+
+    def buyer(index):
+        while time.perf_counter() < deadline:
+            book_id = random.randint(1, books)
+            shard = shard_map.shard_for(book_id)
+            for path in shard.catalog:
+                with get_pool(path).connection() as connection:
+                    status, _ = decrement_stock(connection, book_id)
+            if status != PURCHASED:
+                continue
+            for path in shard.order:
+                with get_pool(path).connection() as connection:
+                    insert_order(connection, book_id)
+            sold[index] += 1
+
+    threads = [threading.Thread(target=buyer, args=(i,)) for i in range(buyers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(sold) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', default='1,2,4')
+    parser.add_argument('--books', type=int, default=1000)
+    parser.add_argument('--buyers', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        for count in [int(count) for count in args.shards.split(',')]:
+            shard_map = build(workdir, count, args.books)
+            rate = run(shard_map, args.books, args.buyers, args.seconds)
+            print(f"{count:>3} shard(s) {rate:9.0f} purchases/s")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Topic lookups on a generated catalog: the old LIKE '%topic%' scan against the
+# topic index (exact) and the FTS5 trigram table (substring).
+#
+#   python benchmarks/bench_topic_search.py --books 200000
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common.migrations import migrate
+from common.topic_search import search_books
+
+WORDS = ("distributed systems fiction history art programming python networks databases "
+         "graduate school cooking travel biology physics poetry music economics design "
+         "security cloud mobile gardening philosophy law medicine finance chemistry").split()
+
+
+def build_catalog(path, books, topics):
+    rng = random.Random(7)
+    topic_names = sorted({" ".join(rng.sample(WORDS, rng.randint(1, 3))) for _ in range(topics * 2)})[:topics]
+    connection = sqlite3.connect(path)
+    connection.execute("""CREATE TABLE books (
+        id INTEGER PRIMARY KEY, title TEXT NOT NULL, quantity INTEGER NOT NULL,
+        price REAL NOT NULL, topic TEXT NOT NULL)""")
+    connection.executemany("INSERT INTO books (title, quantity, price, topic) VALUES (?, ?, ?, ?)",
+                           ((f"Book {i}", rng.randint(0, 100), rng.randint(5, 200), rng.choice(topic_names))
+                            for i in range(books)))
+    connection.commit()
+    connection.close()
+    return topic_names
+
+
+def timed(label, queries, run):
+    start = time.perf_counter()
+    rows = sum(len(run(query)) for query in queries)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {elapsed / len(queries) * 1000:8.2f} ms/query   {rows / len(queries):9.1f} rows/query")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=200000)
+    parser.add_argument('--topics', type=int, default=2000)
+    parser.add_argument('--queries', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'catalog.db')
+        topic_names = build_catalog(path, args.books, args.topics)
+        start = time.perf_counter()
+        migrate(path, 'catalog')
+        print(f"{args.books} books, {len(topic_names)} topics, index + FTS build {time.perf_counter() - start:.2f} s")
+
+        rng = random.Random(11)
+        exact = rng.sample(topic_names, args.queries)
+        fragments = [rng.choice(WORDS)[:rng.randint(4, 7)] for _ in range(args.queries)]
+        connection = sqlite3.connect(path)
+
+        timed("exact, LIKE scan", exact,
+              lambda q: connection.execute("SELECT * FROM books WHERE topic LIKE ?", ('%' + q + '%',)).fetchall())
+        timed("exact, topic index", exact, lambda q: search_books(connection, q, 'exact'))
+        timed("substring, LIKE scan", fragments,
+              lambda q: connection.execute("SELECT * FROM books WHERE topic LIKE ?", ('%' + q + '%',)).fetchall())
+        timed("substring, FTS5 trigram", fragments, lambda q: search_books(connection, q))
+
+        rare = [name for name in topic_names if len(name) > 20][:args.queries]
+        timed("rare topic, LIKE scan", rare,
+              lambda q: connection.execute("SELECT * FROM books WHERE topic LIKE ?", ('%' + q + '%',)).fetchall())
+        timed("rare topic, FTS5 trigram", rare, lambda q: search_books(connection, q))
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,457 @@
+# Load generator for the whole deployment. Copies the tree to a temporary
+# directory, starts the two catalog services, the two order services and the
+# front server there, drives a mix of /product, /products and /purchase
+# requests through the front, and prints a JSON report: throughput, latency
+# percentiles per route, the front's cache hit ratio and stock-consistency
+# checks read from the database files afterwards.
+#
+# Closed loop (--concurrency clients sending back to back):
+#   python benchmarks/loadgen.py --concurrency 64 --duration 30 --mix product=80,products=15,purchase=5
+# Fixed rate (latency counted from when a request was due, not when it went out):
+#   python benchmarks/loadgen.py --rate 500 --duration 30 --env FRONT_BACKEND=http --output run.json
+# Against services that are already running (no consistency checks):
+#   python benchmarks/loadgen.py --no-start --concurrency 16
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# (name, working directory, port); the ports are the ones the apps bind
+SERVICES = [
+    ('catalog-1', 'catalog/catalog-1', 6001),
+    ('catalog-2', 'catalog/catalog-2', 6002),
+    ('order-1', 'order/order-1', 7002),
+    ('order-2', 'order/order-2', 7001),
+    ('front', 'front-and-server', 5000),
+]
+CATALOG_DBS = ['catalog/catalog-1/catalog1.db', 'catalog/catalog-2/catalog2.db']
+ORDER_DBS = ['order/order-1/order1.db', 'order/order-2/order2.db']
+# pooled connections idle longer than this are not reused; uvicorn closes them after 5s
+IDLE_SECONDS = 4
+ROUTES = ('product', 'products', 'purchase')
+PERCENTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('p999', 0.999))
+
+
+# ---- deployment ----
+
+def prepare_tree(stock):
+    workdir = tempfile.mkdtemp(prefix='bookstore-load-')
+    tree = os.path.join(workdir, 'tree')
+    shutil.copytree(ROOT, tree, ignore=shutil.ignore_patterns('__pycache__', '*.db-wal', '*.db-shm', 'benchmarks'))
+    if stock is not None:
+        for path in CATALOG_DBS:
+            connection = sqlite3.connect(os.path.join(tree, path))
+            connection.execute("UPDATE books SET quantity=?", (stock,))
+            connection.commit()
+            connection.close()
+    return workdir, tree
+
+
+def start_services(workdir, tree, env, front):
+    environment = dict(os.environ, **env)
+    processes = []
+    for name, directory, port in SERVICES:
+        command = [sys.executable, 'app.py']
+        if name == 'front' and front == 'asgi':
+            command = [sys.executable, 'asgi_app.py', '--port', str(port)]
+        log = open(os.path.join(workdir, f'{name}.log'), 'w')
+        # own process group: the Flask reloader forks a child that has to go too
+        processes.append(subprocess.Popen(command, cwd=os.path.join(tree, directory), env=environment,
+                                          stdout=log, stderr=subprocess.STDOUT, start_new_session=True))
+        log.close()
+    return processes
+
+
+def stop_services(processes):
+    for process in processes:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+async def wait_until_ready(host, ports, timeout=60):
+    deadline = time.time() + timeout
+    for port in ports:
+        while True:
+            try:
+                status, _, _ = await one_shot(host, port, 'GET', '/')
+                if status == 200:
+                    break
+            except OSError:
+                pass
+            if time.time() > deadline:
+                raise RuntimeError(f"service on port {port} did not come up")
+            await asyncio.sleep(0.2)
+
+
+# ---- HTTP ----
+
+async def exchange(connection, method, path, body=b''):
+    reader, writer = connection
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = {name.strip().lower(): value.strip()
+               for name, _, value in (line.partition(':') for line in lines[1:] if line)}
+    payload = await reader.readexactly(int(headers.get('content-length', 0)))
+    keep_alive = lines[0].startswith('HTTP/1.1') and headers.get('connection', '').lower() != 'close'
+    return status, payload, keep_alive
+
+
+async def one_shot(host, port, method, path):
+    connection = await asyncio.open_connection(host, port)
+    try:
+        status, payload, _ = await exchange(connection, method, path)
+        return status, payload, None
+    finally:
+        connection[1].close()
+
+
+class ClientPool:
+    # at most `size` connections to the front; idle ones are reused
+
+    def __init__(self, host, port, size):
+        self.host = host
+        self.port = port
+        self.slots = asyncio.Semaphore(size)
+        self.idle = []
+        self.opened = 0
+
+    async def request(self, method, path):
+        async with self.slots:
+            while self.idle and time.perf_counter() - self.idle[-1][1] > IDLE_SECONDS:
+                self.idle.pop()[0][1].close()
+            if self.idle:
+                connection = self.idle.pop()[0]
+            else:
+                connection = await asyncio.open_connection(self.host, self.port)
+                self.opened += 1
+            try:
+                status, payload, keep_alive = await exchange(connection, method, path)
+            except BaseException:
+                connection[1].close()
+                raise
+            if keep_alive:
+                self.idle.append((connection, time.perf_counter()))
+            else:
+                connection[1].close()
+            return status, payload
+
+    def close(self):
+        for (_, writer), _ in self.idle:
+            writer.close()
+
+
+async def get_json(host, port, path):
+    try:
+        status, payload, _ = await one_shot(host, port, 'GET', path)
+        return json.loads(payload) if status == 200 else None
+    except (OSError, ValueError):
+        return None
+
+
+async def stats_after(delay, host, port):
+    await asyncio.sleep(delay)
+    return await get_json(host, port, '/stats/cache')
+
+
+# ---- workload ----
+
+class Workload:
+
+    def __init__(self, mix, ids, topics, seed=None):
+        self.routes = list(mix)
+        self.weights = [mix[route] for route in self.routes]
+        self.ids = ids
+        self.topics = topics
+        self.random = random.Random(seed)
+
+    def next(self):
+        route = self.random.choices(self.routes, self.weights)[0]
+        if route == 'product':
+            return route, 'GET', f'/product/{self.random.choice(self.ids)}'
+        if route == 'products':
+            return route, 'GET', f'/products/{quote(self.random.choice(self.topics))}'
+        return route, 'PUT', f'/purchase/{self.random.choice(self.ids)}/'
+
+
+class Results:
+
+    def __init__(self, record_after):
+        self.record_after = record_after
+        self.latencies = {route: [] for route in ROUTES}
+        self.statuses = {route: {} for route in ROUTES}
+        self.errors = {route: 0 for route in ROUTES}
+        self.purchased = 0
+        self.first = None
+        self.last = None
+
+    def add(self, route, started, latency, status=None):
+        # warm-up purchases still change stock, so they are always counted
+        if route == 'purchase' and status == 200:
+            self.purchased += 1
+        if started < self.record_after:
+            return
+        self.first = started if self.first is None else min(self.first, started)
+        self.last = max(self.last or 0, started + latency)
+        self.latencies[route].append(latency)
+        if status is None or status >= 500:
+            self.errors[route] += 1
+        if status is not None:
+            self.statuses[route][str(status)] = self.statuses[route].get(str(status), 0) + 1
+
+
+async def timed(pool, results, route, method, path, due):
+    try:
+        status, _ = await pool.request(method, path)
+    except (OSError, asyncio.IncompleteReadError, ValueError):
+        status = None
+    results.add(route, due, time.perf_counter() - due, status)
+
+
+async def closed_loop(pool, workload, results, concurrency, end):
+    async def client():
+        while time.perf_counter() < end:
+            route, method, path = workload.next()
+            await timed(pool, results, route, method, path, time.perf_counter())
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+
+
+async def fixed_rate(pool, workload, results, rate, end):
+    # requests are due every 1/rate seconds whether or not earlier ones have
+    # returned, so a stall shows up as latency instead of fewer requests
+    tasks = set()
+    start = time.perf_counter()
+    sent = 0
+    while True:
+        due = start + sent / rate
+        if due >= end:
+            break
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        route, method, path = workload.next()
+        task = asyncio.ensure_future(timed(pool, results, route, method, path, due))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        sent += 1
+    if tasks:
+        await asyncio.wait(tasks, timeout=30)
+
+
+def summarize(latencies, errors, statuses):
+    ordered = sorted(latencies)
+    summary = {"requests": len(ordered), "errors": errors, "statuses": statuses}
+    if ordered:
+        for name, fraction in PERCENTILES:
+            summary[f"{name}_ms"] = round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 3)
+        summary["mean_ms"] = round(sum(ordered) / len(ordered) * 1000, 3)
+        summary["max_ms"] = round(ordered[-1] * 1000, 3)
+    return summary
+
+
+def merge_counts(counts):
+    merged = {}
+    for count in counts:
+        for key, value in count.items():
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def cache_report(before, after):
+    if not before or not after:
+        return None
+    hits = after.get('hits', 0) - before.get('hits', 0)
+    misses = after.get('misses', 0) - before.get('misses', 0)
+    return {"hits": hits, "misses": misses, "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None,
+            "coalesced_waiters": after.get('coalesced_waiters', 0) - before.get('coalesced_waiters', 0),
+            "stale_hits": after.get('stale_hits', 0) - before.get('stale_hits', 0)}
+
+
+# ---- consistency ----
+
+def read_stock(tree):
+    stock = []
+    for path in CATALOG_DBS:
+        connection = sqlite3.connect(os.path.join(tree, path), timeout=30)
+        stock.append(dict(connection.execute("SELECT id, quantity FROM books").fetchall()))
+        connection.close()
+    return stock
+
+
+def read_orders(tree, after_ids=None):
+    orders = []
+    for index, path in enumerate(ORDER_DBS):
+        connection = sqlite3.connect(os.path.join(tree, path), timeout=30)
+        last = connection.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+        since = after_ids[index] if after_ids else last
+        ordered = dict(connection.execute(
+            "SELECT book_id, SUM(quantity) FROM orders WHERE id > ? GROUP BY book_id", (since,)).fetchall())
+        orders.append({"last_id": last, "ordered": ordered})
+        connection.close()
+    return orders
+
+
+def consistency_report(tree, stock_before, orders_before, purchased, settle):
+    # backups in primary_backup mode trail the primary; give them `settle` seconds
+    deadline = time.time() + settle
+    while True:
+        stock_after = read_stock(tree)
+        orders_after = read_orders(tree, [orders["last_id"] for orders in orders_before])
+        settled = (all(stock == stock_after[0] for stock in stock_after)
+                   and all(orders["ordered"] == orders_after[0]["ordered"] for orders in orders_after))
+        if settled or time.time() > deadline:
+            break
+        time.sleep(0.2)
+
+    sold = {book_id: stock_before[0][book_id] - quantity for book_id, quantity in stock_after[0].items()
+            if book_id in stock_before[0]}
+    ordered = orders_after[0]["ordered"]
+    mismatched = sorted(book_id for book_id in set(sold) | set(ordered)
+                        if sold.get(book_id, 0) != ordered.get(book_id, 0))
+    checks = {
+        "catalog_replicas_agree": all(stock == stock_after[0] for stock in stock_after),
+        "order_replicas_agree": all(orders["ordered"] == ordered for orders in orders_after),
+        "stock_sold_matches_orders": not mismatched,
+        "orders_match_successful_purchases": sum(ordered.values()) == purchased,
+        "no_negative_stock": all(quantity >= 0 for stock in stock_after for quantity in stock.values()),
+    }
+    return {"ok": all(checks.values()), "checks": checks, "books_mismatched": mismatched,
+            "sold": sum(sold.values()), "ordered": sum(ordered.values()), "successful_purchases": purchased}
+
+
+# ---- main ----
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        route, _, weight = part.partition('=')
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError(f"unknown route {route!r}, expected one of {', '.join(ROUTES)}")
+        mix[route] = float(weight or 1)
+    return mix
+
+
+def parse_env(values):
+    env = {}
+    for value in values:
+        name, _, setting = value.partition('=')
+        env[name] = setting
+    return env
+
+
+async def run(args, tree):
+    host, port = args.host, args.port
+    if tree:
+        await wait_until_ready(host, [service_port for _, _, service_port in SERVICES])
+    stock_before = read_stock(tree) if tree else None
+    orders_before = read_orders(tree) if tree else None
+
+    workload = Workload(args.mix, args.ids, args.topics, args.seed)
+    pool = ClientPool(host, port, args.connections or args.concurrency or 256)
+    start = time.perf_counter()
+    results = Results(start + args.warmup)
+    end = start + args.warmup + args.duration
+    # hit ratio over the measured part only
+    cache_before = asyncio.ensure_future(stats_after(args.warmup, host, port))
+    if args.rate:
+        await fixed_rate(pool, workload, results, args.rate, end)
+    else:
+        await closed_loop(pool, workload, results, args.concurrency, end)
+    pool.close()
+    cache_before = await cache_before
+    cache_after = await get_json(host, port, '/stats/cache')
+
+    elapsed = (results.last - results.first) if results.first is not None else 0
+    total = sum(len(latencies) for latencies in results.latencies.values())
+    report = {
+        "config": {"mode": "fixed_rate" if args.rate else "closed_loop", "rate": args.rate,
+                   "concurrency": args.concurrency, "duration_s": args.duration, "warmup_s": args.warmup,
+                   "mix": args.mix, "ids": args.ids, "topics": args.topics, "env": parse_env(args.env),
+                   "front": args.front, "connections_opened": pool.opened},
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0,
+        "overall": summarize([latency for latencies in results.latencies.values() for latency in latencies],
+                             sum(results.errors.values()), merge_counts(results.statuses.values())),
+        "routes": {route: summarize(results.latencies[route], results.errors[route], results.statuses[route])
+                   for route in ROUTES if route in args.mix},
+        "cache": cache_report(cache_before, cache_after),
+        "consistency": consistency_report(tree, stock_before, orders_before, results.purchased, args.settle)
+        if tree else None,
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('product=80,products=15,purchase=5'),
+                        help="route weights, e.g. product=80,products=15,purchase=5")
+    parser.add_argument('--concurrency', type=int, default=32, help="closed-loop clients")
+    parser.add_argument('--rate', type=float, help="fixed request rate per second instead of a closed loop")
+    parser.add_argument('--connections', type=int, help="connection cap (default: --concurrency, or 256 with --rate)")
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--ids', type=lambda text: [int(value) for value in text.split(',')], default=[1, 2, 3])
+    parser.add_argument('--topics', type=lambda text: text.split(','), default=['fiction', 'programming', 'art', 'all'])
+    parser.add_argument('--stock', type=int, default=1000000, help="set every book to this quantity first")
+    parser.add_argument('--env', action='append', default=[], help="NAME=VALUE for every service, repeatable")
+    parser.add_argument('--front', choices=('flask', 'asgi'), default='flask')
+    parser.add_argument('--settle', type=float, default=10, help="seconds to wait for backups before checking")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--no-start', action='store_true', help="drive services that are already running")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary tree and the service logs")
+    parser.add_argument('--output', help="write the report here as well as to stdout")
+    args = parser.parse_args()
+    if args.rate:
+        args.concurrency = None
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = (args.connections or args.concurrency or 256) * 2 + 256
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, wanted)), hard))
+
+    workdir = tree = None
+    processes = []
+    try:
+        if not args.no_start:
+            workdir, tree = prepare_tree(args.stock)
+            processes = start_services(workdir, tree, parse_env(args.env), args.front)
+        report = asyncio.run(run(args, tree))
+    finally:
+        stop_services(processes)
+        if workdir and not args.keep:
+            shutil.rmtree(workdir)
+        elif workdir:
+            print(f"tree and logs kept in {workdir}", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    if report["consistency"] and not report["consistency"]["ok"]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,155 @@
-from flask import Flask, jsonify, request
-import sqlite3
-import threading
+from flask import Flask, g, jsonify, request
 import os
+import sys
+from werkzeug.serving import WSGIRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../..'))
+from common.anti_entropy import AntiEntropy
+from common.catalog_snapshot import CatalogSnapshot, join
+from common.db_pool import configure_pools, get_pool, pool_stats, PoolTimeout
+from common.hot_stock import HotStock
+from common.invalidation import InvalidationNotifier
+from common.metrics import instrument, span, target_name
+from common.migrations import migrate
+from common.paging import paginate, page_response, parse_page
+from common.replication import ReplicationLog
+from common.serialization import Encoded, dumps, flask_response
+from common.stock import parse_cart, OUT_OF_STOCK, NOT_FOUND
+from common.topic_search import iter_books, search_books, MATCH_MODES
 
 app = Flask(__name__)
+# /metrics, /stats/traces and X-Trace-Id handling
+instrument(app, 'catalog-2')
+
+# another shard's replicas when this service runs for it (common/sharding.py)
+pathDB_1 = os.environ.get('CATALOG_DB_2', os.path.join(os.path.dirname(__file__), 'catalog2.db'))
+pathDB_2 = os.environ.get('CATALOG_DB_1', os.path.join(os.path.dirname(__file__), '../catalog-1/catalog1.db'))
+pathOrderDB = os.environ.get('ORDER_DB_1', os.path.join(os.path.dirname(__file__), '../../order/order-1/order1.db'))
+
+# how long a request waits for a pooled connection before its 503; under
+# the front's BACKEND_TIMEOUT so the front sees the 503 and not a timeout
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 1.0))
+configure_pools(checkout_timeout=app.config['DB_POOL_TIMEOUT'])
+
+# WAL, indexes and topic search; a no-op once the files are up to date
+for path in (pathDB_1, pathDB_2):
+    migrate(path, 'catalog')
+
+# 'snapshot' answers reads from an in-memory copy of books kept current from
+# book_changes, 'sqlite' queries the file on every request
+app.config['CATALOG_READS'] = os.environ.get('CATALOG_READS', 'snapshot')
+snapshot = CatalogSnapshot(pathDB_2) if app.config['CATALOG_READS'] == 'snapshot' else None
+# item and topic responses carry ETag and Last-Modified and answer
+# conditional GETs with 304; clients that accept gzip get bodies of at least
+# this many bytes compressed (0 never compresses)
+app.config['GZIP_MIN_BYTES'] = int(os.environ.get('GZIP_MIN_BYTES', 16384))
 
-thread_data = threading.local()
+# catalog1.db is the primary in 'primary_backup' mode, whichever service writes
+app.config['REPLICATION_MODE'] = os.environ.get('REPLICATION_MODE', 'sync')
+catalog_log = None
+if app.config['REPLICATION_MODE'] == 'primary_backup':
+    catalog_log = ReplicationLog(pathDB_2, [pathDB_1]).start()
 
-pathDB_1 = os.path.join(os.path.dirname(__file__), 'catalog2.db')
-pathDB_2 = os.path.join(os.path.dirname(__file__), '../catalog-1/catalog1.db')
+# flash-sale books whose stock is counted in memory and flushed in batches
+# (common/hot_stock.py); only the HOT_STOCK_OWNER service keeps the counters
+app.config['HOT_BOOKS'] = [int(book_id) for book_id in os.environ.get('HOT_BOOKS', '').split(',') if book_id.strip()]
+app.config['HOT_STOCK_OWNER'] = os.environ.get('HOT_STOCK_OWNER', 'catalog-1')
+app.config['HOT_FLUSH_MS'] = float(os.environ.get('HOT_FLUSH_MS', 50))
+hot_stock = None
+if (app.config['HOT_BOOKS'] and app.config['HOT_STOCK_OWNER'] == 'catalog-2'
+        and (__name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true')):
+    # not in the debug reloader's watcher process: the counters must have one owner
+    hot_stock = HotStock([pathDB_2, pathDB_1], pathOrderDB, app.config['HOT_BOOKS'],
+                         app.config['HOT_FLUSH_MS'] / 1000, log=catalog_log).start()
+
+# checks every ANTI_ENTROPY_INTERVAL seconds that the catalog replicas hold the
+# same rows and makes its own file win where they do not (common/anti_entropy.py);
+# only the ANTI_ENTROPY_OWNER service runs it, 0 turns it off
+app.config['ANTI_ENTROPY_INTERVAL'] = float(os.environ.get('ANTI_ENTROPY_INTERVAL', 30))
+app.config['ANTI_ENTROPY_REPAIR'] = os.environ.get('ANTI_ENTROPY_REPAIR', 'true') == 'true'
+app.config['ANTI_ENTROPY_OWNER'] = os.environ.get('ANTI_ENTROPY_OWNER', 'catalog-1')
+# front servers whose caches are told about every modified book
+invalidations = InvalidationNotifier(os.environ.get('FRONT_SERVERS', 'http://127.0.0.1:5000').split(','),
+                                     log=catalog_log, token=os.environ.get('INVALIDATION_TOKEN'))
+
+def books_repaired(label, changes):
+    # a front may have cached the row anti-entropy just overwrote
+    for wanted, seen in changes:
+        if wanted is None:
+            invalidations.book_removed(seen[0])
+        else:
+            invalidations.book_changed({'id': wanted[0]})
+
+anti_entropy = None
+if (app.config['ANTI_ENTROPY_OWNER'] == 'catalog-2'
+        and (__name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true')):
+    anti_entropy = AntiEntropy([('catalog', 'catalog', pathDB_2, [pathDB_1])], app.config['ANTI_ENTROPY_INTERVAL'],
+                               app.config['ANTI_ENTROPY_REPAIR'], on_repair=books_repaired).start()
 
 def catalog1_db_connection():
-    if not hasattr(thread_data, 'catalog1_connection'):
-        thread_data.catalog1_connection = sqlite3.connect(pathDB_1)
-        thread_data.catalog1_connection.row_factory = sqlite3.Row  
-    return thread_data.catalog1_connection
+    # borrowed from the pool for the rest of the request, handed back on teardown
+    if 'catalog1_connection' not in g:
+        g.catalog1_connection = get_pool(pathDB_1).checkout()
+    return g.catalog1_connection
 
 def catalog2_db_connection():
-    if not hasattr(thread_data, 'catalog2_connection'):
-        thread_data.catalog2_connection = sqlite3.connect(pathDB_2)
-        thread_data.catalog2_connection.row_factory = sqlite3.Row  
-    return thread_data.catalog2_connection
+    if 'catalog2_connection' not in g:
+        g.catalog2_connection = get_pool(pathDB_2).checkout()
+    return g.catalog2_connection
+
+def db_connection(path):
+    return catalog1_db_connection() if path == pathDB_1 else catalog2_db_connection()
+
+def read_path():
+    # the file reads are served from: pathDB_2, or the primary while pathDB_2
+    # is a backup that has not applied the write behind the caller's
+    # X-Min-Seq yet (read-your-writes, forwarded by the front)
+    value = request.headers.get('X-Min-Seq') or '0'
+    min_seq = int(value) if value.isdigit() else 0
+    if catalog_log and min_seq and not catalog_log.is_caught_up(pathDB_2, min_seq, catalog2_db_connection()):
+        return catalog_log.primary
+    return pathDB_2
 
 @app.teardown_appcontext
 def release_db_connection(exception):
-    if hasattr(thread_data, 'catalog2_connection'):
-        thread_data.catalog2_connection.close()
-    if hasattr(thread_data, 'catalog1_connection'):
-        thread_data.catalog1_connection.close() 
-          
+    if 'catalog2_connection' in g:
+        get_pool(pathDB_2).checkin(g.pop('catalog2_connection'))
+    if 'catalog1_connection' in g:
+        get_pool(pathDB_1).checkin(g.pop('catalog1_connection'))
+
+@app.errorhandler(PoolTimeout)
+def pool_exhausted(error):
+    return jsonify({"message": f"Server busy: {error}"}), 503, [('Retry-After', str(error.retry_after))]
+
+@app.route('/stats/pools', methods=['GET'])
+def connection_pool_stats():
+    return jsonify(pool_stats()), 200
+
+@app.route('/stats/snapshot', methods=['GET'])
+def snapshot_stats():
+    if not snapshot:
+        return jsonify({"error": "Snapshot reads are disabled"}), 404
+    return jsonify(snapshot.stats()), 200
+
+@app.route('/stats/anti-entropy', methods=['GET'])
+def anti_entropy_stats():
+    if not anti_entropy:
+        return jsonify({"error": "This service does not run the anti-entropy job"}), 404
+    return jsonify(anti_entropy.stats()), 200
+
+@app.route('/anti-entropy/run', methods=['POST'])
+def run_anti_entropy():
+    # one pass now; ?repair=false only reports
+    if not anti_entropy:
+        return jsonify({"error": "This service does not run the anti-entropy job"}), 409
+    return jsonify(anti_entropy.run_once(request.args.get('repair', 'true') == 'true')), 200
+
+@app.route('/stats/hot', methods=['GET'])
+def hot_stock_stats():
+    if not hot_stock:
+        return jsonify({"error": "This service does not keep hot stock"}), 404
+    return jsonify(hot_stock.stats()), 200
+
 @app.route('/', methods=['GET'])
 def catalog2():  
     return """  
@@ -47,31 +168,137 @@ def get_book_by_id(id):
     if not id.isdigit():
         return jsonify({"error": "Book ID must be numeric"}), 400
 
-    database = catalog2_db_connection()
-    cursor = database.cursor()
-    cursor.execute("SELECT * FROM books WHERE id=?", (id,))
-    book = cursor.fetchone()
-    cursor.close()
+    path = read_path()
+    if snapshot and path == snapshot.path:
+        with span('snapshot_read', target_name(path)):
+            encoded = snapshot.refresh().item_encoded(int(id))
+        if encoded:
+            return flask_response(encoded, app.config['GZIP_MIN_BYTES'])
+        return jsonify({"error": "Book not found"}), 404
+
+    database = db_connection(path)
+    with span('catalog_read', target_name(path)):
+        cursor = database.cursor()
+        cursor.execute("SELECT * FROM books WHERE id=?", (id,))
+        book = cursor.fetchone()
+        cursor.close()
 
     if book:
-        return jsonify(dict(book)), 200
+        return flask_response(Encoded(dumps(dict(book))), app.config['GZIP_MIN_BYTES'])
     else:
         return jsonify({"error": "Book not found"}), 404
 
+# ids one /retrieve/items call may ask for
+MAX_ITEMS = 500
+
+@app.route('/retrieve/items', methods=['GET'])
+def get_books_by_ids():
+    # ?ids=1,2,3: the ones that exist, in id order; the front revalidates its cache with it
+    ids = [value for value in request.args.get('ids', '').split(',') if value]
+    if not ids or not all(value.isdigit() for value in ids):
+        return jsonify({"error": "ids must be a comma-separated list of numeric book IDs"}), 400
+    if len(ids) > MAX_ITEMS:
+        return jsonify({"error": f"At most {MAX_ITEMS} ids per request"}), 400
+    ids = sorted({int(value) for value in ids})
+
+    path = read_path()
+    if snapshot and path == snapshot.path:
+        with span('snapshot_read', target_name(path)):
+            current = snapshot.refresh()
+            items = [current.item(book_id) for book_id in ids]
+        return flask_response(Encoded(join([item for item in items if item])), app.config['GZIP_MIN_BYTES'])
+
+    database = db_connection(path)
+    with span('catalog_read', target_name(path)):
+        books = database.execute(f"SELECT * FROM books WHERE id IN ({','.join('?' * len(ids))}) ORDER BY id", ids).fetchall()
+    return flask_response(Encoded(dumps([dict(book) for book in books])), app.config['GZIP_MIN_BYTES'])
+
 #! work: done
 @app.route('/retrieve/topic/<topic>', methods=['GET'])
 def get_books_by_topic(topic):
-    database = catalog2_db_connection()
-    cursor = database.cursor()
-    cursor.execute("SELECT * FROM books WHERE topic=?", (topic,))
-    books = cursor.fetchall()
-    cursor.close()
+    match = request.args.get('match', 'substring')
+    if match not in MATCH_MODES:
+        return jsonify({"error": f"match must be one of {', '.join(MATCH_MODES)}"}), 400
+    try:
+        page = parse_page(request.args, request.headers)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+
+    path = read_path()
+    if page:
+        # keyset page or streamed listing, written as the rows are read
+        if snapshot and path == snapshot.path:
+            with span('snapshot_read', target_name(path)):
+                rows = snapshot.refresh().topic_rows(topic, match, page.after)
+        else:
+            with span('catalog_read', target_name(path)):
+                cursor = iter_books(db_connection(path), topic, match, page.after,
+                                    page.limit + 1 if page.limit else -1)
+            rows = ((book['id'], dict(book)) for book in cursor)
+        rows, found, next_after = paginate(rows, page)
+        if not found and not page.after:
+            return jsonify({"error": "No books found for this topic"}), 404
+        return page_response(page, rows, next_after)
+
+    if snapshot and path == snapshot.path:
+        with span('snapshot_read', target_name(path)):
+            encoded = snapshot.refresh().topic_encoded(topic, match)
+        if encoded:
+            return flask_response(encoded, app.config['GZIP_MIN_BYTES'])
+        return jsonify({"error": "No books found for this topic"}), 404
+
+    database = db_connection(path)
+    with span('catalog_read', target_name(path)):
+        books = search_books(database, topic, match)
 
     if books:
-        return jsonify([dict(book) for book in books]), 200
+        return flask_response(Encoded(dumps([dict(book) for book in books])), app.config['GZIP_MIN_BYTES'])
     else:
         return jsonify({"error": "No books found for this topic"}), 404
 
+def reservation_fields(data):
+    # the optional reservation id and list of confirmed ids of /reserve and /release
+    reservation = data.get('reservation')
+    confirmed = data.get('confirmed') or []
+    if not isinstance(confirmed, list) or not all(isinstance(item, str) for item in confirmed + [reservation or '']):
+        raise ValueError("Reservation ids must be strings")
+    return reservation, confirmed
+
+@app.route('/reserve', methods=['POST'])
+def reserve_hot_books():
+    # confirms a purchase of hot books from the counters; the caller writes the orders
+    if not hot_stock:
+        return jsonify({"error": "This service does not keep hot stock"}), 409
+    data = request.get_json(silent=True)
+    try:
+        cart = parse_cart(data)
+        reservation, confirmed = reservation_fields(data)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 422
+    # the caller's earlier reservations whose orders are now written
+    hot_stock.confirm(confirmed)
+    with span('hot_reserve'):
+        status, failed_id, books = hot_stock.reserve(cart, reservation)
+    if status == OUT_OF_STOCK:
+        return jsonify({"error": "Book out of stock", "book_id": failed_id}), 400
+    if status == NOT_FOUND:
+        return jsonify({"error": "Book is not a hot item", "book_id": failed_id}), 404
+    return jsonify({"items": books}), 200
+
+@app.route('/release', methods=['POST'])
+def release_hot_books():
+    # a reserved purchase whose order could not be written
+    if not hot_stock:
+        return jsonify({"error": "This service does not keep hot stock"}), 409
+    data = request.get_json(silent=True)
+    try:
+        cart = parse_cart(data)
+        reservation, _ = reservation_fields(data)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 422
+    hot_stock.release(cart, reservation)
+    return jsonify({"message": "Released"}), 200
+
 #! work: done
 @app.route('/modify/<int:id>', methods=['PUT'])
 def modify_book(id):
@@ -83,6 +310,30 @@ def modify_book(id):
     
     if updated_price is None and updated_quantity is None:
         return jsonify({"error": "No update data provided"}), 400
+    if hot_stock is None and id in app.config['HOT_BOOKS']:
+        # the HOT_STOCK_OWNER service counts its stock and would overwrite
+        # the change with its next flush
+        return jsonify({"error": f"Book {id} is a hot item; modify it on {app.config['HOT_STOCK_OWNER']}"}), 409
+
+    if catalog_log:
+        database = catalog2_db_connection()
+        with database, span('catalog_update', target_name(catalog_log.primary)):
+            if updated_price is not None:
+                database.execute("UPDATE books SET price=? WHERE id=?", (updated_price, id))
+            if updated_quantity is not None:
+                database.execute("UPDATE books SET quantity=? WHERE id=?", (updated_quantity, id))
+            book = database.execute("SELECT * FROM books WHERE id=?", (id,)).fetchone()
+            if book:
+                catalog_log.append(database, "UPDATE books SET price=?, quantity=? WHERE id=?",
+                                   (book['price'], book['quantity'], id))
+        if not book:
+            return jsonify({"error": "Book not found"}), 404
+        if hot_stock and hot_stock.is_hot(id):
+            book = hot_stock.update_book(dict(book), updated_quantity is not None)
+        invalidations.book_changed(book)
+        response = jsonify(dict(book))
+        response.headers['X-Catalog-Seq'] = str(catalog_log.last_seq())
+        return response, 200
 
     database1 = catalog1_db_connection()
     database2 = catalog2_db_connection()
@@ -90,20 +341,21 @@ def modify_book(id):
     cursor1 = database1.cursor()
     cursor2 = database2.cursor()
 
-    if updated_price is not None:
-        cursor1.execute("UPDATE books SET price=? WHERE id=?", (updated_price, id))
-    if updated_quantity is not None:
-        cursor1.execute("UPDATE books SET quantity=? WHERE id=?", (updated_quantity, id))
+    with span('catalog_update', target_name(pathDB_1)):
+        if updated_price is not None:
+            cursor1.execute("UPDATE books SET price=? WHERE id=?", (updated_price, id))
+        if updated_quantity is not None:
+            cursor1.execute("UPDATE books SET quantity=? WHERE id=?", (updated_quantity, id))
+        database1.commit()
+        cursor1.close()
 
-    if updated_price is not None:
-        cursor2.execute("UPDATE books SET price=? WHERE id=?", (updated_price, id))
-    if updated_quantity is not None:
-        cursor2.execute("UPDATE books SET quantity=? WHERE id=?", (updated_quantity, id))
-
-    database1.commit()
-    cursor1.close()
-    database2.commit()
-    cursor2.close()
+    with span('catalog_update', target_name(pathDB_2)):
+        if updated_price is not None:
+            cursor2.execute("UPDATE books SET price=? WHERE id=?", (updated_price, id))
+        if updated_quantity is not None:
+            cursor2.execute("UPDATE books SET quantity=? WHERE id=?", (updated_quantity, id))
+        database2.commit()
+        cursor2.close()
    
     cursor2 = database2.cursor()
     cursor2.execute("SELECT * FROM books WHERE id=?", (id,))
@@ -111,9 +363,16 @@ def modify_book(id):
     cursor2.close()
 
     if book:
+        if hot_stock and hot_stock.is_hot(id):
+            book = hot_stock.update_book(dict(book), updated_quantity is not None)
+        invalidations.book_changed(book)
         return jsonify(dict(book)), 200
     else:
         return jsonify({"error": "Book not found"}), 404
 
 if __name__ == '__main__':
-    app.run(debug=True, port=6002)
\ No newline at end of file
+    # HTTP/1.1 lets the front server keep its pooled connections open; without
+    # TCP_NODELAY the split header/body writes stall on delayed ACKs
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    WSGIRequestHandler.disable_nagle_algorithm = True
+    app.run(debug=True, port=int(os.environ.get('PORT', 6002)))
\ No newline at end of file
@@ -0,0 +1,369 @@
+# Finds and repairs drift between replicas of the same table, e.g. a catalog
+# replica that was decremented while its twin was not because the request
+# gave up between the two writes.
+#
+# Each file keeps a Merkle-style tree of checksums over its rows in
+# anti_entropy_tree. The leaves are blocks of rows: 64 consecutive book ids,
+# or the orders of one hour of order_date (order ids are assigned by each
+# replica separately, so they do not line up between replicas; dates do).
+# Triggers only mark the leaves a write touched in anti_entropy_dirty; before
+# comparing, refresh() re-hashes the dirty leaves and moves their parents by
+# the difference (a node's checksum is the sum of its children's), so keeping
+# the tree costs one small insert per write and work proportional to what
+# changed since the last pass. compare() walks both trees from the top and
+# only descends into nodes whose checksums differ, so a pass over two
+# identical files reads a handful of nodes whatever their size.
+#
+# The first file of a pair is taken as right. A block is repaired only when
+# two passes in a row found the same difference, so writes that were still
+# on their way to the second replica are left alone, and book rows are only
+# overwritten if they still hold what the pass saw.
+#
+#   python common/anti_entropy.py --catalog catalog/catalog-1/catalog1.db catalog/catalog-2/catalog2.db --repair
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import closing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common.db_pool import open_connection
+
+MOD = 2 ** 61 - 1
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS anti_entropy_tree (
+        name TEXT NOT NULL,
+        level INTEGER NOT NULL,
+        node NOT NULL,
+        checksum INTEGER NOT NULL,
+        rows INTEGER NOT NULL,
+        PRIMARY KEY (name, level, node)
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS anti_entropy_dirty (
+        name TEXT NOT NULL,
+        node NOT NULL,
+        PRIMARY KEY (name, node)
+    ) WITHOUT ROWID""",
+]
+
+
+def _checksum(images):
+    # order-independent within a block: the encoded images are sorted first
+    encoded = sorted(json.dumps(image, default=str) for image in images)
+    digest = hashlib.md5('\n'.join(encoded).encode()).digest()
+    return int.from_bytes(digest[:7], 'big')
+
+
+class BookBlocks:
+    # leaves of 64 ids; each level up covers 16 nodes of the one below
+    name = 'books'
+    levels = 7
+    leaf = "{row}.id >> 6"
+
+    def parent(self, level, node):
+        return node >> 4
+
+    def children(self, level, node):
+        return "node BETWEEN ? AND ?", (node << 4, (node << 4) + 15)
+
+    def rows(self, connection, leaf):
+        return [tuple(row) for row in connection.execute(
+            "SELECT id, title, quantity, price, topic FROM books WHERE id BETWEEN ? AND ? ORDER BY id",
+            (leaf << 6, (leaf << 6) + 63))]
+
+    def image(self, row):
+        return row
+
+    def diff(self, source_rows, target_rows):
+        # (rows to write to the target, target rows expected before each write)
+        source = {row[0]: row for row in source_rows}
+        target = {row[0]: row for row in target_rows}
+        return [(source.get(book_id), target.get(book_id)) for book_id in sorted(set(source) | set(target))
+                if source.get(book_id) != target.get(book_id)]
+
+    def repair(self, connection, changes):
+        repaired = 0
+        for wanted, seen in changes:
+            if seen is None:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO books (id, title, quantity, price, topic) VALUES (?, ?, ?, ?, ?)", wanted)
+            elif wanted is None:
+                cursor = connection.execute(
+                    "DELETE FROM books WHERE id = ? AND title IS ? AND quantity IS ? AND price IS ? AND topic IS ?", seen)
+            else:
+                cursor = connection.execute(
+                    "UPDATE books SET title = ?, quantity = ?, price = ?, topic = ? "
+                    "WHERE id = ? AND title IS ? AND quantity IS ? AND price IS ? AND topic IS ?",
+                    wanted[1:] + seen)
+            repaired += cursor.rowcount
+        return repaired
+
+
+class OrderBlocks:
+    # leaves are hours of order_date; then days, months, years and the root
+    name = 'orders'
+    widths = (13, 10, 7, 4, 0)
+    levels = len(widths)
+    leaf = "substr({row}.order_date, 1, 13)"
+
+    def parent(self, level, node):
+        return node[:self.widths[level + 1]]
+
+    def children(self, level, node):
+        # '~' sorts after every character of a date
+        return "node >= ? AND node < ?", (node, node + '~')
+
+    def rows(self, connection, leaf):
+        return [tuple(row) for row in connection.execute(
+            "SELECT id, book_id, order_date, quantity FROM orders "
+            "WHERE order_date >= ? AND order_date < ? AND substr(order_date, 1, 13) = ?", (leaf, leaf + '~', leaf))]
+
+    def image(self, row):
+        return row[1:]
+
+    def diff(self, source_rows, target_rows):
+        # (row to add, None) for orders the target lacks, (None, image) for extra ones
+        source = Counter(self.image(row) for row in source_rows)
+        target = Counter(self.image(row) for row in target_rows)
+        ids = {self.image(row): row[0] for row in source_rows}
+        changes = []
+        for image, count in (source - target).items():
+            changes += [((ids[image],) + image, None)] * count
+        for image, count in (target - source).items():
+            changes += [(None, image)] * count
+        return changes
+
+    def repair(self, connection, changes):
+        repaired = 0
+        for wanted, seen in changes:
+            if seen is None:
+                # the source's id when it is free, so primary/backup ids keep
+                # lining up; ids are assigned per replica, so it may hold another order
+                if connection.execute("SELECT 1 FROM orders WHERE id = ?", wanted[:1]).fetchone():
+                    cursor = connection.execute(
+                        "INSERT INTO orders (book_id, order_date, quantity) VALUES (?, ?, ?)", wanted[1:])
+                else:
+                    cursor = connection.execute(
+                        "INSERT INTO orders (id, book_id, order_date, quantity) VALUES (?, ?, ?, ?)", wanted)
+            else:
+                cursor = connection.execute(
+                    "DELETE FROM orders WHERE id = (SELECT MAX(id) FROM orders "
+                    "WHERE book_id IS ? AND order_date = ? AND quantity = ?)", seen)
+            repaired += cursor.rowcount
+        return repaired
+
+
+LAYOUTS = {'catalog': BookBlocks(), 'order': OrderBlocks()}
+
+
+def create_catalog_anti_entropy(connection):
+    create_anti_entropy(connection, LAYOUTS['catalog'])
+
+
+def create_order_anti_entropy(connection):
+    create_anti_entropy(connection, LAYOUTS['order'])
+
+
+def create_anti_entropy(connection, layout):
+    # schema migration; runs inside the migrator's transaction. Every leaf
+    # starts dirty, so the first refresh() builds the tree.
+    for statement in SCHEMA:
+        connection.execute(statement)
+    table = layout.name
+    mark = "INSERT OR IGNORE INTO anti_entropy_dirty (name, node) VALUES ('{table}', {node});"
+    connection.execute(f"""CREATE TRIGGER IF NOT EXISTS anti_entropy_{table}_insert AFTER INSERT ON {table} BEGIN
+        {mark.format(table=table, node=layout.leaf.format(row='new'))}
+    END""")
+    connection.execute(f"""CREATE TRIGGER IF NOT EXISTS anti_entropy_{table}_update AFTER UPDATE ON {table} BEGIN
+        {mark.format(table=table, node=layout.leaf.format(row='old'))}
+        {mark.format(table=table, node=layout.leaf.format(row='new'))}
+    END""")
+    connection.execute(f"""CREATE TRIGGER IF NOT EXISTS anti_entropy_{table}_delete AFTER DELETE ON {table} BEGIN
+        {mark.format(table=table, node=layout.leaf.format(row='old'))}
+    END""")
+    connection.execute(f"INSERT OR IGNORE INTO anti_entropy_dirty (name, node) "
+                       f"SELECT DISTINCT '{table}', {layout.leaf.format(row=table)} FROM {table}")
+
+
+def refresh(connection, layout, batch=256):
+    # re-hashes the dirty leaves of one file and moves their ancestors by the
+    # difference. Each batch of leaves is one transaction under the write
+    # lock, so no write slips in between and none waits long for the lock.
+    # Returns the number of leaves looked at.
+    refreshed = 0
+    while True:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            dirty = [node for (node,) in connection.execute(
+                "SELECT node FROM anti_entropy_dirty WHERE name = ? LIMIT ?", (layout.name, batch))]
+            for leaf in dirty:
+                _rehash(connection, layout, leaf)
+                connection.execute("DELETE FROM anti_entropy_dirty WHERE name = ? AND node = ?", (layout.name, leaf))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        refreshed += len(dirty)
+        if len(dirty) < batch:
+            return refreshed
+
+
+def _rehash(connection, layout, leaf):
+    rows = layout.rows(connection, leaf)
+    checksum = _checksum([layout.image(row) for row in rows]) if rows else 0
+    old = connection.execute("SELECT checksum, rows FROM anti_entropy_tree WHERE name = ? AND level = 0 AND node = ?",
+                             (layout.name, leaf)).fetchone()
+    old_checksum, old_rows = tuple(old) if old else (0, 0)
+    delta, delta_rows = (checksum - old_checksum) % MOD, len(rows) - old_rows
+    if not delta and not delta_rows:
+        return
+    node = leaf
+    for level in range(layout.levels):
+        connection.execute(
+            "INSERT INTO anti_entropy_tree (name, level, node, checksum, rows) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (name, level, node) DO UPDATE SET checksum = (checksum + excluded.checksum) % ?, "
+            "rows = rows + excluded.rows", (layout.name, level, node, delta, delta_rows, MOD))
+        connection.execute("DELETE FROM anti_entropy_tree WHERE name = ? AND level = ? AND node = ? AND rows = 0",
+                           (layout.name, level, node))
+        if level + 1 < layout.levels:
+            node = layout.parent(level, node)
+
+
+def _nodes(connection, layout, level, parent):
+    if parent is None:
+        condition, params = "1", ()
+    else:
+        condition, params = layout.children(level + 1, parent)
+    return {row[0]: (row[1], row[2]) for row in connection.execute(
+        f"SELECT node, checksum, rows FROM anti_entropy_tree WHERE name = ? AND level = ? AND {condition}",
+        (layout.name, level) + params)}
+
+
+def compare(source, target, layout):
+    # leaves whose checksums differ: ({leaf: (source (checksum, rows), target (checksum, rows))},
+    # nodes read). Both trees must be refreshed.
+    differing = {}
+    read = 0
+    pending = [(layout.levels - 1, None)]
+    while pending:
+        level, parent = pending.pop()
+        ours, theirs = _nodes(source, layout, level, parent), _nodes(target, layout, level, parent)
+        read += len(ours) + len(theirs)
+        for node in set(ours) | set(theirs):
+            mine, other = ours.get(node, (0, 0)), theirs.get(node, (0, 0))
+            if mine == other:
+                continue
+            if level == 0:
+                differing[node] = (mine, other)
+            else:
+                pending.append((level - 1, node))
+    return differing, read
+
+
+class AntiEntropy:
+    # Compares every (label, layout, source, targets) set every `interval`
+    # seconds in a background thread and repairs the confirmed differences.
+    # on_repair(label, changes) is called with the (wanted, seen) rows of
+    # each block once its repair is committed.
+
+    def __init__(self, replica_sets, interval=30, repair=True, max_blocks=1000, on_repair=None):
+        self.replica_sets = [(label, LAYOUTS[kind] if isinstance(kind, str) else kind, source, list(targets))
+                             for label, kind, source, targets in replica_sets]
+        self.interval = interval
+        self.repair = repair
+        self.max_blocks = max_blocks
+        self.on_repair = on_repair
+        self.passes = 0
+        self.repaired_rows = 0
+        self.last = {}
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def run_once(self, repair=None, confirm=True):
+        # one pass over every replica set; returns and keeps its report
+        repair = self.repair if repair is None else repair
+        report = {}
+        with self._lock:
+            for label, layout, source_path, targets in self.replica_sets:
+                for target_path in targets:
+                    report[f'{label}:{os.path.basename(target_path)}'] = self._check(
+                        label, layout, source_path, target_path, repair, confirm)
+            self.passes += 1
+            self.last = {"finished": time.time(), "replicas": report}
+        return self.last
+
+    def _check(self, label, layout, source_path, target_path, repair, confirm):
+        start = time.perf_counter()
+        with closing(open_connection(source_path)) as source, closing(open_connection(target_path)) as target:
+            refreshed = refresh(source, layout) + refresh(target, layout)
+            differing, read = compare(source, target, layout)
+            rows_differing = 0
+            repaired = 0
+            confirmed = 0
+            seen = {}
+            for leaf, checksums in sorted(differing.items(), key=lambda item: str(item[0]))[:self.max_blocks]:
+                changes = layout.diff(layout.rows(source, leaf), layout.rows(target, leaf))
+                rows_differing += len(changes)
+                key = (label, target_path, leaf)
+                seen[key] = checksums
+                if not repair or (confirm and self._seen.get(key) != checksums):
+                    continue
+                confirmed += 1
+                with target:
+                    repaired += layout.repair(target, changes)
+                if self.on_repair:
+                    self.on_repair(label, changes)
+            for key in [key for key in self._seen if key[:2] == (label, target_path)]:
+                del self._seen[key]
+            self._seen.update(seen)
+            self.repaired_rows += repaired
+        return {"source": source_path, "target": target_path, "leaves_refreshed": refreshed,
+                "nodes_compared": read, "blocks_differing": len(differing), "rows_differing": rows_differing,
+                "blocks_repaired": confirmed, "rows_repaired": repaired,
+                "sample": [str(leaf) for leaf in sorted(differing, key=str)[:20]],
+                "duration_ms": round((time.perf_counter() - start) * 1000, 3)}
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as error:
+                # tried again on the next round
+                print(f"anti-entropy pass failed: {error}")
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name='anti-entropy', daemon=True)
+            self._thread.start()
+        return self
+
+    def stats(self):
+        return {"interval_s": self.interval, "repair": self.repair, "passes": self.passes,
+                "rows_repaired": self.repaired_rows, "last": self.last}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare replicas and repair the blocks that differ")
+    parser.add_argument('--catalog', nargs='+', default=[], help="catalog files, the right one first")
+    parser.add_argument('--order', nargs='+', default=[], help="order files, the right one first")
+    parser.add_argument('--repair', action='store_true', help="make the other files match the first one")
+    args = parser.parse_args()
+
+    replica_sets = [(kind, kind, paths[0], paths[1:]) for kind, paths in (('catalog', args.catalog), ('order', args.order))
+                    if len(paths) > 1]
+    if not replica_sets:
+        parser.error("give at least two files for --catalog or --order")
+    # by hand the services are expected to be stopped, so nothing is in flight to wait for
+    report = AntiEntropy(replica_sets, repair=args.repair).run_once(confirm=False)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
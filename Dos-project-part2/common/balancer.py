@@ -0,0 +1,136 @@
+import threading
+import time
+from contextlib import contextmanager
+
+POLICIES = ('round_robin', 'least_outstanding', 'ewma')
+
+
+class ReplicaState:
+
+    def __init__(self, replica):
+        self.replica = replica
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ewma_latency = 0.0
+        self.ejected_until = None
+        self.probing = False
+
+    def as_dict(self):
+        return {
+            "replica": getattr(self.replica, "base_url", self.replica),
+            "healthy": self.ejected_until is None,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "ewma_latency_ms": round(self.ewma_latency * 1000, 3),
+        }
+
+
+class ReplicaBalancer:
+    # picks a replica per request; replicas that keep failing are ejected for
+    # eject_seconds and only come back after probe(replica) succeeds
+
+    def __init__(self, replicas, policy='round_robin', probe=None, failure_threshold=2,
+                 eject_seconds=5.0, ewma_decay=0.3):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown balancing policy {policy!r}, expected one of {POLICIES}")
+        self.policy = policy
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.eject_seconds = eject_seconds
+        self.ewma_decay = ewma_decay
+        self.states = [ReplicaState(replica) for replica in replicas]
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def pick(self, exclude=()):
+        now = time.monotonic()
+        to_probe = None
+        with self._lock:
+            candidates = []
+            for state in self.states:
+                if state.replica in exclude:
+                    continue
+                if state.ejected_until is None:
+                    candidates.append(state)
+                elif state.ejected_until <= now and not state.probing and to_probe is None:
+                    state.probing = True
+                    to_probe = state
+        if to_probe is not None and self._probe(to_probe):
+            candidates.append(to_probe)
+        with self._lock:
+            if not candidates:
+                # everything is ejected: try the one that has been out the longest
+                candidates = sorted((s for s in self.states if s.replica not in exclude),
+                                    key=lambda s: s.ejected_until or 0)[:1]
+                if not candidates:
+                    return None
+            state = self._choose(candidates)
+            state.outstanding += 1
+            state.requests += 1
+            return state.replica
+
+    def _choose(self, candidates):
+        self._next += 1
+        rotated = candidates[self._next % len(candidates):] + candidates[:self._next % len(candidates)]
+        if self.policy == 'least_outstanding':
+            return min(rotated, key=lambda s: s.outstanding)
+        if self.policy == 'ewma':
+            return min(rotated, key=lambda s: s.ewma_latency * (s.outstanding + 1))
+        return rotated[0]
+
+    def _probe(self, state):
+        try:
+            ok = self.probe(state.replica) if self.probe else True
+        except Exception:
+            ok = False
+        with self._lock:
+            state.probing = False
+            if ok:
+                state.ejected_until = None
+                state.consecutive_failures = 0
+            else:
+                state.ejected_until = time.monotonic() + self.eject_seconds
+        return ok
+
+    def _state(self, replica):
+        for state in self.states:
+            if state.replica == replica:
+                return state
+        raise KeyError(replica)
+
+    def release(self, replica, latency, ok=True):
+        with self._lock:
+            state = self._state(replica)
+            state.outstanding -= 1
+            if ok:
+                state.consecutive_failures = 0
+                if state.ewma_latency:
+                    state.ewma_latency += self.ewma_decay * (latency - state.ewma_latency)
+                else:
+                    state.ewma_latency = latency
+                return
+            state.failures += 1
+            state.consecutive_failures += 1
+            if state.ejected_until is None and state.consecutive_failures >= self.failure_threshold:
+                state.ejected_until = time.monotonic() + self.eject_seconds
+                state.ejections += 1
+
+    @contextmanager
+    def acquire(self, exclude=()):
+        replica = self.pick(exclude)
+        start = time.perf_counter()
+        try:
+            yield replica
+        except Exception:
+            self.release(replica, time.perf_counter() - start, ok=False)
+            raise
+        self.release(replica, time.perf_counter() - start)
+
+    def stats(self):
+        with self._lock:
+            return {"policy": self.policy, "replicas": [state.as_dict() for state in self.states]}
@@ -0,0 +1,231 @@
+import bisect
+import threading
+import time
+
+from common.db_pool import open_connection
+from common.serialization import Encoded, dumps
+
+# In-memory copy of the books table for the catalog services. A Snapshot is
+# never changed once built: refresh() applies the rows changed since its
+# version to a copy and swaps that in, so a read is a dict lookup that
+# returns ready-made JSON bytes. Changes are found through book_changes, a
+# short history of changed book ids written by triggers on books; `seq` there
+# is the version of the snapshot and of each book. The versions make the
+# ETags of the responses, and the time a book was last seen to change their
+# Last-Modified.
+
+CHANGE_HISTORY = 10000
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS book_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, book_id INTEGER NOT NULL)",
+    f"""CREATE TRIGGER IF NOT EXISTS book_changes_insert AFTER INSERT ON books BEGIN
+        INSERT INTO book_changes(book_id) VALUES (new.id);
+        DELETE FROM book_changes WHERE seq <= (SELECT MAX(seq) FROM book_changes) - {CHANGE_HISTORY};
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS book_changes_update AFTER UPDATE ON books BEGIN
+        INSERT INTO book_changes(book_id) SELECT old.id WHERE old.id != new.id;
+        INSERT INTO book_changes(book_id) VALUES (new.id);
+        DELETE FROM book_changes WHERE seq <= (SELECT MAX(seq) FROM book_changes) - {CHANGE_HISTORY};
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_changes_delete AFTER DELETE ON books BEGIN
+        INSERT INTO book_changes(book_id) VALUES (old.id);
+    END""",
+]
+
+# substring results kept per snapshot; arbitrary queries must not grow it forever
+MAX_MATCHES = 1024
+
+
+def create_change_log(connection):
+    # schema migration; runs inside the migrator's transaction
+    for statement in SCHEMA:
+        connection.execute(statement)
+
+
+def join(items):
+    return b'[' + b','.join(items) + b']'
+
+
+class Snapshot:
+
+    def __init__(self, version, books, versions, items=None, topics=None, changed=(), modified=None, removed=None):
+        self.version = version
+        self.books = books
+        self.versions = versions
+        # when each book last changed, and when a book last left a topic
+        # (deleted or moved), as far as this process has seen
+        now = time.time()
+        self.modified = dict.fromkeys(books, now) if modified is None else modified
+        self.removed = now if removed is None else removed
+        # one JSON document per book and per exact topic (lower case)
+        self.items = dict(items or {})
+        for book_id in changed:
+            self.items.pop(book_id, None)
+        for book_id, book in books.items():
+            if book_id not in self.items:
+                self.items[book_id] = dumps(book)
+        self.topic_ids = {}
+        for book_id in sorted(books):
+            self.topic_ids.setdefault(books[book_id]['topic'].lower(), []).append(book_id)
+        self.topics = {topic: body for topic, body in (topics or {}).items() if topic in self.topic_ids}
+        for topic, ids in self.topic_ids.items():
+            if topic not in self.topics or any(book_id in changed for book_id in ids):
+                self.topics[topic] = join(self.items[book_id] for book_id in ids)
+        self._matches = {}
+        self._match_ids = {}
+        self._encoded = {}
+
+    def apply(self, version, rows, changed):
+        # a new snapshot with `rows` replacing the books in `changed`; ids in
+        # `changed` without a row were deleted
+        now = time.time()
+        books = {book_id: book for book_id, book in self.books.items() if book_id not in changed}
+        versions = dict(self.versions)
+        modified = dict(self.modified)
+        removed = self.removed
+        topics = dict(self.topics)
+        for book_id, seq in changed.items():
+            versions[book_id] = seq
+            modified[book_id] = now
+            if book_id in self.books:
+                topics.pop(self.books[book_id]['topic'].lower(), None)
+        for row in rows:
+            books[row['id']] = dict(row)
+        for book_id in changed:
+            if book_id not in books:
+                versions.pop(book_id, None)
+                modified.pop(book_id, None)
+            if book_id in self.books and (book_id not in books or books[book_id]['topic'] != self.books[book_id]['topic']):
+                removed = now
+        return Snapshot(version, books, versions, self.items, topics, changed, modified, removed)
+
+    def item(self, book_id):
+        return self.items.get(book_id)
+
+    def item_encoded(self, book_id):
+        # item() with its validators, or None; books whose change fell out of
+        # the history have version 0 and a hash of their JSON as ETag
+        body = self.items.get(book_id)
+        if body is None:
+            return None
+        seq = self.versions.get(book_id)
+        return Encoded(body, f'"{book_id}.{seq}"' if seq else None, self.modified[book_id])
+
+    def _topic_ids(self, topic, match):
+        # sorted ids of the matching books, or None for an unknown exact topic
+        needle = topic.lower()
+        if needle == 'all':
+            key = ('all',)
+        elif match == 'exact':
+            return self.topic_ids.get(needle)
+        else:
+            key = ('substring', needle)
+        if key not in self._match_ids:
+            ids = sorted(book_id for name, ids in self.topic_ids.items() if key[0] == 'all' or needle in name
+                         for book_id in ids)
+            if len(self._match_ids) >= MAX_MATCHES:
+                return ids
+            self._match_ids[key] = ids
+        return self._match_ids[key]
+
+    def topic(self, topic, match='substring'):
+        # same results as common.topic_search.search_books, or None
+        if match == 'exact' and topic.lower() != 'all':
+            return self.topics.get(topic.lower())
+        key = (topic.lower(), match)
+        if key in self._matches:
+            return self._matches[key]
+        ids = self._topic_ids(topic, match)
+        body = join(self.items[book_id] for book_id in ids) if ids else None
+        if len(self._matches) < MAX_MATCHES:
+            self._matches[key] = body
+        return body
+
+    def topic_encoded(self, topic, match='substring'):
+        # topic() with its validators, or None. A book that joins the list
+        # always has the newest version in it, and one that leaves it lowers
+        # the count, so the pair changes with every change to the list.
+        key = (topic.lower(), match)
+        encoded = self._encoded.get(key)
+        if encoded is None:
+            body = self.topic(topic, match)
+            if body is None:
+                return None
+            ids = self._topic_ids(topic, match)
+            newest = max(self.versions.get(book_id, 0) for book_id in ids)
+            encoded = Encoded(body, f'"{newest}.{len(ids)}"' if newest else None,
+                              max(self.removed, max(self.modified[book_id] for book_id in ids)))
+            if len(self._encoded) < MAX_MATCHES:
+                self._encoded[key] = encoded
+        return encoded
+
+    def topic_rows(self, topic, match='substring', after=0):
+        # (book_id, JSON bytes) of the matching books with id > after, for common.paging
+        ids = self._topic_ids(topic, match) or []
+        for index in range(bisect.bisect_right(ids, after), len(ids)):
+            yield ids[index], self.items[ids[index]]
+
+
+class CatalogSnapshot:
+    # Keeps the newest Snapshot of one catalog file. refresh() costs one
+    # PRAGMA data_version unless another connection has committed since the
+    # last call; then it reads only the changed books, or everything if the
+    # change history no longer reaches back to the current version.
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = open_connection(path, check_same_thread=False)
+        self._connection.isolation_level = None
+        self._lock = threading.Lock()
+        self._data_version = None
+        self.current = None
+        self.full_loads = 0
+        self.deltas = 0
+        self.changes = 0
+        self.refresh()
+
+    def refresh(self):
+        with self._lock:
+            data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return self.current
+            self._data_version = data_version
+            # one read transaction, so the changes and the rows agree
+            self._connection.execute("BEGIN")
+            try:
+                if self.current is None:
+                    self.current = self._load()
+                else:
+                    self.current = self._apply_changes(self.current)
+            finally:
+                self._connection.execute("COMMIT")
+            return self.current
+
+    def _load(self):
+        self.full_loads += 1
+        version = self._connection.execute("SELECT COALESCE(MAX(seq), 0) FROM book_changes").fetchone()[0]
+        books = {row['id']: dict(row) for row in self._connection.execute("SELECT * FROM books")}
+        versions = dict(self._connection.execute(
+            "SELECT book_id, MAX(seq) FROM book_changes GROUP BY book_id").fetchall())
+        return Snapshot(version, books, {book_id: versions.get(book_id, 0) for book_id in books})
+
+    def _apply_changes(self, snapshot):
+        changes = self._connection.execute(
+            "SELECT seq, book_id FROM book_changes WHERE seq > ? ORDER BY seq", (snapshot.version,)).fetchall()
+        if not changes:
+            return snapshot
+        if changes[0]['seq'] != snapshot.version + 1:
+            # the history was trimmed past our version
+            return self._load()
+        changed = {change['book_id']: change['seq'] for change in changes}
+        placeholders = ','.join('?' * len(changed))
+        rows = self._connection.execute(f"SELECT * FROM books WHERE id IN ({placeholders})", list(changed)).fetchall()
+        self.deltas += 1
+        self.changes += len(changes)
+        return snapshot.apply(changes[-1]['seq'], rows, changed)
+
+    def stats(self):
+        snapshot = self.current
+        return {"path": self.path, "version": snapshot.version, "books": len(snapshot.books),
+                "topics": len(snapshot.topic_ids), "full_loads": self.full_loads,
+                "deltas": self.deltas, "changes": self.changes}
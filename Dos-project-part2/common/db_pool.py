@@ -0,0 +1,207 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# per-connection settings; the WAL journal itself is set once per file by
+# common.migrations. 'balanced' relies on WAL: synchronous=NORMAL never
+# corrupts the file but a power cut can drop the last commits.
+PROFILES = {
+    'safe': (
+        "PRAGMA synchronous = FULL",
+        "PRAGMA cache_size = -8000",
+        "PRAGMA temp_store = MEMORY",
+    ),
+    'balanced': (
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA cache_size = -32000",
+        "PRAGMA mmap_size = 268435456",
+        "PRAGMA temp_store = MEMORY",
+    ),
+    'fast': (
+        "PRAGMA synchronous = OFF",
+        "PRAGMA cache_size = -65536",
+        "PRAGMA mmap_size = 1073741824",
+        "PRAGMA temp_store = MEMORY",
+    ),
+}
+
+
+def profile_pragmas(profile=None):
+    return PROFILES[profile or os.environ.get('DB_PROFILE', 'balanced')]
+
+
+def open_connection(path, timeout=30, pragmas=None, check_same_thread=True):
+    connection = sqlite3.connect(path, timeout=timeout, check_same_thread=check_same_thread)
+    connection.row_factory = sqlite3.Row
+    # so that INSERT OR REPLACE fires the delete triggers of the row it
+    # replaces; the order rollups, change logs and search index rely on them
+    connection.execute("PRAGMA recursive_triggers = ON")
+    for pragma in profile_pragmas() if pragmas is None else pragmas:
+        connection.execute(pragma)
+    return connection
+
+
+class PoolTimeout(Exception):
+    # every connection stayed checked out for the whole timeout; the services
+    # answer 503 and ask the client to come back after retry_after seconds
+    retry_after = 1
+
+
+class ConnectionPool:
+    # Bounded pool of SQLite connections to one file. PRAGMAs run once when a
+    # connection is opened; a connection that sat idle longer than
+    # check_interval is pinged before it is handed out again. `timeout` is
+    # SQLite's busy timeout, checkout_timeout how long checkout() waits for a
+    # free connection (the busy timeout when not given).
+
+    def __init__(self, path, size=8, timeout=30, pragmas=None, check_interval=30, checkout_timeout=None):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.checkout_timeout = timeout if checkout_timeout is None else checkout_timeout
+        self.pragmas = profile_pragmas() if pragmas is None else tuple(pragmas)
+        self.check_interval = check_interval
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checkouts = 0
+        self.in_use = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.failed_checks = 0
+
+    def _connect(self):
+        connection = open_connection(self.path, self.timeout, self.pragmas, check_same_thread=False)
+        with self._lock:
+            self.created += 1
+        return connection
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        finally:
+            with self._lock:
+                self.closed += 1
+
+    def _healthy(self, connection, idle_since):
+        if time.monotonic() - idle_since < self.check_interval:
+            return True
+        try:
+            connection.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            with self._lock:
+                self.failed_checks += 1
+            return False
+
+    def checkout(self):
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise PoolTimeout(f"no free connection to {self.path} after {self.checkout_timeout}s")
+        waited = time.perf_counter() - start
+        try:
+            connection = None
+            while connection is None:
+                try:
+                    candidate, idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    connection = self._connect()
+                    break
+                if self._healthy(candidate, idle_since):
+                    connection = candidate
+                else:
+                    self._discard(candidate)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            if waited > 0.001:
+                self.waits += 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+        return connection
+
+    def checkin(self, connection, broken=False):
+        try:
+            if not broken and connection.in_transaction:
+                connection.rollback()
+        except sqlite3.Error:
+            broken = True
+        if broken:
+            self._discard(connection)
+        else:
+            self._idle.put((connection, time.monotonic()))
+        with self._lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        connection = self.checkout()
+        try:
+            yield connection
+        except sqlite3.DatabaseError as error:
+            self.checkin(connection, broken=not isinstance(error, sqlite3.OperationalError))
+            raise
+        except BaseException:
+            self.checkin(connection)
+            raise
+        self.checkin(connection)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "path": self.path,
+                "size": self.size,
+                "in_use": self.in_use,
+                "idle": self._idle.qsize(),
+                "created": self.created,
+                "closed": self.closed,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "avg_wait_ms": round(self.wait_time / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "max_wait_ms": round(self.max_wait * 1000, 3),
+                "failed_checks": self.failed_checks,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+# path as given -> pool, so a lookup does not resolve symlinks every time
+_spellings = {}
+
+# ConnectionPool options of every pool get_pool creates from now on
+_defaults = {}
+
+
+def configure_pools(**options):
+    # called by the apps at startup, before the first get_pool
+    _defaults.update(options)
+
+
+def get_pool(path, size=None, **options):
+    # one pool per database file per process, whatever path spelling is used
+    pool = _spellings.get(path)
+    if pool is not None:
+        return pool
+    key = os.path.realpath(path)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(path, size or int(os.environ.get('DB_POOL_SIZE', 8)), **{**_defaults, **options})
+        _spellings[path] = _pools[key]
+        return _pools[key]
+
+
+def pool_stats():
+    with _pools_lock:
+        return [pool.stats() for pool in _pools.values()]
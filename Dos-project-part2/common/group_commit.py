@@ -0,0 +1,161 @@
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from common.db_pool import open_connection
+from common.stock import insert_order_rows
+
+
+class OrderTicket:
+    # one purchase's rows; they always land in the same commit. A caller that
+    # stops waiting cancels the ticket, unless the writer has already taken
+    # it, so rows given up on are never written later.
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.order_ids = None
+        self.error = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._taken = False
+        self._cancelled = False
+
+    def take(self):
+        # the writer's claim; False when the caller already gave up
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._taken = True
+            return True
+
+    def cancel(self):
+        with self._lock:
+            if self._taken:
+                return False
+            self._cancelled = True
+            return True
+
+    def resolve(self, order_ids=None, error=None):
+        self.order_ids = order_ids
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            if self.cancel():
+                raise TimeoutError("order row was not committed in time")
+            # the writer has the rows; it resolves the ticket whatever happens
+            self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.order_ids
+
+
+class GroupCommitWriter:
+    # Order rows from concurrent purchases are queued and a single writer
+    # thread inserts them together: it takes what is queued, waits up to
+    # max_delay for more (or until max_rows), commits once and then wakes every
+    # caller of that batch. One fsync is shared by the whole batch. When the
+    # batch fails, each purchase is written on its own, so one bad row only
+    # fails its own purchase.
+
+    def __init__(self, path, max_rows=128, max_delay=0.002, log=None):
+        self.path = path
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.log = log
+        self.commits = 0
+        self.rows = 0
+        self.largest_batch = 0
+        self.batch_sizes = Counter()
+        self.failed_batches = 0
+        self.failed_tickets = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def enqueue(self, cart):
+        # cart is [(book_id, quantity)]; returns a ticket to wait on
+        order_date = datetime.now()
+        ticket = OrderTicket([(book_id, order_date, quantity) for book_id, quantity in cart])
+        self._queue.put(ticket)
+        return ticket
+
+    def write(self, book_id, quantity=1, timeout=30):
+        return self.enqueue([(book_id, quantity)]).wait(timeout)[0]
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        rows = len(batch[0].rows)
+        deadline = time.monotonic() + self.max_delay
+        while rows < self.max_rows:
+            try:
+                ticket = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    ticket = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            batch.append(ticket)
+            rows += len(ticket.rows)
+        return batch, rows
+
+    def _run(self):
+        connection = None
+        while True:
+            batch = [ticket for ticket in self._next_batch()[0] if ticket.take()]
+            if not batch:
+                continue
+            try:
+                connection = connection or open_connection(self.path)
+                self._commit(connection, batch)
+            except Exception:
+                # opened again in case the connection itself is broken
+                self.failed_batches += 1
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                connection = self._commit_each(batch)
+
+    def _commit(self, connection, batch):
+        rows = sum(len(ticket.rows) for ticket in batch)
+        order_ids = insert_order_rows(connection, [row for ticket in batch for row in ticket.rows], self.log)
+        self.commits += 1
+        self.rows += rows
+        self.largest_batch = max(self.largest_batch, rows)
+        self.batch_sizes[rows] += 1
+        for ticket in batch:
+            ticket.resolve(order_ids[:len(ticket.rows)])
+            order_ids = order_ids[len(ticket.rows):]
+
+    def _commit_each(self, batch):
+        # after a failed batch; returns the connection to go on with, or None
+        connection = None
+        for ticket in batch:
+            try:
+                connection = connection or open_connection(self.path)
+                self._commit(connection, [ticket])
+            except Exception as error:
+                self.failed_tickets += 1
+                ticket.resolve(error=error)
+        return connection
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "commits": self.commits,
+            "rows": self.rows,
+            "rows_per_commit": round(self.rows / self.commits, 2) if self.commits else 0.0,
+            "largest_batch": self.largest_batch,
+            "failed_batches": self.failed_batches,
+            "failed_tickets": self.failed_tickets,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "queued": self._queue.qsize(),
+            "max_rows": self.max_rows,
+            "max_delay_ms": self.max_delay * 1000,
+        }
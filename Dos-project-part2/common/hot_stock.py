@@ -0,0 +1,284 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+
+from common.db_pool import get_pool, open_connection
+from common.http_client import BackendClient, BackendError
+from common.stock import PURCHASED, OUT_OF_STOCK, NOT_FOUND
+
+# Flash-sale mode for a few flagged books (HOT_BOOKS): the catalog service
+# holding a shard's primary catalog file keeps their stock in memory and
+# sells it by decrementing a counter under a lock. A flusher writes the
+# counters to books.quantity every HOT_FLUSH_MS; whatever sells books sends
+# the flagged ones to that service's POST /reserve through HotStockClient.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hot_stock (
+    book_id INTEGER PRIMARY KEY,
+    base_quantity INTEGER NOT NULL,
+    base_order_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hot_reservations (
+    id TEXT NOT NULL,
+    book_id INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    reserved_at REAL NOT NULL,
+    PRIMARY KEY (id, book_id)
+);
+"""
+
+# longer than a caller can take between /reserve and committing its orders
+RESERVATION_TTL = 30
+
+
+def reservation_id():
+    return uuid.uuid4().hex
+
+
+class HotStock:
+
+    def __init__(self, catalog_paths, order_path, book_ids, interval=0.05, log=None, reservation_ttl=RESERVATION_TTL):
+        # baselines live in catalog_paths[0]; with a ReplicationLog only that
+        # file is flushed and the shipper brings the others along
+        self.catalog_paths = list(catalog_paths)
+        self.order_path = order_path
+        self.book_ids = set(book_ids)
+        self.interval = interval
+        self.log = log
+        self.reservation_ttl = reservation_ttl
+        self.counters = {}
+        self.books = {}
+        self.reserved = 0
+        self.released = 0
+        self.refused = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self._dirty = set()
+        # reservations confirmed or released since the last flush
+        self._settled = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self.recover()
+
+    def _last_order_id(self, orders):
+        return orders.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+
+    def _sold_since(self, orders, book_id, order_id):
+        return orders.execute("SELECT COALESCE(SUM(quantity), 0) FROM orders WHERE book_id=? AND id > ?",
+                              (book_id, order_id)).fetchone()[0]
+
+    def recover(self):
+        # books.quantity lags by up to one flush, so the counters are rebuilt
+        # from the order log: a baseline (the quantity and last order id when
+        # it was taken) minus every order since, minus the reservations
+        # younger than the TTL, whose orders may still land. Older ones have
+        # turned into orders or never will and are dropped. Books no longer
+        # flagged get their quantity written back and lose their baseline.
+        retired = []
+        with closing(open_connection(self.catalog_paths[0])) as catalog, closing(open_connection(self.order_path)) as orders:
+            catalog.executescript(SCHEMA)
+            with catalog:
+                catalog.execute("DELETE FROM hot_reservations WHERE reserved_at < ?", (time.time() - self.reservation_ttl,))
+            held = dict(catalog.execute("SELECT book_id, SUM(quantity) FROM hot_reservations GROUP BY book_id").fetchall())
+            last_order_id = self._last_order_id(orders)
+            baselines = {row['book_id']: (row['base_quantity'], row['base_order_id'])
+                         for row in catalog.execute("SELECT * FROM hot_stock")}
+            for book_id, (quantity, order_id) in baselines.items():
+                if book_id not in self.book_ids:
+                    retired.append((quantity - self._sold_since(orders, book_id, order_id) - held.get(book_id, 0), book_id))
+            for book_id in self.book_ids:
+                book = catalog.execute("SELECT * FROM books WHERE id=?", (book_id,)).fetchone()
+                if book is None:
+                    continue
+                if book_id not in baselines:
+                    baselines[book_id] = (book['quantity'], last_order_id)
+                    with catalog:
+                        catalog.execute("INSERT INTO hot_stock (book_id, base_quantity, base_order_id) VALUES (?, ?, ?)",
+                                        (book_id, book['quantity'], last_order_id))
+                quantity, order_id = baselines[book_id]
+                self.counters[book_id] = quantity - self._sold_since(orders, book_id, order_id) - held.get(book_id, 0)
+                self.books[book_id] = dict(book)
+                if self.counters[book_id] != book['quantity']:
+                    self._dirty.add(book_id)
+        if retired:
+            self._write(retired)
+            with closing(open_connection(self.catalog_paths[0])) as catalog, catalog:
+                catalog.executemany("DELETE FROM hot_stock WHERE book_id=?", [(book_id,) for _, book_id in retired])
+
+    def is_hot(self, book_id):
+        return book_id in self.counters
+
+    def reserve(self, cart, reservation=None):
+        # all or nothing: (PURCHASED, None, [book rows]), else (OUT_OF_STOCK or NOT_FOUND, book_id, []).
+        # A reservation id is kept in hot_reservations until confirm() or release().
+        with self._lock:
+            for book_id, quantity in cart:
+                if book_id not in self.counters:
+                    return NOT_FOUND, book_id, []
+                if self.counters[book_id] < quantity:
+                    self.refused += 1
+                    return OUT_OF_STOCK, book_id, []
+            for book_id, quantity in cart:
+                self.counters[book_id] -= quantity
+                self._dirty.add(book_id)
+                self.reserved += quantity
+            books = [{**self.books[book_id], 'quantity': self.counters[book_id]} for book_id, _ in cart]
+        if reservation is not None:
+            try:
+                with get_pool(self.catalog_paths[0]).connection() as connection, connection:
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO hot_reservations (id, book_id, quantity, reserved_at) VALUES (?, ?, ?, ?)",
+                        [(reservation, book_id, quantity, time.time()) for book_id, quantity in cart])
+            except Exception:
+                self.release(cart)
+                raise
+        return PURCHASED, None, books
+
+    def confirm(self, reservations):
+        # the callers' order rows are committed; the reservations go at the next flush
+        with self._lock:
+            self._settled.update(reservations)
+
+    def release(self, cart, reservation=None):
+        # gives back a reservation whose purchase could not be completed
+        with self._lock:
+            for book_id, quantity in cart:
+                if book_id in self.counters:
+                    self.counters[book_id] += quantity
+                    self._dirty.add(book_id)
+                    self.released += quantity
+            if reservation is not None:
+                self._settled.add(reservation)
+
+    def update_book(self, book, quantity_set):
+        # after /modify: new price or title, and a new baseline if the quantity
+        # was set; orders in flight at that moment are counted twice on
+        # recovery, which can only undersell. Returns the row with the live quantity.
+        book_id = book['id']
+        with self._lock:
+            self.books[book_id] = dict(book)
+            if quantity_set:
+                with closing(open_connection(self.order_path)) as orders:
+                    order_id = self._last_order_id(orders)
+                with closing(open_connection(self.catalog_paths[0])) as catalog, catalog:
+                    catalog.execute("INSERT OR REPLACE INTO hot_stock (book_id, base_quantity, base_order_id) VALUES (?, ?, ?)",
+                                    (book_id, book['quantity'], order_id))
+                self.counters[book_id] = book['quantity']
+            self._dirty.add(book_id)
+            return {**self.books[book_id], 'quantity': self.counters[book_id]}
+
+    def _write(self, rows):
+        for path in self.catalog_paths[:1] if self.log else self.catalog_paths:
+            with get_pool(path).connection() as connection, connection:
+                connection.executemany("UPDATE books SET quantity=? WHERE id=?", rows)
+                if self.log is not None:
+                    for row in rows:
+                        self.log.append(connection, "UPDATE books SET quantity=? WHERE id=?", row)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows = [(self.counters[book_id], book_id) for book_id in self._dirty]
+                self._dirty.clear()
+                settled = list(self._settled)
+                self._settled.clear()
+            if not rows and not settled:
+                return 0
+            try:
+                if rows:
+                    self._write(rows)
+                if settled:
+                    with get_pool(self.catalog_paths[0]).connection() as connection, connection:
+                        connection.executemany("DELETE FROM hot_reservations WHERE id=?", [(reservation,) for reservation in settled])
+            except Exception:
+                with self._lock:
+                    self._dirty.update(book_id for _, book_id in rows)
+                    self._settled.update(settled)
+                raise
+            self.flushes += 1
+            self.flushed_rows += len(rows)
+            return len(rows)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except sqlite3.Error as error:
+                # kept dirty and tried again on the next round
+                print(f"hot stock flush failed: {error}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='hot-stock-flush', daemon=True)
+            self._thread.start()
+        return self
+
+    def stats(self):
+        with self._lock:
+            return {"books": {str(book_id): quantity for book_id, quantity in sorted(self.counters.items())},
+                    "unflushed": len(self._dirty), "unsettled": len(self._settled), "reserved": self.reserved,
+                    "released": self.released, "refused": self.refused, "flushes": self.flushes, "flushed_rows": self.flushed_rows,
+                    "interval_ms": self.interval * 1000}
+
+
+class HotStockClient:
+    # for the services that sell books: flagged books in a cart are reserved
+    # on the catalog service that owns their counters. Confirmations are
+    # queued and go out with the next reserve() rather than on their own.
+
+    MAX_CONFIRMATIONS = 10000
+
+    def __init__(self, base_url, book_ids, timeout=2.0):
+        self.book_ids = set(book_ids)
+        self.client = BackendClient([base_url], timeout=timeout)
+        self._confirmed = []
+        self._confirmed_lock = threading.Lock()
+
+    def is_hot(self, book_id):
+        return book_id in self.book_ids
+
+    def split(self, cart):
+        # (hot part, everything else)
+        return ([item for item in cart if item[0] in self.book_ids],
+                [item for item in cart if item[0] not in self.book_ids])
+
+    def _post(self, path, cart, **fields):
+        return self.client.post(path, json.dumps({"items": [
+            {"book_id": book_id, "quantity": quantity} for book_id, quantity in cart], **fields}),
+            {'Content-Type': 'application/json'})
+
+    def reserve(self, cart, reservation=None):
+        # same results as HotStock.reserve; BackendError when the owner cannot be reached
+        with self._confirmed_lock:
+            confirmed, self._confirmed = self._confirmed, []
+        try:
+            status, _, body = self._post('/reserve', cart, reservation=reservation, confirmed=confirmed)
+        except BackendError:
+            # deleting a reservation twice is harmless, so they are sent again
+            with self._confirmed_lock:
+                self._confirmed = (confirmed + self._confirmed)[-self.MAX_CONFIRMATIONS:]
+            raise
+        result = json.loads(body)
+        if status == 200:
+            return PURCHASED, None, result['items']
+        if status == 400:
+            return OUT_OF_STOCK, result.get('book_id'), []
+        if status == 404:
+            return NOT_FOUND, result.get('book_id'), []
+        raise BackendError(f"hot stock service answered {status}: {result.get('error')}")
+
+    def confirm(self, reservation):
+        # past MAX_CONFIRMATIONS the oldest are dropped; they expire on the
+        # owner. One lost when the owner goes down counts as held and as
+        # sold after its restart, which can only undersell.
+        with self._confirmed_lock:
+            self._confirmed.append(reservation)
+            del self._confirmed[:-self.MAX_CONFIRMATIONS]
+
+    def release(self, cart, reservation=None):
+        self._post('/release', cart, reservation=reservation)
@@ -0,0 +1,164 @@
+import http.client
+import queue
+import threading
+import time
+from urllib.parse import urlsplit
+
+from common.balancer import ReplicaBalancer
+from common.metrics import span, target_name, trace_headers
+
+
+# safe to send again when it is not known whether the server got them
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+# pooled connections idle longer than this are not reused; a server may
+# close them under us, and a purchase cannot be re-sent once it was written
+MAX_IDLE_SECONDS = 4
+
+
+class BackendError(Exception):
+    pass
+
+
+class HostPool:
+    # keep-alive connections to one backend, capped at max_connections
+
+    def __init__(self, base_url, max_connections=10, timeout=2.0):
+        parts = urlsplit(base_url)
+        self.base_url = base_url
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self.created = 0
+
+    def _new_connection(self):
+        self.created += 1
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise BackendError(f"connection limit reached for {self.base_url}")
+        try:
+            conn = self._idle_connection()
+            reused = conn is not None
+            if not reused:
+                conn = self._new_connection()
+            try:
+                status, headers_out, data = self._send(conn, method, path, body, headers)
+            except (http.client.HTTPException, OSError) as error:
+                conn.close()
+                if not reused or not self._may_resend(method, error):
+                    raise
+                # the server dropped the idle keep-alive connection
+                conn = self._new_connection()
+                try:
+                    status, headers_out, data = self._send(conn, method, path, body, headers)
+                except (http.client.HTTPException, OSError):
+                    conn.close()
+                    raise
+            if conn.sock is None:
+                conn.close()
+            else:
+                self._idle.put((conn, time.monotonic()))
+            return status, headers_out, data
+        finally:
+            self._slots.release()
+
+    def _idle_connection(self):
+        # the most recently used idle connection, or None
+        while True:
+            try:
+                conn, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                return None
+            if time.monotonic() - idle_since <= MAX_IDLE_SECONDS:
+                return conn
+            conn.close()
+
+    @staticmethod
+    def _may_resend(method, error):
+        # after a timeout the server may still be carrying the request out;
+        # other methods are only sent again when writing the request failed,
+        # so it never reached the server
+        if isinstance(error, TimeoutError):
+            return False
+        return method in IDEMPOTENT_METHODS or getattr(error, 'unsent', False)
+
+    def _send(self, conn, method, path, body, headers):
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+        except (ConnectionResetError, BrokenPipeError) as error:
+            # RemoteDisconnected is a ConnectionResetError too
+            error.unsent = True
+            raise
+        response = conn.getresponse()
+        data = response.read()
+        if response.will_close:
+            conn.close()
+        return response.status, dict(response.getheaders()), data
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait()[0].close()
+            except queue.Empty:
+                break
+
+
+class BackendClient:
+    # sends each request to the replica the balancer picks and retries the
+    # others when it fails
+
+    def __init__(self, base_urls, max_connections=10, timeout=2.0, policy='round_robin'):
+        self.pools = [HostPool(url, max_connections, timeout) for url in base_urls]
+        self.balancer = ReplicaBalancer(self.pools, policy, probe=self._probe)
+
+    @staticmethod
+    def _probe(pool):
+        status, _, _ = pool.request('GET', '/')
+        return status < 500
+
+    def request(self, method, path, body=None, headers=None):
+        idempotent = method in IDEMPOTENT_METHODS
+        headers = trace_headers(headers)
+        last_error = None
+        tried = []
+        while len(tried) < len(self.pools):
+            pool = self.balancer.pick(exclude=tried)
+            tried.append(pool)
+            start = time.perf_counter()
+            try:
+                with span('backend', target_name(pool.base_url)):
+                    status, headers_out, data = pool.request(method, path, body, headers)
+            except ConnectionRefusedError as error:
+                # nothing reached the replica, so any method can move on
+                self.balancer.release(pool, time.perf_counter() - start, ok=False)
+                last_error = error
+                continue
+            except (http.client.HTTPException, OSError, BackendError) as error:
+                self.balancer.release(pool, time.perf_counter() - start, ok=False)
+                last_error = error
+                if idempotent:
+                    continue
+                raise BackendError(f"{method} {path} failed on {pool.base_url}: {error}")
+            self.balancer.release(pool, time.perf_counter() - start, ok=status < 500)
+            if status >= 500 and idempotent:
+                last_error = BackendError(f"{pool.base_url} answered {status}")
+                continue
+            return status, headers_out, data
+        raise BackendError(f"{method} {path} failed on every replica: {last_error}")
+
+    def get(self, path, headers=None):
+        return self.request('GET', path, headers=headers)
+
+    def put(self, path, body=None, headers=None):
+        return self.request('PUT', path, body, headers)
+
+    def post(self, path, body=None, headers=None):
+        return self.request('POST', path, body, headers)
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
@@ -0,0 +1,220 @@
+import functools
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from common.db_pool import get_pool
+
+# Idempotency keys for the purchase routes. A purchase sent with
+# Idempotency-Key: <key> gets the same answer however often it is repeated:
+# the first request claims the key in purchase_keys, runs, and stores its
+# status, headers and body there; repeats are answered from the table, or
+# from a small in-memory LRU in front of it, without touching the catalog or
+# the orders again. A repeat that arrives while the first one still runs
+# gets 409, and the key sent with a different request gets 422.
+#
+# Answers the purchase gave itself (200, 400, 404) are kept for `ttl`
+# seconds. 5xx answers and exceptions free the key so a retry runs again,
+# and a claim without a result after `lease` seconds is taken to belong to a
+# process that died. Expired rows are deleted by the next request that
+# comes along once every PURGE_SECONDS, through the index on expires.
+
+KEY_HEADER = 'Idempotency-Key'
+# set on answers that were stored rather than produced by this request
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+PURGE_SECONDS = 60
+# the response headers stored with a result
+KEPT_HEADERS = ('Content-Type', 'X-Catalog-Seq')
+
+CLAIMED = 'claimed'
+REPLAY = 'replay'
+IN_PROGRESS = 'in_progress'
+MISMATCH = 'mismatch'
+# (status, message) for the states that are answered without running the purchase
+CONFLICTS = {
+    IN_PROGRESS: (409, "A request with this Idempotency-Key is still being processed"),
+    MISMATCH: (422, "This Idempotency-Key was already used for a different request"),
+}
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS purchase_keys (
+        key TEXT PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        claimed REAL NOT NULL,
+        expires REAL NOT NULL,
+        status INTEGER,
+        headers TEXT,
+        body BLOB
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_purchase_keys_expires ON purchase_keys(expires)",
+]
+
+
+def create_purchase_keys(connection):
+    # schema migration; runs inside the migrator's transaction
+    for statement in SCHEMA:
+        connection.execute(statement)
+
+
+def check_key(key):
+    # ValueError for a key that cannot be stored
+    if not key or len(key) > MAX_KEY_LENGTH or not key.isprintable():
+        raise ValueError(f"{KEY_HEADER} must be 1 to {MAX_KEY_LENGTH} printable characters")
+
+
+def fingerprint(method, path, body):
+    # what a repeat has to match to be the same request
+    return hashlib.sha256(f'{method} {path}\n'.encode() + (body or b'')).hexdigest()
+
+
+class IdempotencyStore:
+
+    def __init__(self, path, ttl=86400, cache_size=10000, lease=30):
+        self.path = path
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.lease = lease
+        # key -> (fingerprint, (status, headers, body), expires); finished results only
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_purge = 0
+        self.claims = 0
+        self.memory_replays = 0
+        self.table_replays = 0
+        self.conflicts = 0
+        self.released = 0
+        self.purged = 0
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def cached(self, key):
+        # the finished entry for key held in memory, or None
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return entry
+
+    def remembered(self, key, request_fingerprint):
+        # (state, result) answered from memory, or None when the table has to be asked
+        entry = self.cached(key)
+        if entry is None:
+            return None
+        if entry[0] != request_fingerprint:
+            self.conflicts += 1
+            return MISMATCH, None
+        self.memory_replays += 1
+        return REPLAY, entry[1]
+
+    def begin(self, key, request_fingerprint):
+        # (CLAIMED, None) when this request is to run, (REPLAY, (status,
+        # headers, body)) when it already did, or (IN_PROGRESS | MISMATCH, None)
+        remembered = self.remembered(key, request_fingerprint)
+        if remembered:
+            return remembered
+        now = time.time()
+        with get_pool(self.path).connection() as connection, connection:
+            self._purge(connection, now)
+            if connection.execute("INSERT OR IGNORE INTO purchase_keys (key, fingerprint, claimed, expires) "
+                                  "VALUES (?, ?, ?, ?)", (key, request_fingerprint, now, now + self.ttl)).rowcount:
+                self.claims += 1
+                return CLAIMED, None
+            # the insert took the write lock, so nobody changes the row under us
+            row = connection.execute("SELECT * FROM purchase_keys WHERE key = ?", (key,)).fetchone()
+            if row['expires'] <= now or (row['status'] is None and row['claimed'] <= now - self.lease):
+                connection.execute("UPDATE purchase_keys SET fingerprint = ?, claimed = ?, expires = ?, status = NULL, "
+                                   "headers = NULL, body = NULL WHERE key = ?",
+                                   (request_fingerprint, now, now + self.ttl, key))
+                self.claims += 1
+                return CLAIMED, None
+            if row['fingerprint'] != request_fingerprint:
+                self.conflicts += 1
+                return MISMATCH, None
+            if row['status'] is None:
+                self.conflicts += 1
+                return IN_PROGRESS, None
+            result = (row['status'], [tuple(header) for header in json.loads(row['headers'])], bytes(row['body']))
+        self._remember(key, (request_fingerprint, result, row['expires']))
+        self.table_replays += 1
+        return REPLAY, result
+
+    def settle(self, key, status, headers, body):
+        # stores the answer of a claimed key, or frees the key for a 5xx
+        if status >= 500:
+            self.release(key)
+            return
+        headers = [(name, value) for name, value in headers if name in KEPT_HEADERS]
+        expires = time.time() + self.ttl
+        with get_pool(self.path).connection() as connection, connection:
+            row = connection.execute("UPDATE purchase_keys SET status = ?, headers = ?, body = ?, expires = ? "
+                                     "WHERE key = ? RETURNING fingerprint",
+                                     (status, json.dumps(headers), body, expires, key)).fetchone()
+        if row:
+            self._remember(key, (row['fingerprint'], (status, headers, body), expires))
+
+    def release(self, key):
+        # the claim is dropped so that the next try runs the purchase
+        with get_pool(self.path).connection() as connection, connection:
+            connection.execute("DELETE FROM purchase_keys WHERE key = ? AND status IS NULL", (key,))
+        self.released += 1
+
+    def _purge(self, connection, now):
+        if now < self._next_purge:
+            return
+        self._next_purge = now + PURGE_SECONDS
+        self.purged += connection.execute("DELETE FROM purchase_keys WHERE expires <= ?", (now,)).rowcount
+
+    def stats(self):
+        with get_pool(self.path).connection() as connection:
+            stored = connection.execute("SELECT COUNT(*) FROM purchase_keys").fetchone()[0]
+        return {"path": self.path, "ttl_s": self.ttl, "stored_keys": stored, "cached_keys": len(self._cache),
+                "cache_size": self.cache_size, "claims": self.claims, "memory_replays": self.memory_replays,
+                "table_replays": self.table_replays, "conflicts": self.conflicts, "released": self.released,
+                "purged": self.purged}
+
+
+def idempotent(store):
+    # decorator for a Flask purchase view; without a store the view is left as it is
+    def decorate(view):
+        if store is None:
+            return view
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            from flask import Response, jsonify, make_response, request
+
+            key = request.headers.get(KEY_HEADER)
+            if key is None:
+                return view(*args, **kwargs)
+            try:
+                check_key(key)
+            except ValueError as error:
+                return jsonify({"message": str(error)}), 400
+            state, result = store.begin(key, fingerprint(request.method, request.path, request.get_data()))
+            if state == REPLAY:
+                status, headers, body = result
+                return Response(body, status, headers + [(REPLAYED_HEADER, 'true')])
+            if state in CONFLICTS:
+                status, message = CONFLICTS[state]
+                return jsonify({"message": message}), status
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                store.release(key)
+                raise
+            store.settle(key, response.status_code, list(response.headers.items()), response.get_data())
+            return response
+        return wrapper
+    return decorate
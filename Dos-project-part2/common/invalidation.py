@@ -0,0 +1,50 @@
+import http.client
+import json
+import queue
+import threading
+
+from common.http_client import BackendError, HostPool
+
+
+# sent with every notice when the fronts are configured to expect it
+TOKEN_HEADER = 'X-Invalidation-Token'
+
+
+class InvalidationNotifier:
+    # pushes the ids of changed books to the front servers' /cache/invalidate
+    # from a background thread so writes never wait on the front tier. The
+    # fronts read the book again themselves; with a ReplicationLog the notice
+    # carries the write's sequence number so that read sees the change.
+
+    def __init__(self, front_urls, timeout=1.0, max_pending=10000, log=None, token=None):
+        self.pools = [HostPool(url, max_connections=1, timeout=timeout) for url in front_urls if url]
+        self.log = log
+        self.headers = {'Content-Type': 'application/json'}
+        if token:
+            self.headers[TOKEN_HEADER] = token
+        self._queue = queue.Queue(max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def book_changed(self, book):
+        # called in the thread that wrote the book, which holds its log sequence number
+        self._send({"id": book['id'], "seq": self.log.last_seq() if self.log else 0})
+
+    def book_removed(self, book_id):
+        self._send({"id": book_id, "seq": self.log.last_seq() if self.log else 0})
+
+    def _send(self, message):
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            # the front servers are unreachable or slow; entries expire by TTL
+            pass
+
+    def _run(self):
+        while True:
+            body = json.dumps(self._queue.get())
+            for pool in self.pools:
+                try:
+                    pool.request('POST', '/cache/invalidate', body, self.headers)
+                except (http.client.HTTPException, OSError, BackendError):
+                    pass
@@ -0,0 +1,237 @@
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+from common.db_pool import pool_stats
+
+# Counters and histograms for all five services, exported in the Prometheus
+# text format, plus request tracing: every request gets an X-Trace-Id (the
+# caller's, or a new one), calls to other services carry it along, and
+# span() times the stages of a request both into a histogram and into the
+# trace. The stages come back to the caller in a Server-Timing header, and
+# requests slower than TRACE_SLOW_MS are kept for GET /stats/traces and
+# written to stderr as one JSON line, so a slow purchase can be followed
+# from the front into the catalog and order services by its trace id.
+
+TRACE_HEADER = 'X-Trace-Id'
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_SECONDS = float(os.environ.get('TRACE_SLOW_MS', 500)) / 1000
+
+service = 'app'
+_current = contextvars.ContextVar('trace', default=None)
+
+
+def _labels(names, values):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for name, value in zip(names, values))
+
+
+class Counter:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = ('service',) + tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = (service,) + tuple(labels.get(name, '') for name in self.labels[1:])
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{{{_labels(self.labels, key)}}} {value}")
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = ('service',) + tuple(labels)
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = (service,) + tuple(labels.get(name, '') for name in self.labels[1:])
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[0][index] += 1
+                    break
+            counts[1] += 1
+            counts[2] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (buckets, count, total) in sorted(self._values.items()):
+                labels = _labels(self.labels, key)
+                cumulative = 0
+                for bound, hits in zip(self.buckets, buckets):
+                    cumulative += hits
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f"{self.name}_sum{{{labels}}} {total}")
+                lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+class Gauge:
+    # read when /metrics is scraped: collect() returns {(label values): value}
+
+    def __init__(self, name, help, labels, collect):
+        self.name = name
+        self.help = help
+        self.labels = ('service',) + tuple(labels)
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{{{_labels(self.labels, (service,) + tuple(key))}}} {value}")
+        return lines
+
+
+REQUESTS = Counter('http_requests_total', "Requests served.", ('route', 'method', 'status'))
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', "Time to serve a request.", ('route', 'method'))
+ERRORS = Counter('http_request_errors_total', "Requests that failed with a 5xx or an exception.", ('route', 'method'))
+SPAN_SECONDS = Histogram('span_duration_seconds', "Time spent in one stage of a request.", ('span', 'target'))
+CACHE = Counter('cache_requests_total', "Front cache lookups by result.", ('result',))
+METRICS = [REQUESTS, REQUEST_SECONDS, ERRORS, SPAN_SECONDS, CACHE]
+
+slow_traces = deque(maxlen=100)
+
+
+def register(metric):
+    METRICS.append(metric)
+    return metric
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class Trace:
+
+    def __init__(self, trace_id=None):
+        self.id = trace_id or uuid.uuid4().hex[:16]
+        self.start = time.perf_counter()
+        self.spans = []
+
+
+def current_trace_id():
+    trace = _current.get()
+    return trace.id if trace else None
+
+
+def trace_headers(headers=None):
+    # headers for a call to another service, carrying the current trace id
+    headers = dict(headers or {})
+    trace_id = current_trace_id()
+    if trace_id:
+        headers.setdefault(TRACE_HEADER, trace_id)
+    return headers
+
+
+@contextmanager
+def span(name, target=''):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        SPAN_SECONDS.observe(elapsed, span=name, target=target)
+        trace = _current.get()
+        if trace is not None:
+            trace.spans.append((name, target, start - trace.start, elapsed))
+
+
+def begin_request(trace_id=None):
+    trace = Trace(trace_id)
+    return trace, _current.set(trace)
+
+
+def end_request(trace, token, route, method, status, error=None):
+    elapsed = time.perf_counter() - trace.start
+    REQUESTS.inc(route=route, method=method, status=status)
+    REQUEST_SECONDS.observe(elapsed, route=route, method=method)
+    if error is not None or status >= 500:
+        ERRORS.inc(route=route, method=method)
+    if elapsed >= SLOW_SECONDS:
+        record = {"trace_id": trace.id, "service": service, "route": route, "method": method, "status": status,
+                  "ms": round(elapsed * 1000, 3), "spans": [
+                      {"span": name, "target": target, "at_ms": round(at * 1000, 3), "ms": round(took * 1000, 3)}
+                      for name, target, at, took in trace.spans]}
+        slow_traces.append(record)
+        print(json.dumps(record), file=sys.stderr)
+    _current.reset(token)
+
+
+def server_timing(trace):
+    return ', '.join(f'{name};desc="{target}";dur={took * 1000:.3f}' if target else f'{name};dur={took * 1000:.3f}'
+                     for name, target, _, took in trace.spans)
+
+
+def target_name(path_or_url):
+    # replica label: the database file name or the service address
+    return path_or_url.rsplit('/', 1)[-1] if '://' not in path_or_url else path_or_url.split('://', 1)[1]
+
+
+def instrument(app, name):
+    # request metrics and tracing for a Flask app, GET /metrics and GET /stats/traces
+    from flask import Response, g, jsonify, request
+
+    global service
+    service = name
+    register(Gauge('db_pool_connections', "Pooled SQLite connections by state.", ('target', 'state'), lambda: {
+        (target_name(pool['path']), state): pool[state] for pool in pool_stats() for state in ('in_use', 'idle')}))
+
+    @app.before_request
+    def start_trace():
+        g.trace, g.trace_token = begin_request(request.headers.get(TRACE_HEADER))
+
+    @app.after_request
+    def finish_trace(response):
+        if 'trace' in g:
+            g.trace_status = response.status_code
+            response.headers[TRACE_HEADER] = g.trace.id
+            if g.trace.spans:
+                response.headers['Server-Timing'] = server_timing(g.trace)
+        return response
+
+    @app.teardown_request
+    def record_request(error):
+        if 'trace' not in g:
+            return
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        end_request(g.pop('trace'), g.pop('trace_token'), route, request.method,
+                    g.pop('trace_status', 500), error)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/stats/traces', methods=['GET'])
+    def traces():
+        return jsonify(list(slow_traces)), 200
+
+    return app
@@ -0,0 +1,64 @@
+import sqlite3
+
+from common.anti_entropy import create_catalog_anti_entropy, create_order_anti_entropy
+from common.catalog_snapshot import create_change_log
+from common.idempotency import create_purchase_keys
+from common.order_rollups import create_order_rollups, drop_replace_trigger
+from common.topic_search import create_topic_search
+
+# Startup schema bootstrap for the catalog, order and idempotency key
+# databases. Each file records the last migration it ran in PRAGMA
+# user_version; migrate() switches the file to WAL and applies whatever is
+# missing in one transaction, so every service can call it on start and only
+# the first one does any work.
+
+
+def add_order_indexes(connection):
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_orders_book_id ON orders(book_id)")
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_orders_order_date ON orders(order_date)")
+
+
+MIGRATIONS = {
+    'catalog': [
+        (1, "topic index and FTS5 topic search", create_topic_search),
+        (2, "book_changes history for catalog snapshots", create_change_log),
+        (3, "anti-entropy checksum tree for books", create_catalog_anti_entropy),
+    ],
+    'order': [
+        (1, "orders(book_id) and orders(order_date) indexes", add_order_indexes),
+        (2, "order sales rollups kept by triggers", create_order_rollups),
+        (3, "anti-entropy checksum tree for orders", create_order_anti_entropy),
+        (4, "order rollups without the BEFORE INSERT replace trigger", drop_replace_trigger),
+    ],
+    # the purchase idempotency keys of the front server and of each shard's order services
+    'idempotency': [
+        (1, "purchase_keys table", create_purchase_keys),
+    ],
+}
+
+
+def schema_version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(path, kind, journal_mode='wal'):
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        # the journal mode is stored in the file, so this only has to happen once
+        if connection.execute("PRAGMA journal_mode").fetchone()[0] != journal_mode:
+            connection.execute(f"PRAGMA journal_mode = {journal_mode}")
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            current = schema_version(connection)
+            for version, description, apply in MIGRATIONS[kind]:
+                if version > current:
+                    apply(connection)
+                    connection.execute(f"PRAGMA user_version = {version}")
+                    print(f"migrated {path} to version {version}: {description}")
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        return schema_version(connection)
+    finally:
+        connection.close()
@@ -0,0 +1,213 @@
+# Sales totals for the order analytics endpoints, kept up to date by triggers
+# on orders instead of being recomputed from the whole table:
+#
+#   order_sales_by_book   book_id -> orders, quantity (top sellers, per book)
+#   order_sales_by_day    (day, book_id) -> orders, quantity
+#   order_sales_by_hour   hour -> orders, quantity
+#
+# A day is the first 10 characters of order_date (2024-11-18) and an hour the
+# first 13 (2024-11-18 11). Every insert, delete and update of an order
+# adjusts the three tables in the same transaction, on every replica,
+# including the rows that replication logs and common/rebalance.py write.
+# The INSERT OR REPLACE the replication log replays only fires the delete
+# trigger for the row it replaces with PRAGMA recursive_triggers on, which
+# common.db_pool.open_connection and the replication shipper set; other
+# connections writing orders that way must set it too. To recompute the
+# tables from orders, e.g. after restoring a file from a copy made before
+# they existed or after writing to it without the pragma:
+#
+#   python common/order_rollups.py order/order-1/order1.db order/order-2/order2.db
+import argparse
+import os
+import re
+import sys
+import time
+from contextlib import closing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common.db_pool import open_connection
+
+BUCKETS = {'day': 10, 'hour': 13}
+BOUND = re.compile(r'\d{4}(-\d{2}(-\d{2}([ T]\d{2})?)?)?')
+
+
+def _adjust(row, sign):
+    # statements adding (sign 1) or taking out (sign -1) the order `row`;
+    # the WHERE keeps SQLite from reading ON CONFLICT as a join constraint
+    return f"""
+        INSERT INTO order_sales_by_book (book_id, orders, quantity)
+            SELECT {row}.book_id, {sign}, {sign} * {row}.quantity WHERE true
+            ON CONFLICT (book_id) DO UPDATE SET orders = orders + excluded.orders, quantity = quantity + excluded.quantity;
+        INSERT INTO order_sales_by_day (day, book_id, orders, quantity)
+            SELECT substr({row}.order_date, 1, 10), {row}.book_id, {sign}, {sign} * {row}.quantity WHERE true
+            ON CONFLICT (day, book_id) DO UPDATE SET orders = orders + excluded.orders, quantity = quantity + excluded.quantity;
+        INSERT INTO order_sales_by_hour (hour, orders, quantity)
+            SELECT substr({row}.order_date, 1, 13), {sign}, {sign} * {row}.quantity WHERE true
+            ON CONFLICT (hour) DO UPDATE SET orders = orders + excluded.orders, quantity = quantity + excluded.quantity;"""
+
+
+TABLES = [
+    """CREATE TABLE IF NOT EXISTS order_sales_by_book (
+        book_id INTEGER PRIMARY KEY,
+        orders INTEGER NOT NULL,
+        quantity INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_order_sales_by_book_quantity ON order_sales_by_book(quantity DESC, book_id)",
+    """CREATE TABLE IF NOT EXISTS order_sales_by_day (
+        day TEXT NOT NULL,
+        book_id INTEGER NOT NULL,
+        orders INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (day, book_id)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_order_sales_by_day_book ON order_sales_by_day(book_id, day)",
+    """CREATE TABLE IF NOT EXISTS order_sales_by_hour (
+        hour TEXT PRIMARY KEY,
+        orders INTEGER NOT NULL,
+        quantity INTEGER NOT NULL
+    ) WITHOUT ROWID""",
+]
+
+TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS order_sales_insert AFTER INSERT ON orders BEGIN
+        {_adjust('new', 1)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS order_sales_delete AFTER DELETE ON orders BEGIN
+        {_adjust('old', -1)}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS order_sales_update AFTER UPDATE OF book_id, order_date, quantity ON orders BEGIN
+        {_adjust('old', -1)}
+        {_adjust('new', 1)}
+    END""",
+]
+
+
+def create_order_rollups(connection):
+    # schema migration; runs inside the migrator's transaction
+    for statement in TABLES + TRIGGERS:
+        connection.execute(statement)
+    rebuild_rollups(connection)
+
+
+def drop_replace_trigger(connection):
+    # schema migration: the BEFORE INSERT trigger that stood in for the delete
+    # trigger took rows out for inserts that were then ignored or failed
+    connection.execute("DROP TRIGGER IF EXISTS order_sales_replace")
+    rebuild_rollups(connection)
+
+
+def rebuild_rollups(connection):
+    # recomputes the three tables from orders; the caller commits
+    connection.execute("DELETE FROM order_sales_by_book")
+    connection.execute("DELETE FROM order_sales_by_day")
+    connection.execute("DELETE FROM order_sales_by_hour")
+    connection.execute("INSERT INTO order_sales_by_book (book_id, orders, quantity) "
+                       "SELECT book_id, COUNT(*), SUM(quantity) FROM orders GROUP BY book_id")
+    connection.execute("INSERT INTO order_sales_by_day (day, book_id, orders, quantity) "
+                       "SELECT substr(order_date, 1, 10), book_id, COUNT(*), SUM(quantity) FROM orders GROUP BY 1, 2")
+    connection.execute("INSERT INTO order_sales_by_hour (hour, orders, quantity) "
+                       "SELECT substr(order_date, 1, 13), COUNT(*), SUM(quantity) FROM orders GROUP BY 1")
+
+
+def parse_range(args):
+    # (since, until) from the query string, each a day or hour prefix of
+    # order_date or None; ValueError for anything else
+    bounds = []
+    for name in ('since', 'until'):
+        value = args.get(name) or None
+        if value is not None and not BOUND.fullmatch(value):
+            raise ValueError(f"{name} must look like 2024-11-18 or 2024-11-18T11")
+        bounds.append(value.replace('T', ' ') if value else None)
+    return tuple(bounds)
+
+
+def _day_range(since, until):
+    # WHERE clause and parameters for an optional [since, until] range of days
+    conditions, params = [], []
+    if since:
+        conditions.append("day >= ?")
+        params.append(since[:10])
+    if until:
+        conditions.append("day <= ?")
+        params.append(until[:10])
+    return conditions, params
+
+
+def top_sellers(connection, limit=20, since=None, until=None):
+    # [(book_id, orders, quantity)] by quantity sold, over all time or a range of days
+    if not since and not until:
+        return [tuple(row) for row in connection.execute(
+            "SELECT book_id, orders, quantity FROM order_sales_by_book WHERE quantity > 0 "
+            "ORDER BY quantity DESC, book_id LIMIT ?", (limit,))]
+    conditions, params = _day_range(since, until)
+    return [tuple(row) for row in connection.execute(
+        f"SELECT book_id, SUM(orders), SUM(quantity) FROM order_sales_by_day WHERE {' AND '.join(conditions)} "
+        "GROUP BY book_id HAVING SUM(quantity) > 0 ORDER BY SUM(quantity) DESC, book_id LIMIT ?", params + [limit])]
+
+
+def book_sales(connection, book_id, since=None, until=None):
+    # {"book_id", "orders", "quantity", "days": [{"day", "orders", "quantity"}]}, or None if never ordered
+    total = connection.execute("SELECT orders, quantity FROM order_sales_by_book WHERE book_id = ?", (book_id,)).fetchone()
+    if total is None or total['orders'] == 0:
+        return None
+    conditions, params = _day_range(since, until)
+    days = connection.execute(
+        "SELECT day, orders, quantity FROM order_sales_by_day WHERE "
+        f"{' AND '.join(['book_id = ?', 'orders != 0'] + conditions)} ORDER BY day", [book_id] + params)
+    return {"book_id": book_id, "orders": total['orders'], "quantity": total['quantity'],
+            "days": [dict(row) for row in days]}
+
+
+def _hour_range(since, until, width):
+    # conditions on order_sales_by_hour for bounds cut to `width` characters;
+    # '~' sorts after every hour of a day given on its own
+    conditions, params = [], []
+    if since:
+        conditions.append("hour >= ?")
+        params.append(since[:width])
+    if until:
+        conditions.append("hour < ?")
+        params.append(until[:width] + '~')
+    return conditions, params
+
+
+def sales_by_bucket(connection, bucket='day', since=None, until=None, book_id=None):
+    # [{"bucket", "orders", "quantity"}] in time order; per book only by day
+    if book_id is not None:
+        if bucket != 'day':
+            raise ValueError("sales per hour are kept for all books together; use bucket=day for one book")
+        conditions, params = _day_range(since, until)
+        rows = connection.execute(
+            f"SELECT day, orders, quantity FROM order_sales_by_day WHERE {' AND '.join(['book_id = ?'] + conditions)} "
+            "ORDER BY day", [book_id] + params)
+    else:
+        # every book's days add up to the day's hours, a much smaller table
+        width = BUCKETS[bucket]
+        conditions, params = _hour_range(since, until, width)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        rows = connection.execute(
+            f"SELECT substr(hour, 1, {width}), SUM(orders), SUM(quantity) FROM order_sales_by_hour {where} "
+            "GROUP BY 1 ORDER BY 1", params)
+    return [{"bucket": row[0], "orders": row[1], "quantity": row[2]} for row in rows if row[1]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the order sales rollups from the orders table")
+    parser.add_argument('paths', nargs='+', help="order database files")
+    args = parser.parse_args()
+    for path in args.paths:
+        start = time.perf_counter()
+        with closing(open_connection(path)) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                rebuild_rollups(connection)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            books = connection.execute("SELECT COUNT(*) FROM order_sales_by_book").fetchone()[0]
+        print(f"{path}: rebuilt sales of {books} books in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+from itertools import chain, islice
+
+from common.serialization import dumps
+
+# Keyset pages and streamed bodies for the topic listings (/products and
+# /retrieve/topic). ?limit=N&after=ID asks for the matching books with
+# id > ID in id order, at most N of them; when more follow, the response
+# carries X-Next-After with the id to ask from next. ?format=ndjson (or
+# Accept: application/x-ndjson) writes one book per line instead of a JSON
+# array, and ?stream=1 asks for everything without a limit. Either way the
+# body is written from the rows as they are read, so neither memory nor the
+# time to the first byte grows with the catalog. Requests without any of
+# these keep the old cached, fully built responses.
+
+NDJSON = 'application/x-ndjson'
+MAX_LIMIT = 5000
+# rows are encoded and written out this many at a time
+CHUNK_ROWS = 500
+
+
+class Page:
+
+    def __init__(self, after=0, limit=None, ndjson=False):
+        self.after = after
+        self.limit = limit
+        self.ndjson = ndjson
+
+    @property
+    def content_type(self):
+        return NDJSON if self.ndjson else 'application/json'
+
+
+def _number(args, name, default):
+    value = args.get(name)
+    if value is None or value == '':
+        return default
+    if not value.isdigit():
+        raise ValueError(f"{name} must be a non-negative integer")
+    return int(value)
+
+
+def parse_page(args, headers):
+    # the Page a request asks for, or None for the old whole-list response;
+    # ValueError for a malformed one
+    output = args.get('format', '')
+    if output not in ('', 'json', 'ndjson'):
+        raise ValueError("format must be json or ndjson")
+    ndjson = output == 'ndjson' or (not output and NDJSON in headers.get('Accept', headers.get('accept', '')))
+    if not (ndjson or output or args.get('stream') or 'limit' in args or 'after' in args):
+        return None
+    limit = _number(args, 'limit', None)
+    if limit is not None and not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+    return Page(_number(args, 'after', 0), limit, ndjson)
+
+
+def paginate(rows, page):
+    # rows are (book_id, book) in id order. Returns (this page's rows, whether
+    # there are any, id to continue after or None). With a limit the page is
+    # read now, one row more than asked to know whether another page follows;
+    # without one only the first row is, so an empty result is known before
+    # the headers go out and the rest is read while the body is written.
+    rows = iter(rows)
+    if page.limit is None:
+        first = list(islice(rows, 1))
+        return chain(first, rows), bool(first), None
+    taken = list(islice(rows, page.limit + 1))
+    next_after = taken[page.limit - 1][0] if len(taken) > page.limit else None
+    return iter(taken[:page.limit]), bool(taken), next_after
+
+
+def _encode(books, ndjson):
+    # a batch of books joined by newlines or commas. Snapshot rows come
+    # encoded with the same dumps(); dicts in an array are encoded as one
+    # list, far cheaper than a call per book.
+    if isinstance(books[0], bytes):
+        encoded = books
+    elif ndjson:
+        encoded = [dumps(book) for book in books]
+    else:
+        return dumps(books)[1:-1]
+    return (b'\n' if ndjson else b',').join(encoded)
+
+
+def body(rows, ndjson=False, batch=CHUNK_ROWS):
+    # the (book_id, book) rows as a JSON array or NDJSON, `batch` books at a time
+    rows = iter(rows)
+    first = True
+    if not ndjson:
+        yield b'['
+    while True:
+        books = [book for _, book in islice(rows, batch)]
+        if not books:
+            break
+        if ndjson:
+            yield _encode(books, ndjson) + b'\n'
+        else:
+            yield (b'' if first else b',') + _encode(books, ndjson)
+        first = False
+    if not ndjson:
+        yield b']'
+
+
+def page_headers(page, next_after):
+    headers = [('Content-Type', page.content_type)]
+    if next_after is not None:
+        headers.append(('X-Next-After', str(next_after)))
+    return headers
+
+
+def page_response(page, rows, next_after):
+    # a streamed Flask response for paginate()'s rows; the request context is
+    # kept until the body is written, so request-scoped connections stay open
+    from flask import Response, stream_with_context
+    response = Response(stream_with_context(body(rows, page.ndjson)), mimetype=page.content_type)
+    for name, value in page_headers(page, next_after)[1:]:
+        response.headers[name] = value
+    return response
@@ -0,0 +1,147 @@
+# Moves books and their orders to the shards that own them under a new shard
+# file, e.g. after adding a shard:
+#
+#   python common/rebalance.py --old shards-2.json --new shards-3.json --dry-run
+#   python common/rebalance.py --new shards-2.json     # from the unsharded layout
+#
+# A shard is recognised by its primary catalog file, so the unsharded files
+# can be listed as one of the new shards. Files of new shards are created with
+# the schema of an existing one. Every replica of the receiving shard gets the
+# rows before any replica of the giving shard loses them, and the receiving
+# side first drops whatever an interrupted run left for those books, so a
+# failed run can simply be repeated. The giving shard loses the orders before
+# the books: a book still in its catalog without orders there has had them
+# moved already, and its orders on the receiving side are kept. Stop the
+# services and front servers while it runs, then start them with
+# SHARDS_CONFIG pointing at the new file.
+import argparse
+import os
+import sqlite3
+import sys
+from contextlib import closing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from common.db_pool import open_connection
+from common.migrations import migrate
+from common.sharding import default_shard, load_shards
+
+BATCH = 500
+
+
+def create_like(path, template, table):
+    # an empty database with the template's `table`, then the usual migrations
+    if not os.path.exists(path):
+        source = sqlite3.connect(template)
+        try:
+            schema = source.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()[0]
+        finally:
+            source.close()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        target = sqlite3.connect(path)
+        try:
+            target.execute(schema)
+            target.commit()
+        finally:
+            target.close()
+    migrate(path, 'catalog' if table == 'books' else 'order')
+
+
+def same_shard(shard, other):
+    return os.path.realpath(shard.catalog[0]) == os.path.realpath(other.catalog[0])
+
+
+def plan(old_map, new_map):
+    # {(giving shard, receiving shard): [book ids]} and the number of books looked at
+    moves = {}
+    total = 0
+    for shard in old_map.shards:
+        with closing(open_connection(shard.catalog[0])) as connection:
+            for (book_id,) in connection.execute("SELECT id FROM books ORDER BY id"):
+                total += 1
+                owner = new_map.shard_for(book_id)
+                if not same_shard(shard, owner):
+                    moves.setdefault((shard.name, owner.name), []).append(book_id)
+    return moves, total
+
+
+def write(path, statements):
+    # [(sql, params tuple or list of rows)] in one transaction
+    with closing(open_connection(path)) as connection, connection:
+        for sql, params in statements:
+            if isinstance(params, list):
+                connection.executemany(sql, params)
+            else:
+                connection.execute(sql, params)
+
+
+def move(source, target, book_ids):
+    # copies the books and their orders from `source`'s primaries to every
+    # replica of `target`, then deletes them from every replica of `source`
+    moved_orders = 0
+    for start in range(0, len(book_ids), BATCH):
+        ids = tuple(book_ids[start:start + BATCH])
+        in_ids = f"IN ({','.join('?' * len(ids))})"
+        with closing(open_connection(source.catalog[0])) as catalog:
+            books = [tuple(row) for row in catalog.execute(
+                f"SELECT id, title, quantity, price, topic FROM books WHERE id {in_ids}", ids)]
+        with closing(open_connection(source.order[0])) as orders:
+            order_rows = [tuple(row) for row in orders.execute(
+                f"SELECT book_id, order_date, quantity FROM orders WHERE book_id {in_ids} ORDER BY id", ids)]
+
+        # a DELETE and an INSERT, not INSERT OR REPLACE: a REPLACE removes the
+        # old row without running the delete triggers that topic search and
+        # the change logs rely on (and an upsert makes the INSERT OR IGNOREs
+        # of the anti-entropy triggers fail)
+        for path in target.catalog:
+            write(path, [(f"DELETE FROM books WHERE id {in_ids}", ids),
+                         ("INSERT INTO books (id, title, quantity, price, topic) VALUES (?, ?, ?, ?, ?)", books)])
+        ordered = tuple(sorted({row[0] for row in order_rows}))
+        if ordered:
+            in_ordered = f"IN ({','.join('?' * len(ordered))})"
+            for path in target.order:
+                write(path, [(f"DELETE FROM orders WHERE book_id {in_ordered}", ordered),
+                             ("INSERT INTO orders (book_id, order_date, quantity) VALUES (?, ?, ?)", order_rows)])
+
+        for path in source.order:
+            write(path, [(f"DELETE FROM orders WHERE book_id {in_ids}", ids)])
+        for path in source.catalog:
+            write(path, [(f"DELETE FROM books WHERE id {in_ids}", ids)])
+        moved_orders += len(order_rows)
+    return moved_orders
+
+
+def rebalance(old_map, new_map, dry_run=False):
+    template = old_map.shards[0]
+    if not dry_run:
+        for shard in new_map.shards:
+            for path in shard.catalog:
+                create_like(path, template.catalog[0], 'books')
+            for path in shard.order:
+                create_like(path, template.order[0], 'orders')
+
+    moves, total = plan(old_map, new_map)
+    moved = sum(len(ids) for ids in moves.values())
+    for (source, target), book_ids in sorted(moves.items()):
+        if dry_run:
+            print(f"{source} -> {target}: {len(book_ids)} books")
+            continue
+        orders = move(old_map.by_name[source], new_map.by_name[target], book_ids)
+        print(f"{source} -> {target}: {len(book_ids)} books, {orders} orders")
+    print(f"{'would move' if dry_run else 'moved'} {moved} of {total} books")
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--old', default='', help="shard file in use now; the unsharded layout without one")
+    parser.add_argument('--new', required=True, help="shard file to move to")
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    old_map = load_shards(args.old, default_shard())
+    new_map = load_shards(args.new, default_shard())
+    rebalance(old_map, new_map, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+def connect(path):
+    # the replayed INSERT OR REPLACEs have to fire the delete triggers of the
+    # rows they replace (common/order_rollups.py)
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute("PRAGMA recursive_triggers = ON")
+    return connection
+
+
+class ReplicationLog:
+    # Primary/backup replication for one set of replica files. Writers commit on
+    # the primary and append the row image they wrote to replication_log in the
+    # same transaction; a shipper thread replays the log on each backup in
+    # batches and records how far it got in the backup's replication_state.
+
+    def __init__(self, primary, backups, batch_size=200, interval=0.05):
+        self.primary = primary
+        self.backups = list(backups)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.local = threading.local()
+        self._thread = None
+        self._create_tables()
+
+    def _create_tables(self):
+        connection = connect(self.primary)
+        with connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS replication_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                statement TEXT NOT NULL,
+                params TEXT NOT NULL)""")
+        connection.close()
+        for backup in self.backups:
+            connection = connect(backup)
+            with connection:
+                connection.execute("""CREATE TABLE IF NOT EXISTS replication_state (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    applied_seq INTEGER NOT NULL)""")
+                connection.execute("INSERT OR IGNORE INTO replication_state (id, applied_seq) VALUES (0, 0)")
+            connection.close()
+
+    def append(self, connection, statement, params):
+        # must run inside the caller's transaction on the primary; statement has
+        # to be idempotent (absolute values, explicit ids) so a replay is safe
+        cursor = connection.execute("INSERT INTO replication_log (statement, params) VALUES (?, ?)",
+                                    (statement, json.dumps(params, default=str)))
+        self.local.last_seq = cursor.lastrowid
+        return cursor.lastrowid
+
+    def last_seq(self):
+        # sequence number of the last entry this thread appended
+        return getattr(self.local, 'last_seq', 0)
+
+    def head(self, connection=None):
+        own = connection is None
+        connection = connection or connect(self.primary)
+        try:
+            return connection.execute("SELECT COALESCE(MAX(seq), 0) FROM replication_log").fetchone()[0]
+        finally:
+            if own:
+                connection.close()
+
+    def applied_seq(self, backup, connection=None):
+        own = connection is None
+        connection = connection or connect(backup)
+        try:
+            return connection.execute("SELECT applied_seq FROM replication_state WHERE id=0").fetchone()[0]
+        finally:
+            if own:
+                connection.close()
+
+    def is_caught_up(self, replica, min_seq, connection=None):
+        if not min_seq or replica == self.primary:
+            return True
+        return self.applied_seq(replica, connection) >= min_seq
+
+    def ship(self, primary_connection, backup_connection):
+        backup_connection.execute("BEGIN IMMEDIATE")
+        try:
+            applied = backup_connection.execute(
+                "SELECT applied_seq FROM replication_state WHERE id=0").fetchone()[0]
+            entries = primary_connection.execute(
+                "SELECT seq, statement, params FROM replication_log WHERE seq > ? ORDER BY seq LIMIT ?",
+                (applied, self.batch_size)).fetchall()
+            for seq, statement, params in entries:
+                backup_connection.execute(statement, json.loads(params))
+            if entries:
+                backup_connection.execute("UPDATE replication_state SET applied_seq=? WHERE id=0", (entries[-1][0],))
+            backup_connection.commit()
+        except Exception:
+            backup_connection.rollback()
+            raise
+        return len(entries)
+
+    def catch_up(self, backup):
+        # replays everything the backup is missing, e.g. after it was down
+        primary_connection = connect(self.primary)
+        backup_connection = connect(backup)
+        try:
+            total = 0
+            while True:
+                shipped = self.ship(primary_connection, backup_connection)
+                if not shipped:
+                    return total
+                total += shipped
+        finally:
+            primary_connection.close()
+            backup_connection.close()
+
+    def prune(self, primary_connection):
+        # drop entries every backup has applied
+        applied = min(self.applied_seq(backup) for backup in self.backups)
+        with primary_connection:
+            primary_connection.execute("DELETE FROM replication_log WHERE seq <= ?", (applied,))
+
+    def lag(self):
+        head = self.head()
+        return {backup: head - self.applied_seq(backup) for backup in self.backups}
+
+    def _run(self):
+        primary_connection = connect(self.primary)
+        backup_connections = {}
+        rounds = 0
+        while True:
+            shipped = 0
+            for backup in self.backups:
+                try:
+                    if backup not in backup_connections:
+                        backup_connections[backup] = connect(backup)
+                    shipped += self.ship(primary_connection, backup_connections[backup])
+                except sqlite3.Error as error:
+                    # the backup stays behind until it is reachable again
+                    print(f"replication to {backup} failed: {error}")
+                    backup_connections.pop(backup, None)
+            rounds += 1
+            if rounds % 1000 == 0:
+                try:
+                    self.prune(primary_connection)
+                except sqlite3.Error:
+                    pass
+            if not shipped:
+                time.sleep(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
@@ -0,0 +1,134 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON bodies for the catalog reads of the front and the catalog services.
+# dumps() writes compact, key-sorted JSON straight to bytes, with orjson when
+# it is installed and the json module otherwise. A body is encoded once, when
+# it is cached, and sent as it is from then on. It carries an ETag and the
+# time it was built, so a client polling a book or a topic list gets 304
+# with no body until it changes. Clients that accept gzip get bodies of at
+# least `gzip_min_bytes` compressed, once per version of the body.
+
+GZIP_LEVEL = 6
+# compressed bodies kept, counting the plain and the compressed bytes
+GZIP_CACHE_BYTES = 32 * 1024 * 1024
+# appended to the ETag of a gzipped body
+GZIP_TAG_SUFFIX = '-gz'
+
+_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return _encoder.encode(value).encode()
+
+
+def loads(body):
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+def content_tag(body):
+    # an ETag for a body whose row versions are not known
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+class Encoded:
+    # a JSON body with its validators; without an ETag the content is hashed
+
+    __slots__ = ('body', 'etag', 'modified')
+
+    def __init__(self, body, etag=None, modified=None):
+        self.body = body
+        self.etag = etag or content_tag(body)
+        self.modified = time.time() if modified is None else modified
+
+
+_gzip_cache = OrderedDict()
+_gzip_bytes = 0
+_gzip_lock = threading.Lock()
+
+
+def gzipped(body):
+    # the compressed body; the same bytes are compressed once while they stay in the cache
+    global _gzip_bytes
+    with _gzip_lock:
+        compressed = _gzip_cache.get(body)
+        if compressed is not None:
+            _gzip_cache.move_to_end(body)
+            return compressed
+    compressed = gzip.compress(body, GZIP_LEVEL)
+    with _gzip_lock:
+        if body not in _gzip_cache:
+            _gzip_cache[body] = compressed
+            _gzip_bytes += len(body) + len(compressed)
+        while _gzip_bytes > GZIP_CACHE_BYTES and len(_gzip_cache) > 1:
+            old_body, old_compressed = _gzip_cache.popitem(last=False)
+            _gzip_bytes -= len(old_body) + len(old_compressed)
+    return compressed
+
+
+def _header(headers, name):
+    # Flask headers are case-insensitive, the asgi server's are lower case
+    return headers.get(name, headers.get(name.lower()))
+
+
+def gzip_tag(etag):
+    # the compressed body is another representation and needs its own strong ETag
+    return etag[:-1] + GZIP_TAG_SUFFIX + '"'
+
+
+def _plain_tag(tag):
+    # the plain body's ETag for either representation's
+    tag = tag[2:] if tag.startswith('W/') else tag
+    return tag[:-len(GZIP_TAG_SUFFIX) - 1] + '"' if tag.endswith(GZIP_TAG_SUFFIX + '"') else tag
+
+
+def not_modified(headers, encoded):
+    # If-None-Match wins over If-Modified-Since when a client sends both; a
+    # tag of either encoding matches, the body is the same
+    if_none_match = _header(headers, 'If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or encoded.etag in [_plain_tag(tag) for tag in tags]
+    if_modified_since = _header(headers, 'If-Modified-Since')
+    if if_modified_since:
+        try:
+            return int(encoded.modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def encoded_response(encoded, headers, gzip_min_bytes=0):
+    # (status, headers, body) answering a GET with these request headers;
+    # gzip_min_bytes 0 never compresses
+    compress = (gzip_min_bytes and len(encoded.body) >= gzip_min_bytes
+                and 'gzip' in (_header(headers, 'Accept-Encoding') or ''))
+    validators = [('ETag', gzip_tag(encoded.etag) if compress else encoded.etag),
+                  ('Last-Modified', formatdate(encoded.modified, usegmt=True))]
+    if gzip_min_bytes:
+        validators.append(('Vary', 'Accept-Encoding'))
+    if not_modified(headers, encoded):
+        return 304, validators, b''
+    response_headers = [('Content-Type', 'application/json')] + validators
+    if not compress:
+        return 200, response_headers, encoded.body
+    response_headers.append(('Content-Encoding', 'gzip'))
+    return 200, response_headers, gzipped(encoded.body)
+
+
+def flask_response(encoded, gzip_min_bytes=0):
+    from flask import Response, request
+    status, headers, body = encoded_response(encoded, request.headers, gzip_min_bytes)
+    return Response(body, status, headers)
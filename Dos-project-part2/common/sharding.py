@@ -0,0 +1,105 @@
+import bisect
+import hashlib
+import json
+import os
+
+# Splits the books (and their orders) over several shards, each with its own
+# replica set, so purchases on different shards never wait for the same
+# SQLite write lock. Book ids are placed on a consistent hash ring with
+# `vnodes` points per shard: adding a shard only moves the ids that land on
+# its points, about 1/N of them, and common/rebalance.py moves those rows.
+#
+# The shard file (SHARDS_CONFIG), relative paths are taken from its folder:
+#   {"vnodes": 64,
+#    "shards": [{"name": "shard-a",
+#                "catalog": ["a/catalog1.db", "a/catalog2.db"],
+#                "order": ["a/order1.db", "a/order2.db"],
+#                "catalog_services": ["http://127.0.0.1:6001", ...],
+#                "order_services": ["http://127.0.0.1:7001", ...]}, ...]}
+# The first catalog and order file of a shard are its primaries.
+
+DEFAULT_VNODES = 64
+ROOT = os.path.normpath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class Shard:
+
+    def __init__(self, name, catalog, order, catalog_services=(), order_services=()):
+        self.name = name
+        self.catalog = list(catalog)
+        self.order = list(order)
+        self.catalog_services = list(catalog_services)
+        self.order_services = list(order_services)
+
+    def as_dict(self):
+        return {"name": self.name, "catalog": self.catalog, "order": self.order,
+                "catalog_services": self.catalog_services, "order_services": self.order_services}
+
+
+class HashRing:
+
+    def __init__(self, names, vnodes=DEFAULT_VNODES):
+        if not names:
+            raise ValueError("a hash ring needs at least one shard")
+        points = sorted((_hash(f'{name}#{index}'), name) for name in names for index in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def owner(self, book_id):
+        index = bisect.bisect(self._hashes, _hash(str(int(book_id))))
+        return self._names[index % len(self._names)]
+
+
+class ShardMap:
+
+    def __init__(self, shards, vnodes=DEFAULT_VNODES):
+        names = [shard.name for shard in shards]
+        if len(set(names)) != len(names):
+            raise ValueError(f"shard names must be unique: {names}")
+        self.shards = list(shards)
+        self.vnodes = vnodes
+        self.by_name = {shard.name: shard for shard in shards}
+        self.ring = HashRing(names, vnodes)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def shard_for(self, book_id):
+        if len(self.shards) == 1:
+            return self.shards[0]
+        return self.by_name[self.ring.owner(book_id)]
+
+    def split(self, cart):
+        # [(book_id, quantity)] -> [(shard, sub-cart)], in shard order
+        carts = {}
+        for book_id, quantity in cart:
+            carts.setdefault(self.shard_for(book_id).name, []).append((book_id, quantity))
+        return [(shard, carts[shard.name]) for shard in self.shards if shard.name in carts]
+
+    def as_dict(self):
+        return {"vnodes": self.vnodes, "shards": [shard.as_dict() for shard in self.shards]}
+
+
+def default_shard(catalog_services=(), order_services=()):
+    # the two catalog and two order replicas every service uses without SHARDS_CONFIG
+    return Shard('default', [os.path.join(ROOT, 'catalog/catalog-1/catalog1.db'), os.path.join(ROOT, 'catalog/catalog-2/catalog2.db')],
+                 [os.path.join(ROOT, 'order/order-1/order1.db'), os.path.join(ROOT, 'order/order-2/order2.db')],
+                 catalog_services, order_services)
+
+
+def load_shards(path, default):
+    # the ShardMap described by the file at `path`, or just `default` without one
+    if not path:
+        return ShardMap([default])
+    with open(path) as source:
+        config = json.load(source)
+    base = os.path.dirname(os.path.abspath(path))
+    resolve = lambda paths: [os.path.normpath(os.path.join(base, item)) for item in paths]
+    shards = [Shard(entry['name'], resolve(entry['catalog']), resolve(entry['order']),
+                    entry.get('catalog_services', ()), entry.get('order_services', ()))
+              for entry in config['shards']]
+    return ShardMap(shards, config.get('vnodes', DEFAULT_VNODES))
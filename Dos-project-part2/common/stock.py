@@ -0,0 +1,146 @@
+from datetime import datetime
+
+PURCHASED = 'purchased'
+OUT_OF_STOCK = 'out_of_stock'
+NOT_FOUND = 'not_found'
+
+# the updated row as SELECT * gives it; SQLite 3.40's RETURNING hands back
+# a REAL column holding a whole number as an integer
+BOOK_COLUMNS = "id, title, quantity, CAST(price AS REAL) AS price, topic"
+
+
+def decrement_stock(connection, book_id, quantity=1, log=None):
+    # one conditional UPDATE inside an IMMEDIATE transaction: the write lock is
+    # taken up front and the stock check and decrement cannot be interleaved.
+    # With a ReplicationLog the new quantity is logged in the same transaction.
+    # Returns (status, updated_row).
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = connection.execute(
+            f"UPDATE books SET quantity = quantity - ? WHERE id=? AND quantity >= ? RETURNING {BOOK_COLUMNS}",
+            (quantity, book_id, quantity))
+        book = cursor.fetchone()
+        cursor.close()
+        if book is not None:
+            if log is not None:
+                log.append(connection, "UPDATE books SET quantity=? WHERE id=?", (book['quantity'], book_id))
+            connection.commit()
+            return PURCHASED, book
+        exists = connection.execute("SELECT 1 FROM books WHERE id=?", (book_id,)).fetchone()
+        connection.rollback()
+    except Exception:
+        connection.rollback()
+        raise
+    return (OUT_OF_STOCK if exists else NOT_FOUND), None
+
+
+def insert_order(connection, book_id, quantity=1, log=None):
+    order_date = datetime.now()
+    with connection:
+        cursor = connection.execute("INSERT INTO orders (book_id, order_date, quantity) VALUES (?, ?, ?)",
+                                    (book_id, order_date, quantity))
+        if log is not None:
+            log.append(connection, "INSERT OR REPLACE INTO orders (id, book_id, order_date, quantity) VALUES (?, ?, ?, ?)",
+                       (cursor.lastrowid, book_id, order_date, quantity))
+    return cursor.lastrowid
+
+
+def parse_cart(data, max_items=500):
+    # {"items": [{"book_id": 1, "quantity": 2}, ...]} -> [(book_id, quantity)]
+    # with repeated books merged; raises ValueError with a client-facing message
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError("Expected a non-empty 'items' list")
+    if len(items) > max_items:
+        raise ValueError(f"A cart can hold at most {max_items} items")
+    cart = {}
+    for item in items:
+        try:
+            book_id = int(item['book_id'])
+            quantity = int(item.get('quantity', 1))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ValueError("Each item needs a numeric 'book_id' and 'quantity'")
+        if quantity < 1:
+            raise ValueError("Quantities must be positive")
+        cart[book_id] = cart.get(book_id, 0) + quantity
+    return list(cart.items())
+
+
+def decrement_stock_batch(connection, cart, log=None):
+    # all-or-nothing version of decrement_stock for a whole cart in one
+    # transaction. Returns (status, failed_book_id, updated_rows).
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        books = []
+        for book_id, quantity in cart:
+            book = connection.execute(
+                f"UPDATE books SET quantity = quantity - ? WHERE id=? AND quantity >= ? RETURNING {BOOK_COLUMNS}",
+                (quantity, book_id, quantity)).fetchone()
+            if book is None:
+                exists = connection.execute("SELECT 1 FROM books WHERE id=?", (book_id,)).fetchone()
+                connection.rollback()
+                return (OUT_OF_STOCK if exists else NOT_FOUND), book_id, []
+            books.append(book)
+        if log is not None:
+            for book in books:
+                log.append(connection, "UPDATE books SET quantity=? WHERE id=?", (book['quantity'], book['id']))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    return PURCHASED, None, books
+
+
+def restock_batch(connection, cart, log=None):
+    # undoes decrement_stock_batch on a replica when a later replica (or a
+    # later shard) refused the cart; on a primary the new quantities are logged
+    with connection:
+        if log is None:
+            connection.executemany("UPDATE books SET quantity = quantity + ? WHERE id=?",
+                                   [(quantity, book_id) for book_id, quantity in cart])
+            return
+        for book_id, quantity in cart:
+            book = connection.execute("UPDATE books SET quantity = quantity + ? WHERE id=? RETURNING quantity",
+                                      (quantity, book_id)).fetchone()
+            if book is not None:
+                log.append(connection, "UPDATE books SET quantity=? WHERE id=?", (book[0], book_id))
+
+
+def insert_orders(connection, cart, log=None):
+    # one transaction and one executemany for every order row of the cart
+    order_date = datetime.now()
+    return insert_order_rows(connection, [(book_id, order_date, quantity) for book_id, quantity in cart], log)
+
+
+def insert_order_rows(connection, rows, log=None):
+    # rows are (book_id, order_date, quantity); ids are taken under the write
+    # lock so they can be logged for the backups. Returns the new order ids.
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        next_id = connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM orders").fetchone()[0]
+        rows = [(next_id + offset,) + tuple(row) for offset, row in enumerate(rows)]
+        connection.executemany("INSERT INTO orders (id, book_id, order_date, quantity) VALUES (?, ?, ?, ?)", rows)
+        if log is not None:
+            for row in rows:
+                log.append(connection, "INSERT OR REPLACE INTO orders (id, book_id, order_date, quantity) VALUES (?, ?, ?, ?)", row)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    return [row[0] for row in rows]
+
+
+def delete_orders(connection, order_ids, log=None):
+    # takes back order rows of a purchase that could not be recorded everywhere
+    with connection:
+        connection.executemany("DELETE FROM orders WHERE id=?", [(order_id,) for order_id in order_ids])
+        if log is not None:
+            for order_id in order_ids:
+                log.append(connection, "DELETE FROM orders WHERE id=?", (order_id,))
+
+
+def top_books(connection, limit=20, recent=10000):
+    # the most ordered books among the last `recent` orders: [(book_id, quantity)]
+    return [tuple(row) for row in connection.execute(
+        "SELECT book_id, SUM(quantity) FROM (SELECT book_id, quantity FROM orders ORDER BY id DESC LIMIT ?) "
+        "GROUP BY book_id ORDER BY SUM(quantity) DESC, book_id LIMIT ?", (recent, limit))]
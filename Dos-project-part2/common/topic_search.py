@@ -0,0 +1,64 @@
+import sqlite3
+
+# substring search over books.topic. Exact lookups use idx_books_topic; substring
+# lookups go through an FTS5 trigram table kept in sync with books by triggers.
+# Queries shorter than a trigram, or databases without FTS5, fall back to LIKE.
+
+SCHEMA = [
+    "CREATE INDEX IF NOT EXISTS idx_books_topic ON books(topic COLLATE NOCASE)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS books_topic_fts USING fts5("
+    "topic, content='books', content_rowid='id', tokenize='trigram')",
+    """CREATE TRIGGER IF NOT EXISTS books_topic_fts_insert AFTER INSERT ON books BEGIN
+        INSERT INTO books_topic_fts(rowid, topic) VALUES (new.id, new.topic);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_topic_fts_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_topic_fts(books_topic_fts, rowid, topic) VALUES ('delete', old.id, old.topic);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_topic_fts_update AFTER UPDATE OF id, topic ON books BEGIN
+        INSERT INTO books_topic_fts(books_topic_fts, rowid, topic) VALUES ('delete', old.id, old.topic);
+        INSERT INTO books_topic_fts(rowid, topic) VALUES (new.id, new.topic);
+    END""",
+]
+
+MATCH_MODES = ('substring', 'exact')
+
+
+def create_topic_search(connection):
+    # schema migration; runs inside the migrator's transaction
+    connection.execute(SCHEMA[0])
+    connection.execute("SAVEPOINT topic_fts")
+    try:
+        for statement in SCHEMA[1:]:
+            connection.execute(statement)
+        connection.execute("INSERT INTO books_topic_fts(books_topic_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError as error:
+        # no FTS5 in this SQLite build: keep the index, search with LIKE
+        connection.execute("ROLLBACK TO topic_fts")
+        print(f"topic search without FTS5: {error}")
+    connection.execute("RELEASE topic_fts")
+
+
+def has_fts(connection):
+    return connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE name='books_topic_fts'").fetchone() is not None
+
+
+def iter_books(connection, topic, match='substring', after=0, limit=-1):
+    # the matching books with id > after in id order, as an open cursor;
+    # limit -1 is no limit
+    if topic.lower() == 'all':
+        return connection.execute("SELECT * FROM books WHERE id > ? ORDER BY id LIMIT ?", (after, limit))
+    if match == 'exact':
+        return connection.execute(
+            "SELECT * FROM books WHERE topic = ? COLLATE NOCASE AND id > ? ORDER BY id LIMIT ?", (topic, after, limit))
+    if len(topic) >= 3 and has_fts(connection):
+        phrase = '"' + topic.replace('"', '""') + '"'
+        return connection.execute(
+            "SELECT books.* FROM books_topic_fts JOIN books ON books.id = books_topic_fts.rowid "
+            "WHERE books_topic_fts MATCH ? AND books.id > ? ORDER BY books.id LIMIT ?", (phrase, after, limit))
+    return connection.execute(
+        "SELECT * FROM books WHERE topic LIKE ? AND id > ? ORDER BY id LIMIT ?", ('%' + topic + '%', after, limit))
+
+
+def search_books(connection, topic, match='substring'):
+    return iter_books(connection, topic, match).fetchall()
@@ -0,0 +1,195 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+
+from common.metrics import Counter, Gauge, register
+
+# Admission control for the front server. The routes that do real work are
+# sorted into classes, cheap product reads and purchases, and each class lets
+# at most `limit` requests run at once. The next `queue` wait their turn in
+# arrival order for at most `max_wait` seconds; anything past that is turned
+# away at once with 503 and Retry-After instead of piling onto the SQLite
+# write locks. The classes do not share slots, so a purchase burst fills the
+# purchase queue and leaves the reads alone. Other routes (stats, cache
+# invalidations from the services) are never held back.
+#
+# The limit follows the latency the class sees: every `window` completions,
+# if their average time was above the target the limit is cut by a quarter,
+# and if the class used its whole limit and stayed under the target it grows
+# by one, between 1 and four times the configured limit.
+
+SHED = register(Counter('admission_shed_total', "Requests turned away by admission control.",
+                        ('route_class', 'reason')))
+
+
+class Rejected(Exception):
+
+    def __init__(self, route_class, reason, retry_after):
+        super().__init__(f"{route_class} requests are over capacity ({reason})")
+        self.route_class = route_class
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    # a queued request; release() hands it a slot and calls wake()
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+class RouteClass:
+
+    def __init__(self, name, limit, queue, target_ms, max_wait=1.0, window=None):
+        self.name = name
+        self.limit = limit
+        self.min_limit = 1
+        self.max_limit = limit * 4
+        self.queue = queue
+        self.target = target_ms / 1000
+        self.max_wait = max_wait
+        self.window = window or max(limit, 16)
+        self.in_flight = 0
+        self.waiting = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.shed = {'queue_full': 0, 'timeout': 0}
+        self.max_queue_depth = 0
+        self.limit_changes = 0
+        self._lock = threading.Lock()
+        self._samples = 0
+        self._sample_seconds = 0.0
+        self._saturated = False
+        self._average = 0.0
+
+    def _enter(self, wake):
+        # a slot now (None), a place in the queue (the waiter), or Rejected
+        with self._lock:
+            if self.in_flight < self.limit and not self.waiting:
+                self.in_flight += 1
+                self.admitted += 1
+                if self.in_flight == self.limit:
+                    self._saturated = True
+                return None
+            self._saturated = True
+            if len(self.waiting) >= self.queue:
+                self.shed['queue_full'] += 1
+                raise self._rejected('queue_full')
+            waiter = _Waiter(wake)
+            self.waiting.append(waiter)
+            self.queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self.waiting))
+            return waiter
+
+    def _leave(self, waiter, reason=None):
+        # the waiter stops waiting: False if release() gave it a slot just
+        # before, else it leaves the queue and Rejected is raised for `reason`
+        with self._lock:
+            if waiter.granted:
+                return False
+            self.waiting.remove(waiter)
+            if reason:
+                self.shed[reason] += 1
+                raise self._rejected(reason)
+            return True
+
+    def _rejected(self, reason):
+        # called with the lock held
+        SHED.inc(route_class=self.name, reason=reason)
+        seconds = (len(self.waiting) + 1) * (self._average or self.target) / self.limit
+        return Rejected(self.name, reason, min(30, max(1, math.ceil(seconds))))
+
+    def acquire(self):
+        # blocks a request thread until it may run; returns the start time for release()
+        event = threading.Event()
+        waiter = self._enter(event.set)
+        if waiter is not None and not event.wait(self.max_wait):
+            self._leave(waiter, 'timeout')
+        return time.perf_counter()
+
+    async def acquire_async(self):
+        # the same on an event loop; release() may run in any thread
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = self._enter(lambda: loop.call_soon_threadsafe(_resolve, future))
+        if waiter is not None:
+            try:
+                done, _ = await asyncio.wait([future], timeout=self.max_wait)
+            except asyncio.CancelledError:
+                # the client went away; a slot handed over meanwhile goes to the next one
+                if not self._leave(waiter):
+                    self.release(time.perf_counter())
+                raise
+            if not done:
+                self._leave(waiter, 'timeout')
+        return time.perf_counter()
+
+    def release(self, started):
+        elapsed = time.perf_counter() - started
+        woken = []
+        with self._lock:
+            self.in_flight -= 1
+            self._samples += 1
+            self._sample_seconds += elapsed
+            if self._samples >= self.window:
+                self._adapt()
+            while self.waiting and self.in_flight < self.limit:
+                waiter = self.waiting.popleft()
+                waiter.granted = True
+                self.in_flight += 1
+                self.admitted += 1
+                woken.append(waiter)
+        for waiter in woken:
+            waiter.wake()
+
+    def _adapt(self):
+        # called with the lock held, once per window of completions
+        self._average = self._sample_seconds / self._samples
+        limit = self.limit
+        if self._average > self.target:
+            limit = max(self.min_limit, int(self.limit * 0.75))
+        elif self._saturated:
+            limit = min(self.max_limit, self.limit + 1)
+        if limit != self.limit:
+            self.limit = limit
+            self.limit_changes += 1
+        self._samples = 0
+        self._sample_seconds = 0.0
+        self._saturated = self.in_flight >= self.limit
+
+    def stats(self):
+        with self._lock:
+            return {"limit": self.limit, "max_limit": self.max_limit, "in_flight": self.in_flight,
+                    "queue_depth": len(self.waiting), "queue_size": self.queue,
+                    "max_queue_depth": self.max_queue_depth, "target_ms": self.target * 1000,
+                    "avg_ms": round(self._average * 1000, 3), "admitted": self.admitted, "queued": self.queued,
+                    "shed": dict(self.shed), "limit_changes": self.limit_changes}
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionControl:
+    # routes maps a route as the Flask app names it to its class name
+
+    def __init__(self, classes, routes):
+        self.classes = {route_class.name: route_class for route_class in classes}
+        self.routes = routes
+        register(Gauge('admission_in_flight', "Requests running per route class.", ('route_class',),
+                       lambda: {(name,): route_class.in_flight for name, route_class in self.classes.items()}))
+        register(Gauge('admission_queue_depth', "Requests waiting per route class.", ('route_class',),
+                       lambda: {(name,): len(route_class.waiting) for name, route_class in self.classes.items()}))
+        register(Gauge('admission_limit', "Current concurrency limit per route class.", ('route_class',),
+                       lambda: {(name,): route_class.limit for name, route_class in self.classes.items()}))
+
+    def for_route(self, route):
+        # the RouteClass a route is admitted through, or None if it is not limited
+        return self.classes.get(self.routes.get(route))
+
+    def stats(self):
+        return {name: route_class.stats() for name, route_class in self.classes.items()}
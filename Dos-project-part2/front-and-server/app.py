@@ -1,53 +1,319 @@
-from flask import Flask, jsonify, request
+from flask import Flask, g, jsonify, request
+import atexit
+import hmac
+import signal
 import sqlite3
-import threading
 import os
-import itertools
-from datetime import datetime  
-import time
+import socket
+import contextvars
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import quote, urlsplit
+import sys
+import json
 from flask_caching import Cache 
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from admission import AdmissionControl, Rejected, RouteClass
+from cache_warmup import CacheWarmer
+from product_cache import ProductCache
+from common.balancer import ReplicaBalancer
+from common.db_pool import configure_pools, get_pool, pool_stats, PoolTimeout
+from common.hot_stock import reservation_id, HotStockClient
+from common.http_client import BackendClient, BackendError
+from common.idempotency import idempotent, IdempotencyStore, KEY_HEADER
+from common.invalidation import TOKEN_HEADER
+from common.metrics import instrument, span, target_name
+from common.migrations import migrate
+from common.paging import paginate, page_response, parse_page
+from common.replication import ReplicationLog
+from common.serialization import flask_response, loads
+from common.sharding import default_shard, load_shards
+from common.topic_search import iter_books, search_books, MATCH_MODES
+from common.stock import (decrement_stock_batch, delete_orders, insert_orders, parse_cart,
+                          restock_batch, top_books, PURCHASED, OUT_OF_STOCK, NOT_FOUND)
+
 app = Flask(__name__)
+# /metrics, /stats/traces and X-Trace-Id handling
+instrument(app, 'front')
 
-app.config['CACHE_TYPE'] = 'simple'
+# 'lru' / 'lfu' keep a bounded cache inside this process; 'shared' talks to
+# cache_daemon.py so every worker on the host uses the same entries
+app.config['FRONT_CACHE'] = os.environ.get('FRONT_CACHE', 'lru')
+if app.config['FRONT_CACHE'] == 'shared':
+    app.config['CACHE_TYPE'] = 'cache_backends.SharedCache'
+    app.config['CACHE_OPTIONS'] = {'socket_path': os.environ.get('CACHE_SOCKET', '/tmp/bookstore-cache.sock')}
+else:
+    app.config['CACHE_TYPE'] = 'cache_backends.LocalCache'
+    app.config['CACHE_OPTIONS'] = {'max_bytes': int(float(os.environ.get('CACHE_MAX_MB', 64)) * 1024 * 1024),
+                                   'policy': app.config['FRONT_CACHE']}
+# entries are updated in place on purchase and modify, so they can live long
+app.config['CACHE_TIMEOUT'] = int(os.environ.get('CACHE_TIMEOUT', 600))
 cache = Cache(app)
+# after CACHE_TIMEOUT an entry can still be served for CACHE_STALE_TIMEOUT seconds while it is refreshed
+app.config['CACHE_STALE_TIMEOUT'] = int(os.environ.get('CACHE_STALE_TIMEOUT', 60))
+product_cache = ProductCache(cache, app.config['CACHE_TIMEOUT'], app.config['CACHE_STALE_TIMEOUT'])
+# cached books and topic lists are sent with ETag and Last-Modified and
+# answer conditional GETs with 304; clients that accept gzip get bodies of
+# at least this many bytes compressed (0 never compresses)
+app.config['GZIP_MIN_BYTES'] = int(os.environ.get('GZIP_MIN_BYTES', 16384))
+
+# 'sqlite' reads the replica files directly, 'http' goes through the catalog and order services
+app.config['BACKEND_MODE'] = os.environ.get('FRONT_BACKEND', 'sqlite')
+app.config['CATALOG_SERVICES'] = os.environ.get('CATALOG_SERVICES', 'http://127.0.0.1:6001,http://127.0.0.1:6002').split(',')
+app.config['ORDER_SERVICES'] = os.environ.get('ORDER_SERVICES', 'http://127.0.0.1:7001,http://127.0.0.1:7002').split(',')
+app.config['BACKEND_MAX_CONNECTIONS'] = int(os.environ.get('BACKEND_MAX_CONNECTIONS', 20))
+app.config['BACKEND_TIMEOUT'] = float(os.environ.get('BACKEND_TIMEOUT', 2.0))
+# how long a request waits for a pooled SQLite connection before its 503
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', app.config['BACKEND_TIMEOUT']))
+configure_pools(checkout_timeout=app.config['DB_POOL_TIMEOUT'])
+# round_robin, least_outstanding or ewma
+app.config['BALANCER_POLICY'] = os.environ.get('BALANCER_POLICY', 'ewma')
+# 'sync' writes every replica in the request, 'primary_backup' ships a replication log to the backups
+app.config['REPLICATION_MODE'] = os.environ.get('REPLICATION_MODE', 'sync')
+# flash-sale books are sold from in-memory counters on each shard's first
+# catalog service rather than decremented in the files (common/hot_stock.py)
+app.config['HOT_BOOKS'] = [int(book_id) for book_id in os.environ.get('HOT_BOOKS', '').split(',') if book_id.strip()]
+# purchases sent with an Idempotency-Key run once and are replayed after that
+# (common/idempotency.py); IDEMPOTENCY_TTL=0 turns it off
+app.config['IDEMPOTENCY_DB'] = os.environ.get('IDEMPOTENCY_DB', os.path.join(os.path.dirname(__file__), 'idempotency.db'))
+app.config['IDEMPOTENCY_TTL'] = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+app.config['IDEMPOTENCY_CACHE'] = int(os.environ.get('IDEMPOTENCY_CACHE', 10000))
+idempotency = None
+if app.config['IDEMPOTENCY_TTL'] > 0:
+    migrate(app.config['IDEMPOTENCY_DB'], 'idempotency')
+    idempotency = IdempotencyStore(app.config['IDEMPOTENCY_DB'], app.config['IDEMPOTENCY_TTL'],
+                                   app.config['IDEMPOTENCY_CACHE'])
+
+# admission control (admission.py): at most ADMISSION_<CLASS>_LIMIT product
+# reads or purchases run at once and ADMISSION_<CLASS>_QUEUE more wait up to
+# ADMISSION_MAX_WAIT seconds; the rest get 503 with Retry-After. The limits
+# then follow the latency against ADMISSION_<CLASS>_TARGET_MS.
+app.config['ADMISSION'] = os.environ.get('ADMISSION', 'on') == 'on'
+app.config['ADMISSION_MAX_WAIT'] = float(os.environ.get('ADMISSION_MAX_WAIT', 1.0))
+app.config['ADMISSION_READ_LIMIT'] = int(os.environ.get('ADMISSION_READ_LIMIT', 64))
+app.config['ADMISSION_READ_QUEUE'] = int(os.environ.get('ADMISSION_READ_QUEUE', 256))
+app.config['ADMISSION_READ_TARGET_MS'] = float(os.environ.get('ADMISSION_READ_TARGET_MS', 50))
+app.config['ADMISSION_PURCHASE_LIMIT'] = int(os.environ.get('ADMISSION_PURCHASE_LIMIT', 8))
+app.config['ADMISSION_PURCHASE_QUEUE'] = int(os.environ.get('ADMISSION_PURCHASE_QUEUE', 64))
+app.config['ADMISSION_PURCHASE_TARGET_MS'] = float(os.environ.get('ADMISSION_PURCHASE_TARGET_MS', 250))
+ADMISSION_ROUTES = {'/product/<id>': 'read', '/products/<string:topic>': 'read',
+                    '/purchase/<int:id>/': 'purchase', '/purchase/batch': 'purchase'}
+admission = None
+if app.config['ADMISSION']:
+    admission = AdmissionControl([RouteClass(name, app.config[f'ADMISSION_{name.upper()}_LIMIT'],
+                                             app.config[f'ADMISSION_{name.upper()}_QUEUE'],
+                                             app.config[f'ADMISSION_{name.upper()}_TARGET_MS'],
+                                             app.config['ADMISSION_MAX_WAIT']) for name in ('read', 'purchase')],
+                                 ADMISSION_ROUTES)
+
+def overloaded(error):
+    # (body, status, headers) for a request admission control turned away
+    return {"message": f"Server busy: {error}", "success": False}, 503, [('Retry-After', str(error.retry_after))]
+
+# a database pool that stayed full (common/db_pool.py) is the same overload
+app.errorhandler(PoolTimeout)(overloaded)
+
+@app.before_request
+def admit_request():
+    route_class = admission and request.url_rule and admission.for_route(request.url_rule.rule)
+    if not route_class:
+        return None
+    if idempotency and idempotency.cached(request.headers.get(KEY_HEADER)):
+        # a repeat whose answer is in memory is replayed without any real work
+        return None
+    try:
+        g.admitted = (route_class, route_class.acquire())
+    except Rejected as error:
+        body, status, headers = overloaded(error)
+        return jsonify(body), status, headers
+
+@app.teardown_request
+def release_admission(error):
+    if 'admitted' in g:
+        route_class, started = g.pop('admitted')
+        route_class.release(started)
+
+def use_services():
+    return app.config['BACKEND_MODE'] == 'http'
+
+def probe_replica(path):
+    connection = sqlite3.connect(path, timeout=1)
+    try:
+        connection.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+    finally:
+        connection.close()
+    return True
+
+class ShardBackends:
+    # the replica balancers, replication logs and service clients of one shard
+
+    def __init__(self, shard):
+        self.name = shard.name
+        self.catalog_replica = shard.catalog
+        self.order_replica = shard.order
+        if use_services() and not (shard.catalog_services and shard.order_services):
+            raise ValueError(f"shard {shard.name} needs catalog_services and order_services with FRONT_BACKEND=http")
+        if not use_services():
+            for catalog_db_path in self.catalog_replica:
+                migrate(catalog_db_path, 'catalog')
+            for order_db_path in self.order_replica:
+                migrate(order_db_path, 'order')
+
+        self.catalog_balancer = ReplicaBalancer(self.catalog_replica, app.config['BALANCER_POLICY'], probe=probe_replica)
+        self.order_balancer = ReplicaBalancer(self.order_replica, app.config['BALANCER_POLICY'], probe=probe_replica)
+        self.catalog_client = BackendClient(shard.catalog_services, app.config['BACKEND_MAX_CONNECTIONS'], app.config['BACKEND_TIMEOUT'], app.config['BALANCER_POLICY'])
+        self.order_client = BackendClient(shard.order_services, app.config['BACKEND_MAX_CONNECTIONS'], app.config['BACKEND_TIMEOUT'], app.config['BALANCER_POLICY'])
+
+        self.hot_stock = None
+        if app.config['HOT_BOOKS'] and shard.catalog_services:
+            self.hot_stock = HotStockClient(shard.catalog_services[0], app.config['HOT_BOOKS'], app.config['BACKEND_TIMEOUT'])
+
+        if app.config['REPLICATION_MODE'] == 'primary_backup' and not use_services():
+            self.catalog_log = ReplicationLog(self.catalog_replica[0], self.catalog_replica[1:]).start()
+            self.order_log = ReplicationLog(self.order_replica[0], self.order_replica[1:]).start()
+        else:
+            self.catalog_log = None
+            self.order_log = None
+
+    def write_targets(self):
+        # in primary/backup mode only the primaries are written, the shippers do the rest
+        catalog_targets = self.catalog_replica[:1] if self.catalog_log else self.catalog_replica
+        order_targets = self.order_replica[:1] if self.order_log else self.order_replica
+        return catalog_targets, order_targets
+
+    def split_hot(self, cart):
+        # (books sold from the hot stock counters, books decremented in the files)
+        return self.hot_stock.split(cart) if self.hot_stock else ([], cart)
+
+    def stats(self):
+        if use_services():
+            return {"catalog": self.catalog_client.balancer.stats(), "order": self.order_client.balancer.stats()}
+        stats = {"catalog": self.catalog_balancer.stats(), "order": self.order_balancer.stats()}
+        if self.catalog_log:
+            stats["replication_lag"] = {**self.catalog_log.lag(), **self.order_log.lag()}
+        return stats
+
+# without SHARDS_CONFIG the two catalog and two order replicas hold every
+# book; with it book ids are spread over the shards it lists (common/sharding.py)
+app.config['SHARDS_CONFIG'] = os.environ.get('SHARDS_CONFIG', '')
+shard_map = load_shards(app.config['SHARDS_CONFIG'], default_shard(app.config['CATALOG_SERVICES'], app.config['ORDER_SERVICES']))
+shards = [ShardBackends(shard) for shard in shard_map.shards]
+shards_by_name = {backends.name: backends for backends in shards}
+
+# /cache/invalidate is taken from the catalog and order services only: from
+# their addresses, or with INVALIDATION_TOKEN set from whoever sends it
+app.config['INVALIDATION_TOKEN'] = os.environ.get('INVALIDATION_TOKEN', '')
 
-thread_local = threading.local()
-
-catalog_replica = [
-    os.path.join(os.path.dirname(__file__), '../catalog/catalog-1/catalog1.db'),
-    os.path.join(os.path.dirname(__file__), '../catalog/catalog-2/catalog2.db')
-]
-order_replica = [
-    os.path.join(os.path.dirname(__file__), '../order/order-1/order1.db'),
-    os.path.join(os.path.dirname(__file__), '../order/order-2/order2.db')
-]
-
-catalog_itertools = itertools.cycle(catalog_replica)
-order_itertools = itertools.cycle(order_replica)
-
-def catalog_db_connection():
-    catalog_db_path = next(catalog_itertools)
-    print(f"the catalog replica: {catalog_db_path}")
-    if not hasattr(thread_local, 'catalog_conn'):
-        thread_local.catalog_conn = sqlite3.connect(catalog_db_path)
-        thread_local.catalog_conn.row_factory = sqlite3.Row
-    return thread_local.catalog_conn
-
-def order_db_connection():
-    order_db_path = next(order_itertools)
-    print(f"Using order replica: {order_db_path}")
-    if not hasattr(thread_local, 'order_conn'):
-        thread_local.order_conn = sqlite3.connect(order_db_path)
-        thread_local.order_conn.row_factory = sqlite3.Row
-    return thread_local.order_conn
-
-@app.teardown_appcontext
-def cleanup_databases(error):
-    if hasattr(thread_local, 'catalog_conn'):
-        thread_local.catalog_conn.close()
-    if hasattr(thread_local, 'order_conn'):
-        thread_local.order_conn.close()
+def service_addresses():
+    addresses = set()
+    for shard in shard_map.shards:
+        for url in shard.catalog_services + shard.order_services:
+            try:
+                addresses.add(socket.gethostbyname(urlsplit(url).hostname))
+            except (OSError, TypeError, UnicodeError):
+                pass
+    return addresses
+
+invalidation_sources = service_addresses()
+
+def shard_for(book_id):
+    return shards_by_name[shard_map.shard_for(book_id).name]
+
+def split_cart(cart):
+    # [(shard, the part of the cart it owns)]
+    return [(shards_by_name[shard.name], shard_cart) for shard, shard_cart in shard_map.split(cart)]
+
+def request_min_seq():
+    # read-your-writes: clients send back the X-Catalog-Seq they got from a purchase
+    value = request.headers.get('X-Min-Seq') or request.args.get('min_seq') or '0'
+    return int(value) if value.isdigit() else 0
+
+@contextmanager
+def catalog_db_connection(shard, min_seq=0):
+    with shard.catalog_balancer.acquire() as catalog_db_path:
+        connection = get_pool(catalog_db_path).checkout()
+        if shard.catalog_log and not shard.catalog_log.is_caught_up(catalog_db_path, min_seq, connection):
+            # the backup has not applied the caller's write yet
+            get_pool(catalog_db_path).checkin(connection)
+            catalog_db_path = shard.catalog_log.primary
+            connection = get_pool(catalog_db_path).checkout()
+        try:
+            with span('catalog_read', target_name(catalog_db_path)):
+                yield connection
+        finally:
+            get_pool(catalog_db_path).checkin(connection)
+
+@contextmanager
+def order_db_connection(shard):
+    with shard.order_balancer.acquire() as order_db_path:
+        with get_pool(order_db_path).connection() as connection, span('order_read', target_name(order_db_path)):
+            yield connection
+
+# topic reads go to every shard at once
+scatter_pool = ThreadPoolExecutor(max_workers=max(len(shards), 1) * 4, thread_name_prefix='scatter')
+
+def scatter(load):
+    # load(shard) on every shard, results in shard order
+    if len(shards) == 1:
+        return [load(shards[0])]
+    # each worker runs in its own copy of this request's context, for the trace
+    context = contextvars.copy_context()
+    return list(scatter_pool.map(lambda shard: context.copy().run(load, shard), shards))
+
+@app.route('/stats/replicas', methods=['GET'])
+def replica_stats():
+    if len(shards) == 1:
+        return jsonify(shards[0].stats()), 200
+    return jsonify({shard.name: shard.stats() for shard in shards}), 200
+
+@app.route('/stats/shards', methods=['GET'])
+def shard_stats():
+    return jsonify(shard_map.as_dict()), 200
+
+@app.route('/stats/pools', methods=['GET'])
+def connection_pool_stats():
+    return jsonify(pool_stats()), 200
+
+@app.route('/stats/admission', methods=['GET'])
+def admission_stats():
+    if not admission:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, "classes": admission.stats()}), 200
+
+@app.route('/stats/idempotency', methods=['GET'])
+def idempotency_stats():
+    if not idempotency:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **idempotency.stats()}), 200
+
+@app.route('/stats/cache', methods=['GET'])
+def cache_stats():
+    return jsonify({**cache.cache.stats(), **product_cache.stats(), "warmup": cache_warmer.stats()}), 200
+
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    # pushed by the catalog and order services after they change a book. Only
+    # the id is taken and the book is read again, so a notice cannot put a
+    # row of its own into the cache
+    if app.config['INVALIDATION_TOKEN']:
+        allowed = hmac.compare_digest(request.headers.get(TOKEN_HEADER, ''), app.config['INVALIDATION_TOKEN'])
+    else:
+        allowed = request.remote_addr in invalidation_sources
+    if not allowed:
+        return jsonify({"message": "Only the catalog and order services may invalidate the cache"}), 403
+    data = request.get_json(silent=True)
+    data = data if isinstance(data, dict) else {}
+    book_id, seq = str(data.get('id', '')), str(data.get('seq', 0))
+    if not book_id.isdigit() or not seq.isdigit():
+        return jsonify({"message": "Expected a numeric 'id' and 'seq'"}), 400
+    try:
+        product_cache.reload_book(book_id, lambda: load_product(book_id, int(seq)))
+    except BackendError:
+        # dropped rather than left as they were
+        product_cache.invalidate_book(book_id)
+    return jsonify({"message": "Cache updated"}), 200
 
 @app.route('/', methods=['GET'])
 def front():  
@@ -62,143 +328,347 @@ def front():
     </html>  
     """
 
-@app.route('/product/<id>', methods=['GET'])
-def fetch_product_by_id(id):
-    start = time.time()
+def load_product(id, min_seq):
+    shard = shard_for(id)
+    if use_services():
+        headers = {'X-Min-Seq': str(min_seq)} if min_seq else None
+        status, _, body = shard.catalog_client.get(f'/retrieve/item/{id}', headers)
+        return loads(body) if status == 200 else None
 
-    if not id.isdigit():
-        return jsonify({"message": "Product ID must be numeric"}), 400
-
-    cached_response = cache.get(f'product_{id}')  
-    if cached_response:  
-        print("Using cache") 
-        duringTime = time.time() - start  
-        print("The time:", duringTime) 
-        return jsonify(cached_response), 200  
-    
-    print("Using database")
-    catalog_conn = catalog_db_connection()
-    with catalog_conn:
+    with catalog_db_connection(shard, min_seq) as catalog_conn, catalog_conn:
         cursor = catalog_conn.cursor()
         cursor.execute("SELECT * FROM books WHERE id=?", (int(id),))
         product = cursor.fetchone()
+        return dict(product) if product else None
+
+def load_shard_products(shard, topic, min_seq, match):
+    if use_services():
+        headers = {'X-Min-Seq': str(min_seq)} if min_seq else None
+        status, _, body = shard.catalog_client.get(f'/retrieve/topic/{quote(topic)}?match={match}', headers)
+        return loads(body) if status == 200 else []
 
-        if product:
-            productD =dict(product)
-            cache.set(f'product_{id}', {"product": productD}, timeout=60)  
-            duringTime = time.time() - start  
-            print("The time:", duringTime) 
-            return jsonify(productD), 200
+    with catalog_db_connection(shard, min_seq) as catalog_conn, catalog_conn:
+        return [dict(product) for product in search_books(catalog_conn, topic, match)]
+
+def load_products(topic, min_seq, match='substring'):
+    # every shard holds some of the topic's books, in id order; a single
+    # shard's list is used as it is and several are merged, not sorted
+    results = scatter(lambda shard: load_shard_products(shard, topic, min_seq, match))
+    products = results[0] if len(results) == 1 else list(heapq.merge(*results, key=lambda product: product['id']))
+    return products or None
+
+# paged and streamed listings read each shard this many rows at a time
+app.config['STREAM_PAGE_ROWS'] = int(os.environ.get('STREAM_PAGE_ROWS', 500))
+
+def load_shard_page(shard, topic, min_seq, match, after, limit):
+    if use_services():
+        headers = {'X-Min-Seq': str(min_seq)} if min_seq else None
+        status, _, body = shard.catalog_client.get(
+            f'/retrieve/topic/{quote(topic)}?match={match}&after={after}&limit={limit}', headers)
+        return loads(body) if status == 200 else []
+
+    with catalog_db_connection(shard, min_seq) as catalog_conn, catalog_conn:
+        return [dict(product) for product in iter_books(catalog_conn, topic, match, after, limit)]
+
+def iter_shard_products(shard, topic, min_seq, match, after, page_rows):
+    # one shard's matches in id order, fetched a keyset page at a time so no
+    # read transaction or backend call outlives a page
+    while True:
+        products = load_shard_page(shard, topic, min_seq, match, after, page_rows)
+        for product in products:
+            yield product['id'], product
+        if len(products) < page_rows:
+            return
+        after = products[-1]['id']
+
+def iter_products(topic, min_seq, match, after, limit=None):
+    # (id, product) over every shard, merged into id order
+    page_rows = min(limit + 1, app.config['STREAM_PAGE_ROWS']) if limit else app.config['STREAM_PAGE_ROWS']
+    return heapq.merge(*(iter_shard_products(shard, topic, min_seq, match, after, page_rows) for shard in shards),
+                       key=lambda row: row[0])
+
+# ids per /retrieve/items call, the most a catalog service takes
+ITEMS_PER_CALL = 500
+
+def load_books(ids):
+    # current rows for a set of ids, for revalidating the cache: {id: book}
+    books = {}
+    for shard, cart in split_cart([(int(book_id), 1) for book_id in ids]):
+        shard_ids = [book_id for book_id, _ in cart]
+        if use_services():
+            for start in range(0, len(shard_ids), ITEMS_PER_CALL):
+                chunk = ','.join(str(book_id) for book_id in shard_ids[start:start + ITEMS_PER_CALL])
+                status, _, body = shard.catalog_client.get(f'/retrieve/items?ids={chunk}')
+                if status != 200:
+                    raise BackendError(f"catalog answered {status}")
+                books.update((book['id'], book) for book in loads(body))
+            continue
+
+        with catalog_db_connection(shard) as catalog_conn, catalog_conn:
+            rows = catalog_conn.execute(f"SELECT * FROM books WHERE id IN ({','.join('?' * len(shard_ids))})", shard_ids)
+            books.update((row['id'], dict(row)) for row in rows)
+    return books
+
+def load_cached_topic(cache_topic):
+    # cache topics are '<topic>' for substring matches and '<topic>?exact'
+    topic, _, match = cache_topic.partition('?')
+    return load_products(topic, 0, match or 'substring')
+
+def load_shard_top_books(shard, limit, recent):
+    if use_services():
+        status, _, body = shard.order_client.get(f'/orders/top?limit={limit}&recent={recent}')
+        if status != 200:
+            raise BackendError(f"order service answered {status}")
+        return [(row['book_id'], row['quantity']) for row in json.loads(body)]
+    with order_db_connection(shard) as order_conn:
+        return top_books(order_conn, limit, recent)
+
+def load_top_books(limit, recent):
+    # the top of each shard's recent orders, so a busy shard is not crowded out by the others
+    rows = [row for shard_rows in scatter(lambda shard: load_shard_top_books(shard, limit, recent)) for row in shard_rows]
+    return sorted(rows, key=lambda row: row[1], reverse=True)[:limit]
+
+# the hottest entries are written to CACHE_SNAPSHOT_PATH on shutdown and read
+# back (and checked against the catalog) on startup, together with the
+# CACHE_WARM_TOP books ordered most in the last CACHE_WARM_RECENT_ORDERS orders
+app.config['CACHE_SNAPSHOT_PATH'] = os.environ.get('CACHE_SNAPSHOT_PATH', os.path.join(os.path.dirname(__file__), 'cache_snapshot.json.gz'))
+app.config['CACHE_SNAPSHOT_KEYS'] = int(os.environ.get('CACHE_SNAPSHOT_KEYS', 1000))
+app.config['CACHE_WARM_TOP'] = int(os.environ.get('CACHE_WARM_TOP', 20))
+app.config['CACHE_WARM_RECENT_ORDERS'] = int(os.environ.get('CACHE_WARM_RECENT_ORDERS', 10000))
+cache_warmer = CacheWarmer(product_cache, load_books, load_cached_topic, load_top_books,
+                           app.config['CACHE_SNAPSHOT_PATH'], app.config['CACHE_SNAPSHOT_KEYS'],
+                           app.config['CACHE_WARM_TOP'], app.config['CACHE_WARM_RECENT_ORDERS'])
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    # not in the debug reloader's watcher process, which never serves requests
+    cache_warmer.start()
+    atexit.register(cache_warmer.dump)
+
+@app.route('/cache/snapshot', methods=['POST'])
+def dump_cache():
+    return jsonify({"dumped": cache_warmer.dump(), "path": app.config['CACHE_SNAPSHOT_PATH']}), 200
+
+@app.route('/product/<id>', methods=['GET'])
+def fetch_product_by_id(id):
+    if not id.isdigit():
+        return jsonify({"message": "Product ID must be numeric"}), 400
+
+    # concurrent misses for the same id share one load; stale entries are
+    # served while a single background load refreshes them
+    min_seq = request_min_seq()
+    try:
+        if min_seq:
+            productD = product_cache.uncached(lambda: load_product(id, min_seq))
         else:
-            duringTime = time.time() - start  
-            print("The time:", duringTime) 
-            return jsonify({"message": "Product not found"}), 404
+            productD = product_cache.load_product(id, lambda: load_product(id, min_seq))
+    except BackendError as error:
+        return jsonify({"message": f"Catalog service unavailable: {error}"}), 503
+
+    if productD:
+        return flask_response(productD, app.config['GZIP_MIN_BYTES'])
+    return jsonify({"message": "Product not found"}), 404
 
 @app.route('/products/<string:topic>', methods=['GET'])
 def fetch_products_by_topic(topic):
-    start = time.time()
-
-    products = cache.get(topic)  
-    if products is not None:  
-        print("using cache")  
-        duringTime = time.time() - start  
-        print("The time:", duringTime) 
-        return jsonify(products), 200  # Return cached data  
-        
-    else:  
-        print("using database")  
-
-    catalog_conn = catalog_db_connection()
-    with catalog_conn:
-        cursor = catalog_conn.cursor()
-        if topic.lower() == 'all':
-            cursor.execute("SELECT * FROM books")
-        else:
-            cursor.execute("SELECT * FROM books WHERE topic LIKE ?", ('%' + topic + '%',))
-        products = cursor.fetchall()
-        if products:
-            products_list = [dict(product) for product in products]    
-            cache.set(topic, products_list, timeout=60)
-            duringTime = time.time() - start  
-            print("The time:", duringTime)
-            return jsonify([dict(product) for product in products]), 200
-        else:
-            duringTime = time.time() - start  
-            print("The time:", duringTime)
+    # substring (default) matches the topic anywhere, case-insensitively; exact
+    # matches the whole topic through the index
+    match = request.args.get('match', 'substring')
+    if match not in MATCH_MODES:
+        return jsonify({"message": f"match must be one of {', '.join(MATCH_MODES)}"}), 400
+    try:
+        page = parse_page(request.args, request.headers)
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+    cache_topic = topic if match == 'substring' else f'{topic}?{match}'
+
+    min_seq = request_min_seq()
+    if page:
+        # keyset pages and streamed listings skip the cache, which would have
+        # to hold the whole topic
+        try:
+            rows, found, next_after = paginate(iter_products(topic, min_seq, match, page.after, page.limit), page)
+        except BackendError as error:
+            return jsonify({"message": f"Catalog service unavailable: {error}"}), 503
+        if not found and not page.after:
             return jsonify({"message": "No products found"}), 404
+        return page_response(page, rows, next_after)
+
+    try:
+        if min_seq:
+            products_list = product_cache.uncached(lambda: load_products(topic, min_seq, match))
+        else:
+            products_list = product_cache.load_topic(cache_topic, lambda: load_products(topic, min_seq, match))
+    except BackendError as error:
+        return jsonify({"message": f"Catalog service unavailable: {error}"}), 503
+
+    if products_list:
+        return flask_response(products_list, app.config['GZIP_MIN_BYTES'])
+    return jsonify({"message": "No products found"}), 404
+
+def undo_purchase(reservation, done, reserved, written=()):
+    # puts back what a purchase took: the order rows written, the catalog
+    # replicas decremented and the hot stock reserved
+    for shard, order_db_path, order_ids in written:
+        with get_pool(order_db_path).connection() as order_conn:
+            delete_orders(order_conn, order_ids, log=shard.order_log)
+    for shard, catalog_db_path, catalog_cart in done:
+        with get_pool(catalog_db_path).connection() as catalog_conn, span('catalog_restock', target_name(catalog_db_path)):
+            restock_batch(catalog_conn, catalog_cart, log=shard.catalog_log)
+    for shard, hot_cart in reserved:
+        shard.hot_stock.release(hot_cart, reservation)
+
+def forwarded_key(headers=None):
+    # the order service keeps the purchase's Idempotency-Key as well, for
+    # retries that reach it through another front server
+    headers = dict(headers or {})
+    if KEY_HEADER in request.headers:
+        headers[KEY_HEADER] = request.headers[KEY_HEADER]
+    return headers or None
+
+def take_stock(shard_carts, reservation, done, reserved, products):
+    # decrements the catalog replicas and reserves the hot books of every
+    # shard until one refuses, recording in done, reserved and products what
+    # went through. Returns (status, failed_id); status None when the hot
+    # stock service cannot be reached.
+    for shard, shard_cart in shard_carts:
+        hot_cart, catalog_cart = shard.split_hot(shard_cart)
+        if hot_cart:
+            try:
+                status, failed_id, hot_products = shard.hot_stock.reserve(hot_cart, reservation)
+            except BackendError as error:
+                return None, str(error)
+            if status != PURCHASED:
+                return status, failed_id
+            reserved.append((shard, hot_cart))
+            products.extend(hot_products)
+        for catalog_db_path in shard.write_targets()[0] if catalog_cart else ():
+            with get_pool(catalog_db_path).connection() as catalog_conn, span('catalog_decrement', target_name(catalog_db_path)):
+                status, failed_id, shard_products = decrement_stock_batch(catalog_conn, catalog_cart, log=shard.catalog_log)
+            if status != PURCHASED:
+                return status, failed_id
+            done.append((shard, catalog_db_path, catalog_cart))
+        if catalog_cart:
+            products.extend(shard_products)
+    return PURCHASED, None
+
+def purchase_cart(shard_carts):
+    # both purchase routes in sqlite mode: every replica of every shard takes
+    # its part of the cart or none of it; if a later one refuses or fails, or
+    # the order rows cannot be written, everything taken is put back. Hot
+    # books come off their shard's counters instead of the files. Returns
+    # None once the cart is sold, else the error response.
+    done = []
+    reserved = []
+    products = []
+    # one id for the cart's reservations on every shard
+    reservation = reservation_id()
+    try:
+        status, failed_id = take_stock(shard_carts, reservation, done, reserved, products)
+    except Exception:
+        undo_purchase(reservation, done, reserved)
+        raise
+    if status != PURCHASED:
+        undo_purchase(reservation, done, reserved)
+        if status is None:
+            return jsonify({"message": f"Hot stock service unavailable: {failed_id}", "success": False}), 503
+        if status == OUT_OF_STOCK:
+            return jsonify({"message": "Product out of stock", "book_id": failed_id, "success": False}), 400
+        return jsonify({"message": "Product not found", "book_id": failed_id, "success": False}), 404
+
+    for product in products:
+        product_cache.update_book(dict(product))
+
+    written = []
+    try:
+        for shard, shard_cart in shard_carts:
+            for order_db_path in shard.write_targets()[1]:
+                with get_pool(order_db_path).connection() as order_conn, span('order_insert', target_name(order_db_path)):
+                    written.append((shard, order_db_path, insert_orders(order_conn, shard_cart, log=shard.order_log)))
+    except Exception as error:
+        undo_purchase(reservation, done, reserved, written)
+        for product in products:
+            product_cache.invalidate_book(product['id'])
+        return jsonify({"message": f"Order could not be recorded: {error}", "success": False}), 503
+    for shard, _ in reserved:
+        shard.hot_stock.confirm(reservation)
+    return None
 
 @app.route('/purchase/<int:id>/', methods=['PUT'])
+@idempotent(idempotency)
 def purchase_product(id):
-    start = time.time()
     try:
         id = int(id)
     except ValueError:
         return jsonify({"message": "Book ID must be a numeric value"}), 400
+    shard = shard_for(id)
 
-    catalog1_conn = sqlite3.connect(catalog_replica[0])
-    catalog1_conn.row_factory = sqlite3.Row
-
-    catalog2_conn = sqlite3.connect(catalog_replica[1])
-    catalog2_conn.row_factory = sqlite3.Row
-
-    with catalog1_conn:
-        cursor1 = catalog1_conn.cursor()
-        cursor1.execute("SELECT * FROM books WHERE id=?", (id,))
-        product1 = cursor1.fetchone()
-        if product1:
-            if product1['quantity'] > 0:
-                updated_quantity = product1['quantity'] - 1
-                cursor1.execute("UPDATE books SET quantity=? WHERE id=?", (updated_quantity, id))
-            else:
-                duringTime = time.time() - start  
-                print("The time:", duringTime)
-                return jsonify({"message": "Product out of stock", "success": False}), 400
-        else:
-            duringTime = time.time() - start  
-            print("The time:", duringTime)
-            return jsonify({"message": "Product not found", "success": False}), 404
-
-    with catalog2_conn:
-        cursor2 = catalog2_conn.cursor()
-        cursor2.execute("SELECT * FROM books WHERE id=?", (id,))
-        product2 = cursor2.fetchone()
-        if product2:
-            if product2['quantity'] > 0:
-                updated_quantity = product2['quantity'] - 1
-                cursor2.execute("UPDATE books SET quantity=? WHERE id=?", (updated_quantity, id))
-                cache.delete(f'products_{id}')
-                productD =dict(product2)
-                cache.set(f'product_{id}', {"product": productD}, timeout=60) 
-            else:
-                duringTime = time.time() - start  
-                print("The time:", duringTime)
-                return jsonify({"message": "Product out of stock", "success": False}), 400
-        else:
-            duringTime = time.time() - start  
-            print("The time:", duringTime)
-            return jsonify({"message": "Product not found", "success": False}), 404
+    if use_services():
+        try:
+            status, headers, body = shard.order_client.put(f'/purchase/{id}/', headers=forwarded_key())
+        except BackendError as error:
+            return jsonify({"message": f"Order service unavailable: {error}", "success": False}), 503
+        result = json.loads(body)
+        if status == 200:
+            # the order service does not return the row; drop what we hold for it
+            product_cache.invalidate_book(id)
+            response = jsonify({"message": "Product purchased successfully", "success": True})
+            if 'X-Catalog-Seq' in headers:
+                response.headers['X-Catalog-Seq'] = headers['X-Catalog-Seq']
+            return response, 200
+        return jsonify({"message": result.get("message"), "success": False}), status
 
-    order1_conn = sqlite3.connect(order_replica[0])
-    order1_conn.row_factory = sqlite3.Row
+    error = purchase_cart([(shard, [(id, 1)])])
+    if error is not None:
+        return error
 
-    order2_conn = sqlite3.connect(order_replica[1])
-    order2_conn.row_factory = sqlite3.Row
+    response = jsonify({"message": "Product purchased successfully", "success": True})
+    if shard.catalog_log:
+        response.headers['X-Catalog-Seq'] = str(shard.catalog_log.last_seq())
+    return response, 200
+
+@app.route('/purchase/batch', methods=['POST'])
+@idempotent(idempotency)
+def purchase_batch():
+    try:
+        cart = parse_cart(request.get_json(silent=True))
+    except ValueError as error:
+        return jsonify({"message": str(error), "success": False}), 400
+    shard_carts = split_cart(cart)
 
-    
-    with order1_conn:
-        cur1 = order1_conn.cursor()
-        cur1.execute("INSERT INTO orders (book_id, order_date, quantity) VALUES (?, ?, ?)", (id, datetime.now()  , 1))
-        order1_conn.commit()
+    if use_services():
+        if len(shard_carts) > 1:
+            # an order service can only take back what it sold on its own shard
+            return jsonify({"message": "Cart spans several shards; buy their books separately",
+                            "shards": [shard.name for shard, _ in shard_carts], "success": False}), 400
+        shard = shard_carts[0][0]
+        try:
+            status, headers, body = shard.order_client.post('/purchase/batch', json.dumps({"items": [
+                {"book_id": book_id, "quantity": quantity} for book_id, quantity in cart]}),
+                forwarded_key({'Content-Type': 'application/json'}))
+        except BackendError as error:
+            return jsonify({"message": f"Order service unavailable: {error}", "success": False}), 503
+        result = json.loads(body)
+        if status != 200:
+            return jsonify({"message": result.get("message"), "book_id": result.get("book_id"), "success": False}), status
+        for book_id, _ in cart:
+            product_cache.invalidate_book(book_id)
+        response = jsonify({"message": "Products purchased successfully", "success": True, "items": result.get("items")})
+        if 'X-Catalog-Seq' in headers:
+            response.headers['X-Catalog-Seq'] = headers['X-Catalog-Seq']
+        return response, 200
 
-    with order2_conn:
-        cur2 = order2_conn.cursor()
-        cur2.execute("INSERT INTO orders (book_id, order_date, quantity) VALUES (?, ?, ?)", (id, datetime.now()  , 1))
-        order2_conn.commit()  
+    error = purchase_cart(shard_carts)
+    if error is not None:
+        return error
 
-    
-    duringTime = time.time() - start  
-    print("The time:", duringTime)
-    return jsonify({"message": "Product purchased successfully", "success": True}), 200
+    response = jsonify({"message": "Products purchased successfully", "success": True,
+                        "items": [{"book_id": book_id, "quantity": quantity} for book_id, quantity in cart]})
+    # sequence numbers are per shard, so only a one-shard cart gets one back
+    if len(shard_carts) == 1 and shard_carts[0][0].catalog_log:
+        response.headers['X-Catalog-Seq'] = str(shard_carts[0][0].catalog_log.last_seq())
+    return response, 200
 
 if __name__ == '__main__':
+    # the development server just dies on SIGTERM; exit normally instead so
+    # the atexit dump runs. Servers that import the app shut down on their own.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(debug=True, port=5000)
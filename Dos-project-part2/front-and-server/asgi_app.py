@@ -0,0 +1,537 @@
+# asyncio front server with the same routes as app.py:
+#
+#   uvicorn asgi_app:application --port 5000 --no-access-log
+#   python asgi_app.py --port 5000
+#
+# /product, /products and the purchase routes are served here. Cache hits are
+# answered on the event loop; database and backend calls run in a bounded
+# thread pool, and a purchase writes every replica at the same time, so it
+# takes about as long as the slowest replica instead of the sum of them.
+# Every other route is handed to the Flask app through the same pool.
+# The admission control of app.py applies here as well; a request waits for
+# its slot on the event loop and holds it until its body is sent.
+import argparse
+import asyncio
+import contextvars
+import io
+import json
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+
+import app as front
+from admission import Rejected
+from common.db_pool import get_pool, PoolTimeout
+from common.hot_stock import reservation_id
+from common.http_client import BackendError
+from common.idempotency import check_key, fingerprint, CONFLICTS, KEY_HEADER, REPLAY, REPLAYED_HEADER
+from common.metrics import TRACE_HEADER, begin_request, end_request, server_timing, span, target_name
+from common.paging import body as page_body, page_headers, paginate, parse_page
+from common.serialization import dumps, encoded_response
+from common.stock import (decrement_stock, decrement_stock_batch, delete_orders, insert_order, insert_orders, parse_cart,
+                          restock_batch, PURCHASED, OUT_OF_STOCK)
+from common.topic_search import MATCH_MODES
+
+ASYNC_DB_WORKERS = int(os.environ.get('ASYNC_DB_WORKERS', 32))
+# blocking calls past this many wait on the event loop rather than in the pool's queue
+ASYNC_MAX_PENDING = int(os.environ.get('ASYNC_MAX_PENDING', ASYNC_DB_WORKERS * 8))
+
+# buy() status for a cart whose hot books could not be reserved
+UNAVAILABLE = 'unavailable'
+# buy() status for a cart whose order rows could not be written; it is put back
+UNRECORDED = 'unrecorded'
+
+executor = ThreadPoolExecutor(ASYNC_DB_WORKERS, thread_name_prefix='front-db')
+pending = asyncio.Semaphore(ASYNC_MAX_PENDING)
+
+
+# SQLite takes one writer per file and a busy writer makes the others back off
+# and sleep, so writes to a replica go through that replica's own thread
+writers = {}
+
+
+async def blocking(function, *args, pool=None):
+    # run_in_executor does not carry context variables over; the trace has to go along
+    context = contextvars.copy_context()
+    async with pending:
+        return await asyncio.get_running_loop().run_in_executor(pool or executor, context.run, function, *args)
+
+
+async def cache_call(function, *args):
+    # the in-process caches answer from memory; the shared one is a round
+    # trip over a unix socket and goes to the pool like any other blocking call
+    if front.app.config['FRONT_CACHE'] == 'shared':
+        return await blocking(function, *args)
+    return function(*args)
+
+
+def writer(path):
+    if path not in writers:
+        writers[path] = ThreadPoolExecutor(1, thread_name_prefix='front-writer')
+    return writers[path]
+
+
+class Request:
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.args = {}
+        for pair in scope['query_string'].decode('latin-1').split('&'):
+            name, _, value = pair.partition('=')
+            if name:
+                self.args.setdefault(unquote_plus(name), unquote_plus(value))
+        self.body = body
+
+    def min_seq(self):
+        value = self.headers.get('x-min-seq') or self.args.get('min_seq') or '0'
+        return int(value) if value.isdigit() else 0
+
+    def json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+def json_response(body, status=200, headers=None):
+    return status, [('Content-Type', 'application/json')] + (headers or []), dumps(body) + b'\n'
+
+
+async def cached_response(request, encoded):
+    # a cached entry with its validators; a body compressed for the first
+    # time is compressed in the pool, not on the event loop
+    gzip_min_bytes = front.app.config['GZIP_MIN_BYTES']
+    if gzip_min_bytes and len(encoded.body) >= gzip_min_bytes:
+        return await blocking(encoded_response, encoded, request.headers, gzip_min_bytes)
+    return encoded_response(encoded, request.headers, gzip_min_bytes)
+
+
+def seq_header(seq):
+    return [('X-Catalog-Seq', str(seq))] if seq is not None else []
+
+
+def idempotent(handler):
+    # common.idempotency.idempotent() for the purchase handlers here; the
+    # table is only read in the pool when the answer is not in memory
+    async def wrapper(request, *args):
+        store = front.idempotency
+        key = request.headers.get(KEY_HEADER.lower())
+        if store is None or key is None:
+            return await handler(request, *args)
+        try:
+            check_key(key)
+        except ValueError as error:
+            return json_response({"message": str(error)}, 400)
+        request_fingerprint = fingerprint(request.method, request.path, request.body)
+        state, result = store.remembered(key, request_fingerprint) or await blocking(store.begin, key, request_fingerprint)
+        if state == REPLAY:
+            status, headers, body = result
+            return status, headers + [(REPLAYED_HEADER, 'true')], body
+        if state in CONFLICTS:
+            status, message = CONFLICTS[state]
+            return json_response({"message": message}, status)
+        try:
+            status, headers, payload = await handler(request, *args)
+        except Exception:
+            await blocking(store.release, key)
+            raise
+        await blocking(store.settle, key, status, headers, payload)
+        return status, headers, payload
+    return wrapper
+
+
+def forwarded_key(request, headers=None):
+    # app.forwarded_key() for this server's requests
+    headers = dict(headers or {})
+    if KEY_HEADER.lower() in request.headers:
+        headers[KEY_HEADER] = request.headers[KEY_HEADER.lower()]
+    return headers or None
+
+
+async def fetch_product_by_id(request, id):
+    if not id.isdigit():
+        return json_response({"message": "Product ID must be numeric"}, 400)
+
+    min_seq = request.min_seq()
+    load = lambda: front.load_product(id, min_seq)
+    try:
+        if min_seq:
+            product = await blocking(front.product_cache.uncached, load)
+        else:
+            product = await cache_call(front.product_cache.cached_product, id, load)
+            if product is None:
+                product = await blocking(front.product_cache.fill_product, id, load)
+    except BackendError as error:
+        return json_response({"message": f"Catalog service unavailable: {error}"}, 503)
+
+    if product:
+        return await cached_response(request, product)
+    return json_response({"message": "Product not found"}, 404)
+
+
+async def fetch_products_by_topic(request, topic):
+    match = request.args.get('match', 'substring')
+    if match not in MATCH_MODES:
+        return json_response({"message": f"match must be one of {', '.join(MATCH_MODES)}"}, 400)
+    try:
+        page = parse_page(request.args, request.headers)
+    except ValueError as error:
+        return json_response({"message": str(error)}, 400)
+    cache_topic = topic if match == 'substring' else f'{topic}?{match}'
+
+    min_seq = request.min_seq()
+    if page:
+        # the body is an iterator; application() pulls it chunk by chunk in the pool
+        try:
+            rows, found, next_after = await blocking(
+                paginate, front.iter_products(topic, min_seq, match, page.after, page.limit), page)
+        except BackendError as error:
+            return json_response({"message": f"Catalog service unavailable: {error}"}, 503)
+        if not found and not page.after:
+            return json_response({"message": "No products found"}, 404)
+        return 200, page_headers(page, next_after), page_body(rows, page.ndjson)
+    load = lambda: front.load_products(topic, min_seq, match)
+    try:
+        if min_seq:
+            products = await blocking(front.product_cache.uncached, load)
+        else:
+            products = await cache_call(front.product_cache.cached_topic, cache_topic, load)
+            if products is None:
+                products = await blocking(front.product_cache.fill_topic, cache_topic, load)
+    except BackendError as error:
+        return json_response({"message": f"Catalog service unavailable: {error}"}, 503)
+
+    if products:
+        return await cached_response(request, products)
+    return json_response({"message": "No products found"}, 404)
+
+
+# per-replica writes, run in the pool; the replication seq is thread-local so
+# it is read in the same thread that appended it
+
+def decrement_replica(shard, path, cart):
+    with get_pool(path).connection() as connection, span('catalog_decrement', target_name(path)):
+        if len(cart) == 1:
+            book_id, quantity = cart[0]
+            status, book = decrement_stock(connection, book_id, quantity, log=shard.catalog_log)
+            result = (status, book_id if status != PURCHASED else None, [book] if book else [])
+        else:
+            result = decrement_stock_batch(connection, cart, log=shard.catalog_log)
+    return result + (shard.catalog_log.last_seq() if shard.catalog_log else None,)
+
+
+def restock_replica(shard, path, cart):
+    with get_pool(path).connection() as connection, span('catalog_restock', target_name(path)):
+        restock_batch(connection, cart, log=shard.catalog_log)
+
+
+def insert_order_replica(shard, path, cart):
+    # returns the new order ids
+    with get_pool(path).connection() as connection, span('order_insert', target_name(path)):
+        if len(cart) == 1:
+            return [insert_order(connection, cart[0][0], cart[0][1], log=shard.order_log)]
+        return insert_orders(connection, cart, log=shard.order_log)
+
+
+def delete_order_replica(shard, path, order_ids):
+    with get_pool(path).connection() as connection:
+        delete_orders(connection, order_ids, log=shard.order_log)
+
+
+def reserve_hot(shard, cart, reservation):
+    # same shape as decrement_replica; UNAVAILABLE when the counters cannot be reached
+    try:
+        status, failed_id, books = shard.hot_stock.reserve(cart, reservation)
+    except BackendError as error:
+        return UNAVAILABLE, str(error), [], None
+    return status, failed_id, books, None
+
+
+def release_hot(shard, cart, reservation):
+    shard.hot_stock.release(cart, reservation)
+
+
+def went_through(result):
+    # a gathered decrement_replica or reserve_hot result that took the stock
+    return not isinstance(result, BaseException) and result[0] == PURCHASED
+
+
+async def undo(reservation, hot, writes, written=()):
+    # puts back what buy() took: the order rows written, then the catalog
+    # decrements and the hot reservations
+    await asyncio.gather(*(blocking(delete_order_replica, shard, path, order_ids, pool=writer(path))
+                           for shard, path, order_ids in written))
+    await asyncio.gather(*(blocking(release_hot, shard, hot_cart, reservation) for shard, hot_cart in hot),
+                         *(blocking(restock_replica, shard, path, shard_cart, pool=writer(path))
+                           for shard, path, shard_cart in writes))
+
+
+async def buy(cart):
+    # every catalog replica of every shard the cart touches is decremented at
+    # once, and hot books are reserved on their shard's counters alongside;
+    # if any of them refuses or fails, the ones that went through are put
+    # back, and so is everything when the order rows cannot be written.
+    # Returns (status, failed_id, seq), seq only for a cart on one shard;
+    # failed_id is the error for UNRECORDED.
+    shard_carts = front.split_cart(cart)
+    reservation = reservation_id()
+    hot = []
+    writes = []
+    for shard, shard_cart in shard_carts:
+        hot_cart, catalog_cart = shard.split_hot(shard_cart)
+        if hot_cart:
+            hot.append((shard, hot_cart))
+        if catalog_cart:
+            writes.extend((shard, path, catalog_cart) for path in shard.write_targets()[0])
+    results = await asyncio.gather(*(blocking(reserve_hot, shard, hot_cart, reservation) for shard, hot_cart in hot),
+                                   *(blocking(decrement_replica, shard, path, shard_cart, pool=writer(path))
+                                     for shard, path, shard_cart in writes), return_exceptions=True)
+    hot_results, results = results[:len(hot)], results[len(hot):]
+    refused = [result for result in hot_results + results if not went_through(result)]
+    if refused:
+        await undo(reservation, [item for item, result in zip(hot, hot_results) if went_through(result)],
+                   [item for item, result in zip(writes, results) if went_through(result)])
+        errors = [result for result in refused if isinstance(result, BaseException)]
+        if errors:
+            raise errors[0]
+        return refused[0][0], refused[0][1], None
+
+    # the counters and the first replica written of each shard have the rows to cache
+    first = {}
+    for (shard, _, _), result in zip(writes, results):
+        first.setdefault(shard.name, result)
+    await asyncio.gather(*(cache_call(front.product_cache.update_book, dict(book))
+                           for _, _, books, _ in hot_results + list(first.values()) for book in books))
+    order_writes = [(shard, path, shard_cart) for shard, shard_cart in shard_carts for path in shard.write_targets()[1]]
+    inserted = await asyncio.gather(*(blocking(insert_order_replica, shard, path, shard_cart, pool=writer(path))
+                                      for shard, path, shard_cart in order_writes), return_exceptions=True)
+    errors = [result for result in inserted if isinstance(result, BaseException)]
+    if errors:
+        await undo(reservation, hot, writes, [(shard, path, order_ids) for (shard, path, _), order_ids
+                                              in zip(order_writes, inserted) if not isinstance(order_ids, BaseException)])
+        await asyncio.gather(*(cache_call(front.product_cache.invalidate_book, book_id) for book_id, _ in cart))
+        return UNRECORDED, str(errors[0]), None
+    for shard, _ in hot:
+        shard.hot_stock.confirm(reservation)
+    seq = results[0][3] if results else None
+    return PURCHASED, None, seq if len(shard_carts) == 1 else None
+
+
+@idempotent
+async def purchase_product(request, id):
+    id = int(id)
+
+    if front.use_services():
+        try:
+            status, headers, body = await blocking(front.shard_for(id).order_client.put, f'/purchase/{id}/',
+                                                   None, forwarded_key(request))
+        except BackendError as error:
+            return json_response({"message": f"Order service unavailable: {error}", "success": False}, 503)
+        result = json.loads(body)
+        if status == 200:
+            await cache_call(front.product_cache.invalidate_book, id)
+            return json_response({"message": "Product purchased successfully", "success": True}, 200,
+                                 seq_header(headers.get('X-Catalog-Seq')))
+        return json_response({"message": result.get("message"), "success": False}, status)
+
+    status, failed_id, seq = await buy([(id, 1)])
+    if status == UNAVAILABLE:
+        return json_response({"message": "Hot stock service unavailable", "success": False}, 503)
+    if status == UNRECORDED:
+        return json_response({"message": f"Order could not be recorded: {failed_id}", "success": False}, 503)
+    if status == OUT_OF_STOCK:
+        return json_response({"message": "Product out of stock", "success": False}, 400)
+    if status != PURCHASED:
+        return json_response({"message": "Product not found", "success": False}, 404)
+    return json_response({"message": "Product purchased successfully", "success": True}, 200, seq_header(seq))
+
+
+@idempotent
+async def purchase_batch(request):
+    try:
+        cart = parse_cart(request.json())
+    except ValueError as error:
+        return json_response({"message": str(error), "success": False}, 400)
+
+    if front.use_services():
+        shard_carts = front.split_cart(cart)
+        if len(shard_carts) > 1:
+            return json_response({"message": "Cart spans several shards; buy their books separately",
+                                  "shards": [shard.name for shard, _ in shard_carts], "success": False}, 400)
+        try:
+            status, headers, body = await blocking(shard_carts[0][0].order_client.post, '/purchase/batch', json.dumps({"items": [
+                {"book_id": book_id, "quantity": quantity} for book_id, quantity in cart]}),
+                forwarded_key(request, {'Content-Type': 'application/json'}))
+        except BackendError as error:
+            return json_response({"message": f"Order service unavailable: {error}", "success": False}, 503)
+        result = json.loads(body)
+        if status != 200:
+            return json_response({"message": result.get("message"), "book_id": result.get("book_id"), "success": False}, status)
+        await asyncio.gather(*(cache_call(front.product_cache.invalidate_book, book_id) for book_id, _ in cart))
+        return json_response({"message": "Products purchased successfully", "success": True, "items": result.get("items")},
+                             200, seq_header(headers.get('X-Catalog-Seq')))
+
+    status, failed_id, seq = await buy(cart)
+    if status == UNAVAILABLE:
+        return json_response({"message": "Hot stock service unavailable", "success": False}, 503)
+    if status == UNRECORDED:
+        return json_response({"message": f"Order could not be recorded: {failed_id}", "success": False}, 503)
+    if status == OUT_OF_STOCK:
+        return json_response({"message": "Product out of stock", "book_id": failed_id, "success": False}, 400)
+    if status != PURCHASED:
+        return json_response({"message": "Product not found", "book_id": failed_id, "success": False}, 404)
+    return json_response({"message": "Products purchased successfully", "success": True,
+                          "items": [{"book_id": book_id, "quantity": quantity} for book_id, quantity in cart]},
+                         200, seq_header(seq))
+
+
+# (method, path pattern, route name as the Flask app has it, handler)
+ROUTES = [
+    ('GET', re.compile(r'/product/([^/]+)'), '/product/<id>', fetch_product_by_id),
+    ('GET', re.compile(r'/products/([^/]+)'), '/products/<string:topic>', fetch_products_by_topic),
+    ('PUT', re.compile(r'/purchase/(\d+)/'), '/purchase/<int:id>/', purchase_product),
+    ('POST', re.compile(r'/purchase/batch'), '/purchase/batch', purchase_batch),
+]
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('127.0.0.1', 5000)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': '',
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+
+def run_wsgi(environ):
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    result = front.app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return started['status'], started['headers'], body
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # uvicorn re-raises SIGTERM once it is done, so atexit would not get to dump the cache
+            await blocking(front.cache_warmer.dump)
+            for pool in [executor, *writers.values()]:
+                pool.shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    body = await read_body(receive)
+    # the admission slot is held until the last chunk of the body is sent
+    admitted = None
+    try:
+        for method, pattern, route, handler in ROUTES:
+            match = pattern.fullmatch(scope['path'])
+            if scope['method'] == method and match:
+                request = Request(scope, body)
+                trace, token = begin_request(request.headers.get(TRACE_HEADER.lower()))
+                status, error = 500, None
+                route_class = front.admission and front.admission.for_route(route)
+                if front.idempotency and front.idempotency.cached(request.headers.get(KEY_HEADER.lower())):
+                    # replayed from memory, nothing to hold back
+                    route_class = None
+                try:
+                    if route_class:
+                        admitted = (route_class, await route_class.acquire_async())
+                    status, headers, payload = await handler(request, *match.groups())
+                except (Rejected, PoolTimeout) as rejected:
+                    message, status, headers = front.overloaded(rejected)
+                    status, headers, payload = json_response(message, status, headers)
+                except Exception as exception:
+                    error = exception
+                    raise
+                finally:
+                    end_request(trace, token, route, method, status, error)
+                headers = headers + [(TRACE_HEADER, trace.id)]
+                if trace.spans:
+                    headers.append(('Server-Timing', server_timing(trace)))
+                break
+        else:
+            # the Flask app does its own metrics and tracing
+            status, headers, payload = await blocking(run_wsgi, wsgi_environ(scope, body))
+
+        headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+        if isinstance(payload, bytes) and status != 304:
+            # a 304's length would have to be the one of the body it stands for
+            headers.append(('Content-Length', str(len(payload))))
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+        if isinstance(payload, bytes):
+            await send({'type': 'http.response.body', 'body': payload})
+            return
+        # a streamed body: each chunk may need a database read or a backend call
+        while True:
+            chunk = await blocking(next, payload, None)
+            if chunk is None:
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if admitted:
+            admitted[0].release(admitted[1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("the asyncio front server needs uvicorn: pip install uvicorn")
+    uvicorn.run(application, host=args.host, port=args.port, access_log=False, log_level='warning', backlog=2048)
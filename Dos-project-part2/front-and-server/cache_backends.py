@@ -0,0 +1,310 @@
+import json
+import pickle
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from flask_caching.backends.base import BaseCache
+
+POLICIES = ('lru', 'lfu')
+
+OP_GET, OP_SET, OP_ADD, OP_DELETE, OP_CLEAR, OP_STATS, OP_HAS, OP_ADD_MEMBER = range(1, 9)
+REQUEST = struct.Struct('!BIId')
+RESPONSE = struct.Struct('!BI')
+
+
+class BoundedStore:
+    # byte-capped key -> bytes store with LRU or LFU eviction; used directly by
+    # LocalCache and behind the socket by cache_daemon.py
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, policy='lru'):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown eviction policy {policy!r}, expected one of {POLICIES}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = {}
+        self._recency = OrderedDict()
+        self._frequencies = defaultdict(OrderedDict)
+        self._lock = threading.Lock()
+
+    def _touch(self, key, entry):
+        if self.policy == 'lru':
+            self._recency.move_to_end(key)
+            return
+        bucket = self._frequencies[entry[2]]
+        del bucket[key]
+        if not bucket:
+            del self._frequencies[entry[2]]
+        entry[2] += 1
+        self._frequencies[entry[2]][key] = None
+
+    def _remove(self, key):
+        data, _, frequency = self._entries.pop(key)
+        self.used_bytes -= len(key) + len(data)
+        if self.policy == 'lru':
+            del self._recency[key]
+        else:
+            bucket = self._frequencies[frequency]
+            del bucket[key]
+            if not bucket:
+                del self._frequencies[frequency]
+
+    def _victim(self):
+        if self.policy == 'lru':
+            return next(iter(self._recency))
+        return next(iter(self._frequencies[min(self._frequencies)]))
+
+    def _live(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(key, entry)
+            return entry[0]
+
+    def has(self, key):
+        with self._lock:
+            return self._live(key) is not None
+
+    def set(self, key, data, ttl=None, only_if_missing=False):
+        with self._lock:
+            if only_if_missing and self._live(key) is not None:
+                return False
+            return self._store(key, data, ttl)
+
+    def add_member(self, key, member, ttl=None):
+        # adds member to the newline-separated set at key in one step, so
+        # workers sharing the store cannot drop each other's members
+        with self._lock:
+            entry = self._live(key)
+            members = entry[0].split(b'\n') if entry is not None else []
+            if member not in members:
+                members.append(member)
+            return self._store(key, b'\n'.join(members), ttl)
+
+    def _store(self, key, data, ttl):
+        # called with the lock held
+        size = len(key) + len(data)
+        if key in self._entries:
+            self._remove(key)
+        if size > self.max_bytes:
+            # too big to keep; the older value is gone all the same
+            return False
+        while self.used_bytes + size > self.max_bytes:
+            self._remove(self._victim())
+            self.evictions += 1
+        expires = time.monotonic() + ttl if ttl else None
+        self._entries[key] = [data, expires, 1]
+        self.used_bytes += size
+        if self.policy == 'lru':
+            self._recency[key] = None
+        else:
+            self._frequencies[1][key] = None
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._remove(key)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._recency.clear()
+            self._frequencies.clear()
+            self.used_bytes = 0
+
+    def hottest(self, limit):
+        # live keys, most recently used (lru) or most used (lfu) first
+        with self._lock:
+            if self.policy == 'lru':
+                keys = reversed(self._recency)
+            else:
+                keys = (key for frequency in sorted(self._frequencies, reverse=True)
+                        for key in reversed(self._frequencies[frequency]))
+            now = time.monotonic()
+            hot = []
+            for key in keys:
+                expires = self._entries[key][1]
+                if expires is None or expires > now:
+                    hot.append(key)
+                    if len(hot) >= limit:
+                        break
+            return hot
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "policy": self.policy,
+                "items": len(self._entries),
+                "bytes": self.used_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class LocalCache(BaseCache):
+    # in-process bounded cache, the default for single-worker runs
+    #   CACHE_TYPE = 'cache_backends.LocalCache'
+    #   CACHE_OPTIONS = {'max_bytes': ..., 'policy': 'lru' | 'lfu'}
+
+    def __init__(self, default_timeout=300, max_bytes=64 * 1024 * 1024, policy='lru', **kwargs):
+        super().__init__(default_timeout=default_timeout)
+        self.store = BoundedStore(max_bytes, policy)
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        return cls(*args, **kwargs)
+
+    def get(self, key):
+        data = self.store.get(key.encode())
+        return None if data is None else pickle.loads(data)
+
+    def set(self, key, value, timeout=None):
+        return self.store.set(key.encode(), pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                              self._normalize_timeout(timeout))
+
+    def add(self, key, value, timeout=None):
+        return self.store.set(key.encode(), pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                              self._normalize_timeout(timeout), only_if_missing=True)
+
+    def delete(self, key):
+        return self.store.delete(key.encode())
+
+    def add_member(self, key, member, timeout=None):
+        # sets of keys are kept as plain text, not pickled, so they can be added to in place
+        return self.store.add_member(key.encode(), member.encode(), self._normalize_timeout(timeout))
+
+    def members(self, key):
+        data = self.store.get(key.encode())
+        return [] if data is None else data.decode().split('\n')
+
+    def has(self, key):
+        return self.store.has(key.encode())
+
+    def clear(self):
+        self.store.clear()
+        return True
+
+    def stats(self):
+        return self.store.stats()
+
+    def hot_keys(self, limit):
+        return [key.decode() for key in self.store.hottest(limit)]
+
+
+class SharedCache(BaseCache):
+    # client for cache_daemon.py over a unix socket, so every worker on the host
+    # shares one bounded store. A missing daemon behaves like an empty cache.
+    #   CACHE_TYPE = 'cache_backends.SharedCache'
+    #   CACHE_OPTIONS = {'socket_path': ...}
+
+    def __init__(self, default_timeout=300, socket_path='/tmp/bookstore-cache.sock', timeout=0.5, **kwargs):
+        super().__init__(default_timeout=default_timeout)
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.errors = 0
+        self._local = threading.local()
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        return cls(*args, **kwargs)
+
+    def _socket(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _call(self, op, key=b'', value=b'', ttl=0.0):
+        try:
+            sock = self._socket()
+            sock.sendall(REQUEST.pack(op, len(key), len(value), ttl or 0.0) + key + value)
+            status, length = RESPONSE.unpack(recv_exactly(sock, RESPONSE.size))
+            return status, recv_exactly(sock, length)
+        except OSError:
+            self.errors += 1
+            sock = getattr(self._local, 'sock', None)
+            if sock is not None:
+                sock.close()
+                self._local.sock = None
+            return 0, b''
+
+    def get(self, key):
+        status, data = self._call(OP_GET, key.encode())
+        return pickle.loads(data) if status else None
+
+    def set(self, key, value, timeout=None):
+        status, _ = self._call(OP_SET, key.encode(), pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                               self._normalize_timeout(timeout))
+        return bool(status)
+
+    def add(self, key, value, timeout=None):
+        status, _ = self._call(OP_ADD, key.encode(), pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                               self._normalize_timeout(timeout))
+        return bool(status)
+
+    def delete(self, key):
+        status, _ = self._call(OP_DELETE, key.encode())
+        return bool(status)
+
+    def add_member(self, key, member, timeout=None):
+        # done by the daemon, so two workers adding to one set both get in
+        status, _ = self._call(OP_ADD_MEMBER, key.encode(), member.encode(), self._normalize_timeout(timeout))
+        return bool(status)
+
+    def members(self, key):
+        status, data = self._call(OP_GET, key.encode())
+        return data.decode().split('\n') if status else []
+
+    def has(self, key):
+        status, _ = self._call(OP_HAS, key.encode())
+        return bool(status)
+
+    def clear(self):
+        status, _ = self._call(OP_CLEAR)
+        return bool(status)
+
+    def stats(self):
+        status, data = self._call(OP_STATS)
+        stats = json.loads(data) if status else {"error": "cache daemon unreachable"}
+        stats["client_errors"] = self.errors
+        return stats
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ConnectionError("cache connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
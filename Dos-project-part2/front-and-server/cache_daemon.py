@@ -0,0 +1,68 @@
+# Shared cache for all front-server workers on one host:
+#
+#   python cache_daemon.py --socket /tmp/bookstore-cache.sock --max-mb 64 --policy lfu
+#
+# then start the front server with FRONT_CACHE=shared.
+import argparse
+import json
+import os
+import socketserver
+
+from cache_backends import (BoundedStore, REQUEST, RESPONSE, recv_exactly,
+                            OP_GET, OP_SET, OP_ADD, OP_DELETE, OP_CLEAR, OP_STATS, OP_HAS, OP_ADD_MEMBER)
+
+
+class CacheRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            try:
+                op, key_length, value_length, ttl = REQUEST.unpack(recv_exactly(self.request, REQUEST.size))
+                key = recv_exactly(self.request, key_length)
+                value = recv_exactly(self.request, value_length)
+            except ConnectionError:
+                return
+            status, payload = 1, b''
+            if op == OP_GET:
+                payload = store.get(key)
+                status, payload = (0, b'') if payload is None else (1, payload)
+            elif op == OP_SET:
+                status = int(store.set(key, value, ttl))
+            elif op == OP_ADD:
+                status = int(store.set(key, value, ttl, only_if_missing=True))
+            elif op == OP_DELETE:
+                status = int(store.delete(key))
+            elif op == OP_ADD_MEMBER:
+                status = int(store.add_member(key, value, ttl))
+            elif op == OP_HAS:
+                status = int(store.has(key))
+            elif op == OP_CLEAR:
+                store.clear()
+            elif op == OP_STATS:
+                payload = json.dumps(store.stats()).encode()
+            else:
+                status = 0
+            self.request.sendall(RESPONSE.pack(status, len(payload)) + payload)
+
+
+class CacheServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, store):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, CacheRequestHandler)
+        os.chmod(path, 0o600)
+        self.store = store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', default='/tmp/bookstore-cache.sock')
+    parser.add_argument('--max-mb', type=float, default=64)
+    parser.add_argument('--policy', choices=('lru', 'lfu'), default='lru')
+    args = parser.parse_args()
+    server = CacheServer(args.socket, BoundedStore(int(args.max_mb * 1024 * 1024), args.policy))
+    print(f"cache daemon on {args.socket} ({args.max_mb} MB, {args.policy})")
+    server.serve_forever()
@@ -0,0 +1,153 @@
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Keeps the front cache warm across restarts. dump() writes the hottest
+# books and topic lists to a gzipped JSON file on shutdown; on startup
+# restore() reads it back and revalidates every entry against the catalog
+# before caching it, and warm_top() loads the books ordered most in recent
+# history and their topics. If the catalog cannot be reached, the dumped
+# values go in as stale entries, which are served and refreshed on first use.
+# Entries are only added where the cache has none yet: requests served while
+# the warmer runs already put newer ones there.
+#
+# The file: {"written_at": ..., "books": {id: book}, "products": [id, ...],
+#            "topics": {cache topic: [id, ...]}}
+
+
+class CacheWarmer:
+
+    def __init__(self, product_cache, load_books, load_topic, top_books, path=None, max_keys=1000,
+                 top=20, recent_orders=10000):
+        # load_books(ids) -> {id: book}; load_topic(cache topic) -> [book] or None;
+        # top_books(limit, recent) -> [(book_id, quantity)]
+        self.product_cache = product_cache
+        self.load_books = load_books
+        self.load_topic = load_topic
+        self.top_books = top_books
+        self.path = path
+        self.max_keys = max_keys
+        self.top = top
+        self.recent_orders = recent_orders
+        self.counts = {"restored": 0, "changed": 0, "removed": 0, "stale": 0, "warmed": 0,
+                       "dumped": 0, "errors": [], "seconds": None}
+
+    def dump(self):
+        products, topics = self.product_cache.hot_entries(self.max_keys)
+        if not self.path or not (products or topics):
+            # nothing worth keeping; do not overwrite the last good file
+            return 0
+        books = {book['id']: book for book in products}
+        for topic_books in topics.values():
+            books.update((book['id'], book) for book in topic_books)
+        snapshot = {"written_at": time.time(), "books": books,
+                    "products": [book['id'] for book in products],
+                    "topics": {topic: [book['id'] for book in topic_books] for topic, topic_books in topics.items()}}
+        # a file of its own per worker; they all dump at the same shutdown
+        descriptor, temporary = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.',
+                                                 dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(descriptor, 'wb') as raw, gzip.open(raw, 'wt') as output:
+                json.dump(snapshot, output, separators=(',', ':'))
+            # mkstemp makes it owner-only
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, self.path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        self.counts["dumped"] = len(products) + len(topics)
+        return self.counts["dumped"]
+
+    def _read(self):
+        if not self.path or not os.path.exists(self.path):
+            return None
+        with gzip.open(self.path, 'rt') as source:
+            snapshot = json.load(source)
+        books = {int(book_id): book for book_id, book in snapshot["books"].items()}
+        return books, snapshot["products"], snapshot["topics"]
+
+    def restore(self):
+        try:
+            snapshot = self._read()
+        except (OSError, ValueError, KeyError) as error:
+            self.counts["errors"].append(f"unreadable snapshot {self.path}: {error}")
+            return
+        if snapshot is None:
+            return
+        books, products, topics = snapshot
+
+        try:
+            current = self.load_books(products)
+        except Exception as error:
+            self.counts["errors"].append(f"revalidating books: {error}")
+            current = None
+        # coldest first, so the hottest entries end up most recently used
+        for book_id in reversed(products):
+            if current is None:
+                self.product_cache.set_product(books[book_id], fresh=False, only_if_missing=True)
+                self.counts["stale"] += 1
+            elif book_id in current:
+                self.product_cache.set_product(current[book_id], only_if_missing=True)
+                self.counts["restored"] += 1
+                self.counts["changed"] += current[book_id] != books[book_id]
+            else:
+                self.counts["removed"] += 1
+
+        for topic, ids in reversed(list(topics.items())):
+            try:
+                topic_books = self.load_topic(topic)
+            except Exception as error:
+                self.counts["errors"].append(f"revalidating topic {topic}: {error}")
+                self.product_cache.set_topic(topic, [books[book_id] for book_id in ids], fresh=False, only_if_missing=True)
+                self.counts["stale"] += 1
+                continue
+            if topic_books:
+                self.product_cache.set_topic(topic, topic_books, only_if_missing=True)
+                self.counts["restored"] += 1
+                self.counts["changed"] += [book['id'] for book in topic_books] != ids or any(
+                    book != books[book['id']] for book in topic_books if book['id'] in books)
+            else:
+                self.counts["removed"] += 1
+
+    def warm_top(self):
+        if not self.top:
+            return
+        try:
+            ids = [book_id for book_id, _ in self.top_books(self.top, self.recent_orders)]
+            current = self.load_books(ids)
+        except Exception as error:
+            self.counts["errors"].append(f"warming top books: {error}")
+            return
+        for book in current.values():
+            if not self.product_cache.has_product(book['id']):
+                self.product_cache.set_product(book, only_if_missing=True)
+                self.counts["warmed"] += 1
+        # the topic pages those books are listed on, as /products/<topic> asks for them
+        for topic in {book['topic'] for book in current.values()}:
+            if self.product_cache.has_topic(topic):
+                continue
+            try:
+                topic_books = self.load_topic(topic)
+            except Exception as error:
+                self.counts["errors"].append(f"warming topic {topic}: {error}")
+                continue
+            if topic_books:
+                self.product_cache.set_topic(topic, topic_books, only_if_missing=True)
+                self.counts["warmed"] += 1
+
+    def run(self):
+        start = time.perf_counter()
+        self.restore()
+        self.warm_top()
+        self.counts["seconds"] = round(time.perf_counter() - start, 3)
+
+    def start(self):
+        # in the background, so the server starts listening right away
+        threading.Thread(target=self.run, name='cache-warmup', daemon=True).start()
+        return self
+
+    def stats(self):
+        return {**self.counts, "errors": self.counts["errors"][-10:], "path": self.path}
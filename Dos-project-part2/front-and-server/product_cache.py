@@ -0,0 +1,297 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common.metrics import CACHE
+from common.serialization import Encoded, dumps, loads
+
+ALL_TOPIC = 'all'
+# topic lists up to this many bytes are rewritten when one of their books
+# changes; longer ones, and 'all', are dropped and loaded again on demand
+MAX_REWRITE_BYTES = 32 * 1024
+
+
+PRODUCT_PREFIX = 'product_'
+TOPIC_PREFIX = 'products_'
+
+
+def product_key(book_id):
+    return f'{PRODUCT_PREFIX}{book_id}'
+
+
+def topic_key(topic):
+    return f'{TOPIC_PREFIX}{topic.lower()}'
+
+
+def index_key(book_id):
+    return f'topics_of_{book_id}'
+
+
+class SingleFlight:
+    # runs one load per key at a time; concurrent callers for the same key wait
+    # for that load and share its result (or its exception)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.loads = 0
+        self.shared = 0
+
+    def do(self, key, load):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event()}
+                self.loads += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call["done"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["value"]
+        try:
+            call["value"] = load()
+            return call["value"]
+        except Exception as error:
+            call["error"] = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+
+class ProductCache:
+    # Write-through cache for books and topic lists on top of a flask_caching
+    # Cache. Besides the entries themselves it keeps topics_of_<id>: the topic
+    # list keys that contain that book, so a purchase or a price change only
+    # touches the lists the book is actually in. The index is added to by the
+    # backend in one step (add_member), as several workers may share it. The
+    # 'all' list contains every book and is dropped instead of being indexed.
+    #
+    # Entries are fresh for `timeout` seconds and may then be served stale for
+    # another `stale_timeout` seconds while one background load refreshes them.
+    # Misses are coalesced so only one request per key reaches the catalog.
+    #
+    # Values are stored as JSON bytes with an ETag and the time they were
+    # written, so a hit is answered without encoding anything again. The
+    # load_*, cached_* and fill_* methods hand back that Encoded; get_* decode
+    # the value for callers that need it.
+    #
+    # Every update_book / invalidate_book takes the next generation number and
+    # stamps the book with it. A load that read a book before such a change
+    # is answered but not cached, so it cannot put the older row back.
+
+    def __init__(self, cache, timeout=600, stale_timeout=60, refresh_workers=2):
+        self.cache = cache
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self.flight = SingleFlight()
+        self.stale_hits = 0
+        self._refresher = ThreadPoolExecutor(refresh_workers, thread_name_prefix='cache-refresh')
+        # reentrant: a fill checks the stamps and stores under the same lock
+        self._lock = threading.RLock()
+        self._generation = 0
+        # book id -> generation of its last update_book / invalidate_book
+        self._changed = {}
+        self.discarded_loads = 0
+        # keys with a background refresh queued or running
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+
+    def _put(self, key, value, fresh=True, only_if_missing=False):
+        # a stale entry is served at once and refreshed in the background;
+        # only_if_missing leaves an entry already there alone
+        encoded = Encoded(dumps(value))
+        fresh_until = time.time() + self.timeout if fresh else time.time()
+        store = self.cache.add if only_if_missing else self.cache.set
+        store(key, (encoded.body, fresh_until, encoded.etag, encoded.modified), timeout=self.timeout + self.stale_timeout)
+        return encoded
+
+    def _read_encoded(self, key):
+        entry = self.cache.get(key)
+        if entry is None or len(entry) != 4:
+            # missing, or written by a front that stored values (shared daemon)
+            return None, False
+        body, fresh_until, etag, modified = entry
+        return Encoded(body, etag, modified), fresh_until > time.time()
+
+    def _read(self, key):
+        encoded, fresh = self._read_encoded(key)
+        return (None if encoded is None else loads(encoded.body)), fresh
+
+    def _load(self, key, load, store):
+        value = self._cached(key, load, store)
+        if value is not None:
+            return value
+        return self._fill(key, load, store)
+
+    def _cached(self, key, load, store):
+        # the part of _load that never waits on load(): None on a miss
+        value, fresh = self._read_encoded(key)
+        CACHE.inc(result='miss' if value is None else 'hit' if fresh else 'stale')
+        if value is not None and not fresh:
+            self.stale_hits += 1
+            if not self.flight.in_flight(key) and self._claim_refresh(key):
+                self._refresher.submit(self._refresh, key, load, store)
+        return value
+
+    def _claim_refresh(self, key):
+        # True for the one caller that gets to queue the refresh of key
+        with self._refreshing_lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def _fill(self, key, load, store):
+        def load_and_store():
+            started = self._generation
+            value = load()
+            if value is None:
+                return None
+            with self._lock:
+                if self._changed_since(value if isinstance(value, list) else [value], started):
+                    self.discarded_loads += 1
+                    return Encoded(dumps(value))
+                return store(value)
+
+        return self.flight.do(key, load_and_store)
+
+    def _refresh(self, key, load, store):
+        try:
+            self._fill(key, load, store)
+        except Exception as error:
+            # keep serving the stale entry until it expires for good
+            print(f"refreshing {key} failed: {error}")
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(key)
+
+    def uncached(self, load):
+        # for a read that has to see the caller's own write (X-Min-Seq): a
+        # cached entry or a load shared with others may predate it
+        value = load()
+        return None if value is None else Encoded(dumps(value))
+
+    def load_product(self, book_id, load):
+        # load() returns the book dict or None when it does not exist; the
+        # cached Encoded is returned, or None
+        return self._load(product_key(book_id), load, self.set_product)
+
+    def load_topic(self, topic, load):
+        return self._load(topic_key(topic), load, lambda books: self.set_topic(topic, books))
+
+    def cached_product(self, book_id, load):
+        return self._cached(product_key(book_id), load, self.set_product)
+
+    def cached_topic(self, topic, load):
+        return self._cached(topic_key(topic), load, lambda books: self.set_topic(topic, books))
+
+    def fill_product(self, book_id, load):
+        # after a cached_product() miss: load once, shared by concurrent callers
+        return self._fill(product_key(book_id), load, self.set_product)
+
+    def fill_topic(self, topic, load):
+        return self._fill(topic_key(topic), load, lambda books: self.set_topic(topic, books))
+
+    def get_product(self, book_id):
+        return self._read(product_key(book_id))[0]
+
+    def has_product(self, book_id):
+        # without touching the hit/miss counters
+        return self.cache.has(product_key(book_id))
+
+    def set_product(self, book, fresh=True, only_if_missing=False):
+        return self._put(product_key(book['id']), book, fresh, only_if_missing)
+
+    def get_topic(self, topic):
+        return self._read(topic_key(topic))[0]
+
+    def has_topic(self, topic):
+        return self.cache.has(topic_key(topic))
+
+    def set_topic(self, topic, books, fresh=True, only_if_missing=False):
+        key = topic_key(topic)
+        with self._lock:
+            encoded = self._put(key, books, fresh, only_if_missing)
+            if topic.lower() == ALL_TOPIC:
+                return encoded
+            for book in books:
+                self.cache.cache.add_member(index_key(book['id']), key, timeout=self.timeout + self.stale_timeout)
+            return encoded
+
+    def _touch(self, book_id):
+        # called with the lock held
+        self._generation += 1
+        self._changed[int(book_id)] = self._generation
+
+    def _changed_since(self, books, generation):
+        return any(self._changed.get(book['id'], 0) > generation for book in books)
+
+    def _topic_keys(self, book_id):
+        # keys of lists that have since been dropped stay until the index expires
+        return self.cache.cache.members(index_key(book_id)) + [topic_key(ALL_TOPIC)]
+
+    def update_book(self, book):
+        # a book changed (purchase or modify): refresh it in place, and in the
+        # short topic lists it is in; the long ones are dropped
+        with self._lock:
+            self._touch(book['id'])
+            self._put(product_key(book['id']), book)
+            for key in self._topic_keys(book['id']):
+                encoded, _ = self._read_encoded(key)
+                if encoded is None:
+                    continue
+                if key == topic_key(ALL_TOPIC) or len(encoded.body) > MAX_REWRITE_BYTES:
+                    self.cache.delete(key)
+                    continue
+                self._put(key, [book if cached['id'] == book['id'] else cached for cached in loads(encoded.body)])
+
+    def reload_book(self, book_id, load):
+        # after a change notice: load() reads the book again, None if it is
+        # gone. Dropped when the book changes again while it is read.
+        started = self._generation
+        book = load()
+        with self._lock:
+            if self._changed_since([{'id': int(book_id)}], started):
+                self.discarded_loads += 1
+            elif book is None:
+                self.invalidate_book(book_id)
+            else:
+                self.update_book(book)
+
+    def invalidate_book(self, book_id):
+        with self._lock:
+            self._touch(book_id)
+            self.cache.delete(product_key(book_id))
+            for key in self._topic_keys(book_id):
+                self.cache.delete(key)
+            self.cache.delete(index_key(book_id))
+
+    def hot_entries(self, limit):
+        # the hottest books and topic lists, for cache_warmup; empty when the
+        # backend cannot rank its keys (the shared daemon outlives the front anyway)
+        hot_keys = getattr(self.cache.cache, 'hot_keys', None)
+        products, topics = [], {}
+        for key in hot_keys(limit) if hot_keys else []:
+            if not key.startswith((TOPIC_PREFIX, PRODUCT_PREFIX)):
+                continue
+            value, _ = self._read(key)
+            if value is None:
+                continue
+            if key.startswith(TOPIC_PREFIX):
+                topics[key[len(TOPIC_PREFIX):]] = value
+            else:
+                products.append(value)
+        return products, topics
+
+    def stats(self):
+        return {"coalesced_loads": self.flight.loads, "coalesced_waiters": self.flight.shared,
+                "stale_hits": self.stale_hits, "discarded_loads": self.discarded_loads}
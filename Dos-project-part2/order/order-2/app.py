@@ -1,54 +1,242 @@
-from flask import Flask, jsonify, request
-import sqlite3
-import threading
+from flask import Flask, g, jsonify, request
 import os
-from datetime import datetime  
+import sys
+from werkzeug.serving import WSGIRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../..'))
+from common.anti_entropy import AntiEntropy
+from common.db_pool import configure_pools, get_pool, pool_stats, PoolTimeout
+from common.group_commit import GroupCommitWriter
+from common.hot_stock import reservation_id, HotStockClient
+from common.http_client import BackendError
+from common.idempotency import idempotent, IdempotencyStore
+from common.invalidation import InvalidationNotifier
+from common.metrics import instrument, span, target_name
+from common.migrations import migrate
+from common.order_rollups import book_sales, parse_range, sales_by_bucket, top_sellers, BUCKETS
+from common.replication import ReplicationLog
+from common.stock import (decrement_stock_batch, delete_orders, insert_orders, parse_cart,
+                          restock_batch, top_books, PURCHASED, OUT_OF_STOCK, NOT_FOUND)
 
 app = Flask(__name__)
+# /metrics, /stats/traces and X-Trace-Id handling
+instrument(app, 'order-2')
+
+
+# another shard's replicas when this service runs for it (common/sharding.py)
+pathOrder2DB = os.environ.get('ORDER_DB_2', os.path.join(os.path.dirname(__file__), 'order2.db'))
+pathOrder1DB = os.environ.get('ORDER_DB_1', os.path.join(os.path.dirname(__file__), '../order-1/order1.db'))
+
+pathCatalog1DB = os.environ.get('CATALOG_DB_1', os.path.join(os.path.dirname(__file__), '../../catalog/catalog-1/catalog1.db'))
+pathCatalog2DB = os.environ.get('CATALOG_DB_2', os.path.join(os.path.dirname(__file__), '../../catalog/catalog-2/catalog2.db'))
+
+# how long a request waits for a pooled connection before its 503; under
+# the front's BACKEND_TIMEOUT so the front sees the 503 and not a timeout
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 1.0))
+configure_pools(checkout_timeout=app.config['DB_POOL_TIMEOUT'])
+
+# WAL, indexes and topic search; a no-op once the files are up to date
+for path in (pathOrder1DB, pathOrder2DB):
+    migrate(path, 'order')
+for path in (pathCatalog1DB, pathCatalog2DB):
+    migrate(path, 'catalog')
 
+# catalog1.db and order1.db are the primaries in 'primary_backup' mode
+app.config['REPLICATION_MODE'] = os.environ.get('REPLICATION_MODE', 'sync')
+catalog_log = None
+order_log = None
+if app.config['REPLICATION_MODE'] == 'primary_backup':
+    catalog_log = ReplicationLog(pathCatalog1DB, [pathCatalog2DB]).start()
+    order_log = ReplicationLog(pathOrder1DB, [pathOrder2DB]).start()
 
-thread_data = threading.local()
+# 'group' hands order rows to one writer thread per replica that commits them
+# in batches; 'direct' commits each purchase on its own
+app.config['ORDER_WRITE_MODE'] = os.environ.get('ORDER_WRITE_MODE', 'group')
+app.config['GROUP_COMMIT_MAX_ROWS'] = int(os.environ.get('GROUP_COMMIT_MAX_ROWS', 128))
+app.config['GROUP_COMMIT_DELAY_MS'] = float(os.environ.get('GROUP_COMMIT_DELAY_MS', 2))
+# how long a purchase waits for its order rows before it is undone and
+# answered 503; under the front's BACKEND_TIMEOUT so the front sees the 503
+app.config['ORDER_WRITE_TIMEOUT'] = float(os.environ.get('ORDER_WRITE_TIMEOUT', 1.5))
+order_writers = []
+if app.config['ORDER_WRITE_MODE'] == 'group':
+    order_writers = [GroupCommitWriter(path, app.config['GROUP_COMMIT_MAX_ROWS'],
+                                       app.config['GROUP_COMMIT_DELAY_MS'] / 1000, log=order_log)
+                     for path in ([pathOrder1DB] if order_log else [pathOrder1DB, pathOrder2DB])]
 
-pathOrder2DB = os.path.join(os.path.dirname(__file__), 'order2.db')
-pathOrder1DB = os.path.join(os.path.dirname(__file__), '../order-1/order1.db')
+# flash-sale books are sold from the counters of the catalog service at
+# HOT_STOCK_SERVICE instead of decrementing the catalog files here
+app.config['HOT_BOOKS'] = [int(book_id) for book_id in os.environ.get('HOT_BOOKS', '').split(',') if book_id.strip()]
+app.config['HOT_STOCK_SERVICE'] = os.environ.get('HOT_STOCK_SERVICE', 'http://127.0.0.1:6001')
+hot_stock = HotStockClient(app.config['HOT_STOCK_SERVICE'], app.config['HOT_BOOKS']) if app.config['HOT_BOOKS'] else None
 
-pathCatalog1DB = os.path.join(os.path.dirname(__file__), '../../catalog/catalog-1/catalog1.db')
-pathCatalog2DB = os.path.join(os.path.dirname(__file__), '../../catalog/catalog-2/catalog2.db')
+# checks every ANTI_ENTROPY_INTERVAL seconds that the order replicas hold the
+# same rows and makes order1.db win where they do not (common/anti_entropy.py);
+# only the ANTI_ENTROPY_OWNER service runs it, 0 turns it off
+app.config['ANTI_ENTROPY_INTERVAL'] = float(os.environ.get('ANTI_ENTROPY_INTERVAL', 30))
+app.config['ANTI_ENTROPY_REPAIR'] = os.environ.get('ANTI_ENTROPY_REPAIR', 'true') == 'true'
+app.config['ANTI_ENTROPY_OWNER'] = os.environ.get('ANTI_ENTROPY_OWNER', 'order-1')
+anti_entropy = None
+if (app.config['ANTI_ENTROPY_OWNER'] == 'order-2'
+        and (__name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true')):
+    anti_entropy = AntiEntropy([('order', 'order', pathOrder1DB, [pathOrder2DB])], app.config['ANTI_ENTROPY_INTERVAL'],
+                               app.config['ANTI_ENTROPY_REPAIR']).start()
+
+# purchases sent with an Idempotency-Key run once and are replayed after that
+# (common/idempotency.py). Both order services of a shard share the file
+# next to order1.db, so a retry that reaches the other one is still a repeat.
+app.config['IDEMPOTENCY_DB'] = os.environ.get('IDEMPOTENCY_DB', os.path.join(os.path.dirname(pathOrder1DB), 'idempotency.db'))
+app.config['IDEMPOTENCY_TTL'] = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+app.config['IDEMPOTENCY_CACHE'] = int(os.environ.get('IDEMPOTENCY_CACHE', 10000))
+idempotency = None
+if app.config['IDEMPOTENCY_TTL'] > 0:
+    migrate(app.config['IDEMPOTENCY_DB'], 'idempotency')
+    idempotency = IdempotencyStore(app.config['IDEMPOTENCY_DB'], app.config['IDEMPOTENCY_TTL'],
+                                   app.config['IDEMPOTENCY_CACHE'])
+
+# front servers whose caches are told about every purchased book
+invalidations = InvalidationNotifier(os.environ.get('FRONT_SERVERS', 'http://127.0.0.1:5000').split(','),
+                                     log=catalog_log, token=os.environ.get('INVALIDATION_TOKEN'))
+
+CONNECTIONS = {
+    'order1_db_connection': pathOrder1DB,
+    'order2_db_connection': pathOrder2DB,
+    'catalog1_connection': pathCatalog1DB,
+    'catalog2_connection': pathCatalog2DB,
+}
+
+def pooled_connection(name):
+    # borrowed from the pool for the rest of the request, handed back on teardown
+    if name not in g:
+        setattr(g, name, get_pool(CONNECTIONS[name]).checkout())
+    return getattr(g, name)
 
 def openOrder1DB():
-    if not hasattr(thread_data, 'order1_db_connection'):
-        thread_data.order1_db_connection = sqlite3.connect(pathOrder1DB)
-        thread_data.order1_db_connection.row_factory = sqlite3.Row
-    return thread_data.order1_db_connection
+    return pooled_connection('order1_db_connection')
 
 def openOrder2DB():
-    if not hasattr(thread_data, 'order2_db_connection'):
-        thread_data.order2_db_connection = sqlite3.connect(pathOrder2DB)
-        thread_data.order2_db_connection.row_factory = sqlite3.Row
-    return thread_data.order2_db_connection
+    return pooled_connection('order2_db_connection')
 
 def catalog1_db_connection():
-    if not hasattr(thread_data, 'catalog1_connection'):
-        thread_data.catalog1_connection = sqlite3.connect(pathCatalog1DB)
-        thread_data.catalog1_connection.row_factory = sqlite3.Row  
-    return thread_data.catalog1_connection
+    return pooled_connection('catalog1_connection')
 
 def catalog2_db_connection():
-    if not hasattr(thread_data, 'catalog2_connection'):
-        thread_data.catalog2_connection = sqlite3.connect(pathCatalog2DB)
-        thread_data.catalog2_connection.row_factory = sqlite3.Row  
-    return thread_data.catalog2_connection
+    return pooled_connection('catalog2_connection')
+
+# database file behind each connection function, for span labels
+REPLICAS = {
+    openOrder1DB: pathOrder1DB,
+    openOrder2DB: pathOrder2DB,
+    catalog1_db_connection: pathCatalog1DB,
+    catalog2_db_connection: pathCatalog2DB,
+}
+ORDER_CONNECTIONS = {pathOrder1DB: openOrder1DB, pathOrder2DB: openOrder2DB}
 
 @app.teardown_appcontext
 def close_connections(error):
-    if hasattr(thread_data, 'order1_db_connection'):
-        thread_data.order1_db_connection.close()
-    if hasattr(thread_data, 'order2_db_connection'):
-        thread_data.order2_db_connection.close()
-    if hasattr(thread_data, 'catalog1_connection'):
-        thread_data.catalog1_connection.close()
-    if hasattr(thread_data, 'catalog2_connection'):
-        thread_data.catalog2_connection.close()
+    for name, path in CONNECTIONS.items():
+        if name in g:
+            get_pool(path).checkin(g.pop(name))
+
+@app.errorhandler(PoolTimeout)
+def pool_exhausted(error):
+    return jsonify({"message": f"Server busy: {error}"}), 503, [('Retry-After', str(error.retry_after))]
+
+def write_orders(cart, order_targets):
+    # the cart's order rows on every order replica; returns the
+    # [(connection function, order ids)] written and the error that stopped
+    # the rest, if any
+    written = []
+    try:
+        if order_writers:
+            # queue on every replica first so both batches fill in parallel
+            tickets = [writer.enqueue(cart) for writer in order_writers]
+            error = None
+            for writer, ticket in zip(order_writers, tickets):
+                with span('order_insert', target_name(writer.path)):
+                    try:
+                        written.append((ORDER_CONNECTIONS[writer.path], ticket.wait(app.config['ORDER_WRITE_TIMEOUT'])))
+                    except Exception as ticket_error:
+                        error = error or ticket_error
+            return written, error
+        for order_connection in order_targets:
+            with span('order_insert', target_name(REPLICAS[order_connection])):
+                written.append((order_connection, insert_orders(order_connection(), cart, log=order_log)))
+    except Exception as error:
+        return written, error
+    return written, None
+
+def undo_purchase(written, catalog_done, catalog_cart, hot_cart, reservation, books):
+    # the order rows could not be written everywhere: the ones that were are
+    # deleted and the stock goes back where it was taken from
+    for order_connection, order_ids in written:
+        delete_orders(order_connection(), order_ids, log=order_log)
+    for catalog_connection in catalog_done:
+        with span('catalog_restock', target_name(REPLICAS[catalog_connection])):
+            restock_batch(catalog_connection(), catalog_cart, log=catalog_log)
+    if hot_cart:
+        hot_stock.release(hot_cart, reservation)
+    for book in books:
+        invalidations.book_changed(book)
+
+def purchase_cart(cart):
+    # both purchase routes: takes the cart's stock and writes its order rows,
+    # or leaves everything as it was. Returns None once the cart is sold,
+    # else the error response. Connections are only taken from the pools
+    # when they are used.
+    catalog_targets = (catalog1_db_connection, catalog2_db_connection)
+    order_targets = (openOrder1DB, openOrder2DB)
+    if catalog_log:
+        # only the primaries are written, the shippers bring the backups along
+        catalog_targets = catalog_targets[:1]
+        order_targets = order_targets[:1]
+
+    # hot books come off the in-memory counters first, the rest of the cart
+    # off the catalog files
+    hot_cart, catalog_cart = hot_stock.split(cart) if hot_stock else ([], cart)
+    hot_books = []
+    reservation = reservation_id() if hot_cart else None
+    if hot_cart:
+        try:
+            status, failed_id, hot_books = hot_stock.reserve(hot_cart, reservation)
+        except BackendError as error:
+            return jsonify({"message": f"Hot stock service unavailable: {error}", "status": False}), 503
+        if status == OUT_OF_STOCK:
+            return jsonify({"message": "Book out of stock", "book_id": failed_id, "status": False}), 400
+        if status == NOT_FOUND:
+            return jsonify({"message": "Book not found", "book_id": failed_id, "status": False}), 404
+
+    # all-or-nothing on every replica: one that refuses the cart rolls back and
+    # the replicas that already took it are restocked
+    done = []
+    books = []
+    for catalog_connection in catalog_targets if catalog_cart else ():
+        with span('catalog_decrement', target_name(REPLICAS[catalog_connection])):
+            status, failed_id, books = decrement_stock_batch(catalog_connection(), catalog_cart, log=catalog_log)
+        if status != PURCHASED:
+            for done_connection in done:
+                with span('catalog_restock', target_name(REPLICAS[done_connection])):
+                    restock_batch(done_connection(), catalog_cart, log=catalog_log)
+            if hot_cart:
+                hot_stock.release(hot_cart, reservation)
+            if status == OUT_OF_STOCK:
+                return jsonify({"message": "Book out of stock", "book_id": failed_id, "status": False}), 400
+            return jsonify({"message": "Book not found", "book_id": failed_id, "status": False}), 404
+        done.append(catalog_connection)
+
+    for book in list(books) + hot_books:
+        invalidations.book_changed(book)
+
+    written, error = write_orders(cart, order_targets)
+    if error is not None:
+        undo_purchase(written, done, catalog_cart, hot_cart, reservation, list(books) + hot_books)
+        return jsonify({"message": f"Order could not be recorded: {error}", "status": False}), 503
+    if hot_cart:
+        hot_stock.confirm(reservation)
+    return None
+
+@app.route('/stats/pools', methods=['GET'])
+def connection_pool_stats():
+    return jsonify(pool_stats()), 200
 
 @app.route('/', methods=['GET'])
 def catalog2():  
@@ -65,6 +253,7 @@ def catalog2():
 
 #! work: done
 @app.route('/purchase/<book_id>/', methods=['PUT'])
+@idempotent(idempotency)
 def process_purchase(book_id):
     
     try:
@@ -72,49 +261,112 @@ def process_purchase(book_id):
     except ValueError:
         return jsonify({"message": "Book ID must be a numeric value"}), 400
 
-    order1_connection = openOrder1DB()
-    order2_connection = openOrder2DB()
-    catalog1_connection = catalog1_db_connection()
-    catalog2_connection = catalog2_db_connection()
-
-    with catalog1_connection:
-        cursor1 = catalog1_connection.cursor()
-        cursor1.execute("SELECT * FROM books WHERE id=?", (book_id,))
-        book_info1 = cursor1.fetchone()
-        
-        if book_info1:
-            if book_info1['quantity'] > 0:
-                updated_quantity = book_info1['quantity'] - 1
-                cursor1.execute("UPDATE books SET quantity=? WHERE id=?", (updated_quantity, book_id))
-            else:
-                return jsonify({"message": "Book out of stock", "status": False}), 400
-        else:
-            return jsonify({"message": "Book not found", "status": False}), 404
-    
-    with catalog2_connection:
-        cursor2 = catalog2_connection.cursor()
-        cursor2.execute("SELECT * FROM books WHERE id=?", (book_id,))
-        book_info2 = cursor2.fetchone()
-        
-        if book_info2:
-            if book_info2['quantity'] > 0:
-                updated_quantity = book_info2['quantity'] - 1
-                cursor2.execute("UPDATE books SET quantity=? WHERE id=?", (updated_quantity, book_id))
-            else:
-                return jsonify({"message": "Book out of stock", "status": False}), 400
-        else:
-            return jsonify({"message": "Book not found", "status": False}), 404
-    
-    
-    with order1_connection:
-        order1_cursor = order1_connection.cursor()
-        order1_cursor.execute("INSERT INTO orders (book_id, order_date, quantity) VALUES (?, ?, ?)", (book_id, datetime.now()  , 1))
-    
-    with order2_connection:
-        order2_cursor = order2_connection.cursor()
-        order2_cursor.execute("INSERT INTO orders (book_id, order_date, quantity) VALUES (?, ?, ?)", (book_id, datetime.now()  , 1))
-    
-    return jsonify({"message": "Book successfully purchased", "status": True}), 200
+    error = purchase_cart([(book_id, 1)])
+    if error is not None:
+        return error
+
+    response = jsonify({"message": "Book successfully purchased", "status": True})
+    if catalog_log:
+        response.headers['X-Catalog-Seq'] = str(catalog_log.last_seq())
+    return response, 200
+
+@app.route('/orders/top', methods=['GET'])
+def most_ordered_books():
+    # used by the front server to warm its cache after a restart
+    limit = request.args.get('limit', '20')
+    recent = request.args.get('recent', '10000')
+    if not limit.isdigit() or not recent.isdigit():
+        return jsonify({"message": "limit and recent must be numeric"}), 400
+    rows = top_books(openOrder2DB(), int(limit), int(recent))
+    return jsonify([{"book_id": book_id, "quantity": quantity} for book_id, quantity in rows]), 200
+
+# sales analytics, read from the rollup tables the order triggers keep
+# (common/order_rollups.py) rather than from orders
+@app.route('/orders/sales/top', methods=['GET'])
+def top_selling_books():
+    limit = request.args.get('limit', '20')
+    if not limit.isdigit():
+        return jsonify({"message": "limit must be numeric"}), 400
+    try:
+        since, until = parse_range(request.args)
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+    with span('order_read', target_name(pathOrder2DB)):
+        rows = top_sellers(openOrder2DB(), int(limit), since, until)
+    return jsonify([{"book_id": book_id, "orders": orders, "quantity": quantity} for book_id, orders, quantity in rows]), 200
+
+@app.route('/orders/sales/book/<int:book_id>', methods=['GET'])
+def sales_of_book(book_id):
+    try:
+        since, until = parse_range(request.args)
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+    with span('order_read', target_name(pathOrder2DB)):
+        sales = book_sales(openOrder2DB(), book_id, since, until)
+    if sales is None:
+        return jsonify({"message": "No orders for this book"}), 404
+    return jsonify(sales), 200
+
+@app.route('/orders/sales', methods=['GET'])
+def sales_over_time():
+    bucket = request.args.get('bucket', 'day')
+    book_id = request.args.get('book_id')
+    if bucket not in BUCKETS:
+        return jsonify({"message": f"bucket must be one of {', '.join(BUCKETS)}"}), 400
+    if book_id is not None and not book_id.isdigit():
+        return jsonify({"message": "book_id must be numeric"}), 400
+    try:
+        since, until = parse_range(request.args)
+        with span('order_read', target_name(pathOrder2DB)):
+            buckets = sales_by_bucket(openOrder2DB(), bucket, since, until, int(book_id) if book_id else None)
+    except ValueError as error:
+        return jsonify({"message": str(error)}), 400
+    return jsonify(buckets), 200
+
+@app.route('/stats/anti-entropy', methods=['GET'])
+def anti_entropy_stats():
+    if not anti_entropy:
+        return jsonify({"error": "This service does not run the anti-entropy job"}), 404
+    return jsonify(anti_entropy.stats()), 200
+
+@app.route('/anti-entropy/run', methods=['POST'])
+def run_anti_entropy():
+    # one pass now; ?repair=false only reports
+    if not anti_entropy:
+        return jsonify({"error": "This service does not run the anti-entropy job"}), 409
+    return jsonify(anti_entropy.run_once(request.args.get('repair', 'true') == 'true')), 200
+
+@app.route('/stats/idempotency', methods=['GET'])
+def idempotency_stats():
+    if not idempotency:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **idempotency.stats()}), 200
+
+@app.route('/stats/orders', methods=['GET'])
+def order_write_stats():
+    return jsonify({"mode": app.config['ORDER_WRITE_MODE'], "writers": [writer.stats() for writer in order_writers]}), 200
+
+@app.route('/purchase/batch', methods=['POST'])
+@idempotent(idempotency)
+def process_batch_purchase():
+    try:
+        cart = parse_cart(request.get_json(silent=True))
+    except ValueError as error:
+        return jsonify({"message": str(error), "status": False}), 400
+
+    error = purchase_cart(cart)
+    if error is not None:
+        return error
+
+    response = jsonify({"message": "Books successfully purchased", "status": True,
+                        "items": [{"book_id": book_id, "quantity": quantity} for book_id, quantity in cart]})
+    if catalog_log:
+        response.headers['X-Catalog-Seq'] = str(catalog_log.last_seq())
+    return response, 200
 
 if __name__ == '__main__':
-    app.run(debug=True, port=7001)
\ No newline at end of file
+    # HTTP/1.1 lets the front server keep its pooled connections open; without
+    # TCP_NODELAY the split header/body writes stall on delayed ACKs
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    WSGIRequestHandler.disable_nagle_algorithm = True
+    app.run(debug=True, port=int(os.environ.get('PORT', 7001)))
\ No newline at end of file
@@ -0,0 +1,67 @@
+# The topics_of_<id> index and what a book change does to the topic lists,
+# on an in-process cache and on two workers sharing one cache daemon.
+import os
+import sys
+import threading
+
+import pytest
+from flask import Flask
+from flask_caching import Cache
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'front-and-server'))
+from cache_backends import BoundedStore
+from cache_daemon import CacheServer
+from product_cache import ProductCache, MAX_REWRITE_BYTES, index_key, topic_key
+
+
+def product_cache(cache_type, **options):
+    app = Flask(__name__)
+    app.config['CACHE_TYPE'] = cache_type
+    app.config['CACHE_OPTIONS'] = options
+    return ProductCache(Cache(app))
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    server = CacheServer(str(tmp_path / 'cache.sock'), BoundedStore())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address
+    server.shutdown()
+    server.server_close()
+
+
+def book(book_id, quantity=10, topic='Fiction'):
+    return {"id": book_id, "title": f"Book {book_id}", "quantity": quantity, "price": 10.0, "topic": topic}
+
+
+def test_update_rewrites_short_lists_and_drops_long_ones():
+    cache = product_cache('cache_backends.LocalCache')
+    long_list = [book(book_id) for book_id in range(1, MAX_REWRITE_BYTES // 50)]
+    cache.set_topic('fiction', [book(1), book(2)])
+    cache.set_topic('fic', long_list)
+    cache.set_topic('all', long_list)
+    cache.update_book(book(1, quantity=9))
+    assert cache.get_topic('fiction')[0]['quantity'] == 9
+    assert cache.get_product(1)['quantity'] == 9
+    assert not cache.has_topic('fic')
+    assert not cache.has_topic('all')
+
+
+def test_shared_index_keeps_every_worker_key(daemon):
+    workers = [product_cache('cache_backends.SharedCache', socket_path=daemon) for _ in range(2)]
+    topics = [f'topic{number}' for number in range(50)]
+
+    def fill(worker, names):
+        for name in names:
+            worker.set_topic(name, [book(1)])
+
+    threads = [threading.Thread(target=fill, args=(worker, topics[number::2])) for number, worker in enumerate(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(workers[0].cache.cache.members(index_key(1))) == sorted(topic_key(name) for name in topics)
+    workers[1].update_book(book(1, quantity=3))
+    assert all(workers[0].get_topic(name)[0]['quantity'] == 3 for name in topics)
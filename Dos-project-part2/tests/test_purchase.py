@@ -0,0 +1,181 @@
+# A purchase that one catalog replica refuses, or whose order rows cannot be
+# written, must leave every replica as it was. The front servers (sqlite
+# mode) and an order service run against copies of the replica files.
+import asyncio
+import importlib.util
+import json
+import os
+import shutil
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+REPLICAS = {
+    'catalog1.db': 'catalog/catalog-1/catalog1.db',
+    'catalog2.db': 'catalog/catalog-2/catalog2.db',
+    'order1.db': 'order/order-1/order1.db',
+    'order2.db': 'order/order-2/order2.db',
+}
+
+
+def load_app(name, path):
+    # each test imports the app again, so it reads its environment again
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def quantity(path, book_id):
+    with sqlite3.connect(path) as connection:
+        return connection.execute("SELECT quantity FROM books WHERE id=?", (book_id,)).fetchone()[0]
+
+
+def set_quantity(path, book_id, value):
+    with sqlite3.connect(path) as connection:
+        connection.execute("UPDATE books SET quantity=? WHERE id=?", (value, book_id))
+
+
+def break_table(path, table):
+    # every write to `table` fails from now on
+    with sqlite3.connect(path) as connection:
+        for event in ('INSERT', 'UPDATE'):
+            connection.execute(f"CREATE TRIGGER broken_{table}_{event.lower()} BEFORE {event} ON {table} "
+                               "BEGIN SELECT RAISE(ABORT, 'replica broken'); END")
+
+
+def order_count(path):
+    with sqlite3.connect(path) as connection:
+        return connection.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+
+@pytest.fixture
+def replicas(tmp_path, monkeypatch):
+    paths = {}
+    for name, source in REPLICAS.items():
+        paths[name] = str(tmp_path / name)
+        shutil.copy(os.path.join(ROOT, source), paths[name])
+    monkeypatch.setenv('IDEMPOTENCY_TTL', '0')
+    monkeypatch.setenv('ANTI_ENTROPY_INTERVAL', '0')
+    monkeypatch.setenv('FRONT_SERVERS', '')
+    # the second replica has sold out book 2, the first has not noticed yet
+    set_quantity(paths['catalog1.db'], 2, 5)
+    set_quantity(paths['catalog2.db'], 2, 0)
+    return paths
+
+
+@pytest.fixture
+def front_environment(replicas, tmp_path, monkeypatch):
+    shards = tmp_path / 'shards.json'
+    shards.write_text(json.dumps({"shards": [{"name": "default",
+                                              "catalog": [replicas['catalog1.db'], replicas['catalog2.db']],
+                                              "order": [replicas['order1.db'], replicas['order2.db']]}]}))
+    monkeypatch.setenv('SHARDS_CONFIG', str(shards))
+    monkeypatch.setenv('FRONT_BACKEND', 'sqlite')
+    monkeypatch.setenv('CACHE_SNAPSHOT_PATH', str(tmp_path / 'cache_snapshot.json.gz'))
+    monkeypatch.setenv('CACHE_WARM_TOP', '0')
+    monkeypatch.syspath_prepend(os.path.join(ROOT, 'front-and-server'))
+
+
+@pytest.fixture
+def front(front_environment, tmp_path):
+    return load_app(f'front_{tmp_path.name}', 'front-and-server/app.py').app.test_client()
+
+
+@pytest.fixture
+def asgi_front(front_environment, tmp_path, monkeypatch):
+    # asgi_app imports the Flask app as `app`; it has to read this test's environment
+    monkeypatch.delitem(sys.modules, 'app', raising=False)
+    return load_app(f'asgi_{tmp_path.name}', 'front-and-server/asgi_app.py')
+
+
+@pytest.fixture
+def order_service(replicas, tmp_path, monkeypatch):
+    monkeypatch.setenv('CATALOG_DB_1', replicas['catalog1.db'])
+    monkeypatch.setenv('CATALOG_DB_2', replicas['catalog2.db'])
+    monkeypatch.setenv('ORDER_DB_1', replicas['order1.db'])
+    monkeypatch.setenv('ORDER_DB_2', replicas['order2.db'])
+    monkeypatch.setenv('ORDER_WRITE_MODE', 'direct')
+    return load_app(f'order_{tmp_path.name}', 'order/order-1/app.py').app.test_client()
+
+
+def assert_untouched(replicas, orders, second_quantity=0):
+    assert quantity(replicas['catalog1.db'], 2) == 5
+    assert quantity(replicas['catalog2.db'], 2) == second_quantity
+    assert order_count(replicas['order1.db']) == orders[0]
+    assert order_count(replicas['order2.db']) == orders[1]
+
+
+def test_front_purchase_refused_by_second_replica(front, replicas):
+    orders = order_count(replicas['order1.db']), order_count(replicas['order2.db'])
+    response = front.put('/purchase/2/')
+    assert response.status_code == 400
+    assert_untouched(replicas, orders)
+
+
+def test_front_batch_refused_by_second_replica(front, replicas):
+    orders = order_count(replicas['order1.db']), order_count(replicas['order2.db'])
+    response = front.post('/purchase/batch', json={"items": [{"book_id": 1}, {"book_id": 2}]})
+    assert response.status_code == 400
+    assert response.get_json()['book_id'] == 2
+    assert_untouched(replicas, orders)
+
+
+def test_order_service_purchase_refused_by_second_replica(order_service, replicas):
+    orders = order_count(replicas['order1.db']), order_count(replicas['order2.db'])
+    response = order_service.put('/purchase/2/')
+    assert response.status_code == 400
+    assert_untouched(replicas, orders)
+
+
+def test_front_purchase_sold_everywhere(front, replicas):
+    set_quantity(replicas['catalog2.db'], 2, 5)
+    orders = order_count(replicas['order1.db'])
+    response = front.put('/purchase/2/')
+    assert response.status_code == 200
+    assert quantity(replicas['catalog1.db'], 2) == quantity(replicas['catalog2.db'], 2) == 4
+    assert order_count(replicas['order1.db']) == orders + 1
+
+
+def test_front_purchase_undone_when_orders_fail(front, replicas):
+    set_quantity(replicas['catalog2.db'], 2, 5)
+    orders = order_count(replicas['order1.db']), order_count(replicas['order2.db'])
+    break_table(replicas['order2.db'], 'orders')
+    response = front.put('/purchase/2/')
+    assert response.status_code == 503
+    assert_untouched(replicas, orders, second_quantity=5)
+
+
+def test_front_purchase_undone_when_a_replica_fails(front, replicas):
+    set_quantity(replicas['catalog2.db'], 2, 5)
+    orders = order_count(replicas['order1.db']), order_count(replicas['order2.db'])
+    break_table(replicas['catalog2.db'], 'books')
+    response = front.put('/purchase/2/')
+    assert response.status_code == 500
+    assert_untouched(replicas, orders, second_quantity=5)
+
+
+def test_asgi_purchase_refused_by_second_replica(asgi_front, replicas):
+    orders = order_count(replicas['order1.db']), order_count(replicas['order2.db'])
+    assert asyncio.run(asgi_front.buy([(2, 1)]))[0] == asgi_front.OUT_OF_STOCK
+    assert_untouched(replicas, orders)
+
+
+def test_asgi_purchase_undone_when_a_replica_fails(asgi_front, replicas):
+    set_quantity(replicas['catalog2.db'], 2, 5)
+    orders = order_count(replicas['order1.db']), order_count(replicas['order2.db'])
+    break_table(replicas['catalog2.db'], 'books')
+    with pytest.raises(sqlite3.IntegrityError):
+        asyncio.run(asgi_front.buy([(2, 1)]))
+    assert_untouched(replicas, orders, second_quantity=5)
+
+
+def test_asgi_purchase_undone_when_orders_fail(asgi_front, replicas):
+    set_quantity(replicas['catalog2.db'], 2, 5)
+    orders = order_count(replicas['order1.db']), order_count(replicas['order2.db'])
+    break_table(replicas['order2.db'], 'orders')
+    status, error, _ = asyncio.run(asgi_front.buy([(1, 1), (2, 1)]))
+    assert status == asgi_front.UNRECORDED and 'replica broken' in error
+    assert_untouched(replicas, orders, second_quantity=5)